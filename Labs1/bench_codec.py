@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+from raft.codec import BinaryCodec, JsonCodec
+from raft.log import CompactLog
+from raft.protocol import MessageType, MessageDirection, RequestVotesMessage, RequestVotesResults, \
+    AppendEntriesMessage, AppendEntriesResults, parse_json_message
+import sys
+import time
+
+nodes = [f'127.0.0.1:{5557 + i}' for i in range(5)]
+iterations = 20000
+
+
+def make_messages():
+    """One of each message the leader and followers send in steady state, plus an election"""
+    entries = [{'term': 3, 'entry': {'key': f'key_{j}', 'value': j}, 'id': f'{j:032x}'} for j in range(8)]
+    packed = CompactLog(entries).packed(0, len(entries))
+    return {
+        'heartbeat': AppendEntriesMessage(type_=MessageType.Heartbeat, term=3, sender=nodes[0], receiver=None,
+                                          direction=MessageDirection.Request, leader_id=nodes[0], leader_commit=1200,
+                                          read_round=17),
+        'heartbeat ack': AppendEntriesMessage(type_=MessageType.Heartbeat, term=3, sender=nodes[1], receiver=nodes[0],
+                                              direction=MessageDirection.Response, leader_id=nodes[0], leader_commit=1200,
+                                              read_round=17, results=AppendEntriesResults(term=3, success=True)),
+        'append 8': AppendEntriesMessage(type_=MessageType.AppendEntries, term=3, sender=nodes[0], receiver=nodes[1],
+                                         direction=MessageDirection.Request, leader_id=nodes[0], prev_log_index=1200,
+                                         prev_log_term=3, entries=entries, leader_commit=1200),
+        'append 8 packed': AppendEntriesMessage(type_=MessageType.AppendEntries, term=3, sender=nodes[0], receiver=nodes[1],
+                                                direction=MessageDirection.Request, leader_id=nodes[0], prev_log_index=1200,
+                                                prev_log_term=3, entries=packed, leader_commit=1200),
+        'acknowledge': AppendEntriesMessage(type_=MessageType.Acknowledge, term=3, sender=nodes[1], receiver=nodes[0],
+                                            direction=MessageDirection.Response, leader_id=nodes[0], prev_log_index=1200,
+                                            prev_log_term=3, leader_commit=1200,
+                                            results=AppendEntriesResults(term=3, success=True, match_index=1208)),
+        'request vote': RequestVotesMessage(type_=MessageType.RequestVotes, term=4, sender=nodes[2], receiver=None,
+                                            direction=MessageDirection.Request, candidate_id=nodes[2],
+                                            last_log_index=1208, last_log_term=3),
+        'vote': RequestVotesMessage(type_=MessageType.RequestVotes, term=4, sender=nodes[1], receiver=nodes[2],
+                                    direction=MessageDirection.Response, candidate_id=nodes[2], last_log_index=1208,
+                                    last_log_term=3, results=RequestVotesResults(term=4, vote_granted=True)),
+    }
+
+
+def time_per_call(function, argument):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter() - start) / iterations
+
+
+def objects_per_parse(codec, frame):
+    """Memory blocks still allocated per frame decoded and parsed, with the parsed messages kept alive"""
+    count = 1000
+    before = sys.getallocatedblocks()
+    parsed = [parse_json_message(codec.decode(frame)) for _ in range(count)]
+    blocks = sys.getallocatedblocks() - before
+    del parsed
+    return blocks / count
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1):
+        iterations = int(sys.argv[1])
+    codecs = {'json': JsonCodec(), 'binary': BinaryCodec(nodes)}
+    print(f"{'message':<18}{'codec':<8}{'bytes':>8}{'encode us':>12}{'decode us':>12}{'parse us':>12}{'objects':>10}")
+    for name, message in make_messages().items():
+        msg = message.jsonify()
+        for codec_name, codec in codecs.items():
+            frame = codec.encode(msg)
+            encode = time_per_call(codec.encode, msg)
+            decode = time_per_call(codec.decode, frame)
+            parse = time_per_call(lambda frame: parse_json_message(codec.decode(frame)), frame)
+            print(f"{name:<18}{codec_name:<8}{len(frame):>8}{encode * 1e6:>12.2f}{decode * 1e6:>12.2f}{parse * 1e6:>12.2f}"
+                  f"{objects_per_parse(codec, frame):>10.1f}")
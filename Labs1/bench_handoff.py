@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+from raft.interface import Listener, Talker, InProcessListener, InProcessTalker
+import resource
+import sys
+import time
+
+start_port = 7200
+round_trips = 2000
+deadline = 30.0
+
+
+def make_message(sender, receiver, i):
+    """Roughly the size of an append entries carrying a small batch"""
+    entries = [{'term': 1, 'entry': {'key': f'key_{j}', 'value': j}, 'id': f'{i:016x}{j:016x}'} for j in range(8)]
+    return {'type': 4, 'term': 1, 'timestamp': 0, 'sender': sender, 'receiver': receiver, 'direction': 0,
+            'results': {}, 'leader_id': sender, 'prev_log_index': i, 'prev_log_term': 1, 'entries': entries,
+            'leader_commit': i, 'read_round': None, 'group': None}
+
+
+def cpu_time():
+    """User + system time of this process and of every child that has been joined"""
+    total = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(in_process):
+    """Two endpoints bounce a message back and forth round_trips times, returns one way latencies and cpu per message"""
+    ids = [f'127.0.0.1:{start_port}', f'127.0.0.1:{start_port + 1}']
+    if (in_process):
+        talkers = [InProcessTalker(identity={'my_id': a}) for a in ids]
+        listeners = [InProcessListener(port_list=ids, identity={'my_id': a}) for a in ids]
+    else:
+        talkers = [Talker(identity={'my_id': a}) for a in ids]
+        listeners = [Listener(port_list=ids, identity={'my_id': a}) for a in ids]
+    for p in talkers + listeners:
+        p.start()
+    for t in talkers:
+        t.wait_until_ready()
+    time.sleep(listeners[0].initial_backoff)
+
+    cpu_start = cpu_time()
+    start = time.time()
+    latencies = []
+    for i in range(round_trips):
+        if (time.time() - start > deadline):
+            break
+        sent = time.perf_counter()
+        talkers[0].send_message(make_message(ids[0], ids[1], i))
+        msg = listeners[1].get_message(1.0)
+        if (msg is None):
+            continue
+        talkers[1].send_message(make_message(ids[1], ids[0], i))
+        if (listeners[0].get_message(1.0) is None):
+            continue
+        latencies.append((time.perf_counter() - sent) / 2)
+
+    for p in talkers + listeners:
+        p.stop()
+    if (not in_process):
+        for p in talkers + listeners:
+            p.join()
+    cpu = cpu_time() - cpu_start
+    return sorted(latencies), cpu / max(1, 2 * len(latencies))
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1):
+        round_trips = int(sys.argv[1])
+    print(f"{'mode':<12}{'p50 us':>10}{'p99 us':>10}{'max us':>10}{'cpu us/msg':>12}{'delivered':>14}")
+    for in_process in [False, True]:
+        latencies, cpu = run(in_process)
+        if (not latencies):
+            print(f"{'in process' if in_process else 'processes':<12}{'nothing delivered':>54}")
+            continue
+        print(f"{'in process' if in_process else 'processes':<12}{percentile(latencies, 0.5) * 1e6:>10.0f}"
+              f"{percentile(latencies, 0.99) * 1e6:>10.0f}{latencies[-1] * 1e6:>10.0f}{cpu * 1e6:>12.0f}"
+              f"{len(latencies):>8}/{round_trips}")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from raft.log import CompactLog
+import time
+import tracemalloc
+
+num_entries = 100000
+batch_size = 64
+
+
+def make_entries():
+    return [{'term': 1 + i // 10000, 'entry': {'key': f'key_{i % 100}', 'value': i}, 'id': f'{i:032x}'} for i in range(num_entries)]
+
+
+def bench_memory(make_log, entries):
+    """Bytes allocated to hold the log, not counting the entries passed in"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    log = make_log()
+    for entry in entries:
+        # A follower gets its entries from freshly parsed messages, so the list can't share them
+        log.append({'term': entry['term'], 'entry': dict(entry['entry']), 'id': entry['id']})
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, log
+
+
+def bench_append(make_log, entries):
+    """Batched appends, the way _append_entries extends the log"""
+    log = make_log()
+    start = time.time()
+    for i in range(0, len(entries), batch_size):
+        log.extend(entries[i:i + batch_size])
+    return len(entries) / (time.time() - start)
+
+
+def bench_truncate(make_log, entries):
+    """Cut a batch off the end of the log, the way a follower drops conflicting entries. Only the cut is timed,
+    the batch is put back between cuts. A list is cut the way the log was before CompactLog, by copying the
+    prefix with self.log = self.log[:prev_index+1], a CompactLog with truncate"""
+    log = make_log()
+    log.extend(entries)
+    batch = entries[:batch_size]
+    elapsed = 0.0
+    for _ in range(1000):
+        position = len(log) - batch_size
+        if isinstance(log, CompactLog):
+            start = time.perf_counter()
+            log.truncate(position)
+            elapsed += time.perf_counter() - start
+        else:
+            start = time.perf_counter()
+            log = log[:position]
+            elapsed += time.perf_counter() - start
+        log.extend(batch)
+    return 1000 / elapsed
+
+
+def bench_term_lookup(log):
+    """Term lookups, the way _verify_entry and the conflict hints read the log"""
+    start = time.time()
+    if isinstance(log, CompactLog):
+        for i in range(len(log)):
+            log.term(i)
+    else:
+        for i in range(len(log)):
+            log[i]['term']
+    return len(log) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    entries = make_entries()
+    print(f"{'log':<14}{'bytes/entry':>14}{'appends/sec':>14}{'truncates/sec':>16}{'terms/sec':>14}")
+    for name, make_log in [('list', list), ('CompactLog', CompactLog)]:
+        used, log = bench_memory(make_log, entries)
+        append_rate = bench_append(make_log, entries)
+        truncate_rate = bench_truncate(make_log, entries)
+        term_rate = bench_term_lookup(log)
+        print(f"{name:<14}{used / num_entries:>14.0f}{append_rate:>14.0f}{truncate_rate:>16.0f}{term_rate:>14.0f}")
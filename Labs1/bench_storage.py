@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+from storage import KVStorage
+import os
+import time
+import threading
+
+bench_db = 'bench_storage.db'
+num_entries = 2000
+batch_size = 64
+read_duration = 3.0
+
+
+def cleanup_db_files():
+    """Remove the benchmark database and its WAL files"""
+    for suffix in ['', '-wal', '-shm', '-journal']:
+        if os.path.exists(bench_db + suffix):
+            os.remove(bench_db + suffix)
+
+
+def make_entries():
+    return [(i, 1, {'key': f'key_{i % 100}', 'value': i}) for i in range(1, num_entries + 1)]
+
+
+def bench_per_entry(storage):
+    """One transaction per entry, the way _commit_entry used to write"""
+    for index, term, data in make_entries():
+        storage.commit_log(index, term, data)
+
+
+def bench_batched(storage):
+    """One transaction per batch_size entries"""
+    entries = make_entries()
+    for i in range(0, len(entries), batch_size):
+        storage.commit_logs(entries[i:i + batch_size])
+
+
+def bench_group_commit(storage):
+    """Per entry calls, coalesced by the background group commit thread"""
+    for index, term, data in make_entries():
+        storage.commit_log(index, term, data)
+    storage.flush()
+
+
+def run(name, bench, journal_mode, synchronous, group_commit=False):
+    cleanup_db_files()
+    storage = KVStorage(bench_db, journal_mode=journal_mode, synchronous=synchronous, group_commit=group_commit)
+    start = time.time()
+    bench(storage)
+    elapsed = time.time() - start
+    storage.close()
+    print(f"{name:<14}{journal_mode:<10}{synchronous:<10}{num_entries / elapsed:>12.0f} entries/sec")
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run_read_latency(concurrent_reads, with_writer):
+    """Read latency percentiles, optionally while a writer commits one fsync'd entry at a time"""
+    cleanup_db_files()
+    storage = KVStorage(bench_db, synchronous='FULL', concurrent_reads=concurrent_reads)
+    storage.commit_logs(make_entries())
+
+    stop = threading.Event()
+    def writer():
+        index = num_entries
+        while not stop.is_set():
+            index += 1
+            storage.commit_log(index, 1, {'key': f'key_{index % 100}', 'value': index})
+    writer_thread = threading.Thread(target=writer)
+    if with_writer:
+        writer_thread.start()
+
+    samples = []
+    end = time.time() + read_duration
+    while time.time() < end:
+        start = time.perf_counter()
+        storage.get_value(f'key_{len(samples) % 100}')
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    stop.set()
+    if with_writer:
+        writer_thread.join()
+    storage.close()
+
+    samples.sort()
+    name = 'reader pool' if concurrent_reads else 'shared lock'
+    load = 'writing' if with_writer else 'idle'
+    print(f"{name:<14}{load:<10}{percentile(samples, 0.5):>10.0f}{percentile(samples, 0.99):>10.0f}{percentile(samples, 0.999):>10.0f}")
+
+
+if __name__ == '__main__':
+    print(f"{'mode':<14}{'journal':<10}{'sync':<10}{'throughput':>12}")
+    try:
+        for journal_mode in ['DELETE', 'WAL']:
+            for synchronous in ['OFF', 'NORMAL', 'FULL']:
+                run('per-entry', bench_per_entry, journal_mode, synchronous)
+                run('batched', bench_batched, journal_mode, synchronous)
+                run('group-commit', bench_group_commit, journal_mode, synchronous, group_commit=True)
+
+        print(f"\n{'reads':<14}{'writer':<10}{'p50 us':>10}{'p99 us':>10}{'p99.9 us':>10}")
+        for concurrent_reads in [False, True]:
+            for with_writer in [False, True]:
+                run_read_latency(concurrent_reads, with_writer)
+    finally:
+        cleanup_db_files()
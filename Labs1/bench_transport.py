@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+from raft.interface import Listener, Talker
+import sys
+import time
+
+start_port = 7100
+messages_per_node = 500
+cluster_sizes = [3, 5, 7]
+deadline = 30.0
+
+
+def make_message(sender, receiver, i):
+    """Roughly the size of an append entries carrying a small batch"""
+    entries = [{'term': 1, 'entry': {'key': f'key_{j}', 'value': j}, 'id': f'{i:016x}{j:016x}'} for j in range(8)]
+    return {'type': 4, 'term': 1, 'timestamp': 0, 'sender': sender, 'receiver': receiver, 'direction': 0,
+            'results': {}, 'leader_id': sender, 'prev_log_index': i, 'prev_log_term': 1, 'entries': entries,
+            'leader_commit': i, 'read_round': None, 'group': None}
+
+
+def run(num_nodes, directed):
+    """Every node sends messages_per_node messages round robin to its peers, returns delivered messages/sec"""
+    ids = [f'127.0.0.1:{start_port + i}' for i in range(num_nodes)]
+    talkers = [Talker(identity={'my_id': a}, directed=directed) for a in ids]
+    listeners = [Listener(port_list=ids, identity={'my_id': a}, directed=directed) for a in ids]
+    for p in talkers + listeners:
+        p.start()
+    for t in talkers:
+        t.wait_until_ready()
+    time.sleep(listeners[0].initial_backoff)
+
+    expected = num_nodes * messages_per_node
+    start = time.time()
+    for i in range(messages_per_node):
+        for n, sender in enumerate(ids):
+            receiver = ids[(n + 1 + i % (num_nodes - 1)) % num_nodes]
+            talkers[n].send_message(make_message(sender, receiver, i))
+
+    received = 0
+    while (received < expected) and (time.time() - start < deadline):
+        for listener in listeners:
+            while listener.get_message(0.001) is not None:
+                received += 1
+    elapsed = time.time() - start
+
+    for p in talkers + listeners:
+        p.stop()
+    for p in talkers + listeners:
+        p.join()
+    return received / elapsed, received, expected
+
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or cluster_sizes
+    print(f"{'nodes':<8}{'mode':<12}{'msgs/sec':>12}{'delivered':>14}")
+    for num_nodes in sizes:
+        for directed in [False, True]:
+            rate, received, expected = run(num_nodes, directed)
+            print(f"{num_nodes:<8}{'directed' if directed else 'broadcast':<12}{rate:>12.0f}{received:>8}/{expected}")
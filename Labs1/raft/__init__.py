@@ -1 +1,2 @@
-from .raft import RaftNode
\ No newline at end of file
+from .raft import RaftNode
+from .multi import MultiRaftHost
@@ -0,0 +1,258 @@
+import json
+import zlib
+import struct
+
+from .log import PackedEntries, pack_entry
+from .protocol import MessageType
+
+# First byte of every binary frame. A json frame always starts with '{', so a binary node can still read json
+binary_magic = 0xb1
+
+# Type of a frame holding several messages for the same receiver, see MultiRaftHost
+batch_type = 0xff
+
+# Node index meaning the address isn't interned and follows in the frame as a string
+inline_node = 0xffff
+
+# Receiver of a batch meaning it's a broadcast
+no_node = 0xfffe
+
+# magic, type, direction, node table fingerprint, bitmask of the fields present
+header = struct.Struct('<BBBHI')
+length = struct.Struct('<I')
+entry_header = struct.Struct('<qI')                                         # term, payload length
+
+# Fields of each message type as (key, results key, kind), in the order they're packed. Kinds:
+#   q: int, ?: bool, n: node address, j: any json value, s: str, e: list of log entries
+base_fields = [('term', None, 'q'), ('timestamp', None, 'q'), ('sender', None, 'n'), ('receiver', None, 'n'), ('group', None, 'j')]
+vote_results = [('results', 'term', 'q'), ('results', 'vote_granted', '?')]
+append_results = [('results', 'term', 'q'), ('results', 'success', '?'), ('results', 'match_index', 'q'),
+    ('results', 'conflict_term', 'q'), ('results', 'conflict_index', 'q')]
+request_votes_fields = base_fields + vote_results + [('candidate_id', None, 'n'), ('last_log_index', None, 'q'), ('last_log_term', None, 'q')]
+append_entries_fields = base_fields + append_results + [('leader_id', None, 'n'), ('prev_log_index', None, 'q'), ('prev_log_term', None, 'q'),
+    ('entries', None, 'e'), ('leader_commit', None, 'q'), ('read_round', None, 'q')]
+install_snapshot_fields = base_fields + append_results + [('leader_id', None, 'n'), ('last_included_index', None, 'q'),
+    ('last_included_term', None, 'q'), ('offset', None, 'q'), ('data', None, 's'), ('done', None, '?')]
+
+class NodeTableMismatch(ValueError):
+    '''
+        NodeTableMismatch: Raised by BinaryCodec.decode for a frame from a 
+            codec with a different node table, its node indexes can't be 
+            trusted.
+    '''
+    pass
+
+def get_fields(type_):
+    ''' Return the fields packed for a message type, matching the class parse_json_message picks. '''
+    if (type_ == MessageType.RequestVotes):
+        return request_votes_fields
+    elif (type_ == MessageType.InstallSnapshot):
+        return install_snapshot_fields
+    return append_entries_fields
+
+# (struct of the fixed width fields, fields present) for each (type, bitmask), shared by every codec
+plans = {}
+
+def get_plan(type_, mask):
+    plan = plans.get((type_, mask))
+    if (plan is None):
+        present = [field for bit, field in enumerate(get_fields(type_)) if ((mask >> bit) & 1)]
+        fixed = struct.Struct('<' + ''.join(kind for _, _, kind in present if (kind in 'q?n')).replace('n', 'H'))
+        plan = plans[(type_, mask)] = (fixed, present)
+    return plan
+
+# (message dict, results dict) with every field set to None for each type
+templates = {}
+
+def get_template(type_):
+    template = templates.get(type_)
+    if (template is None):
+        fields = get_fields(type_)
+        template = templates[type_] = (dict.fromkeys(key for key, result_key, _ in fields if (result_key is None)),
+            dict.fromkeys(result_key for _, result_key, _ in fields if (result_key is not None)))
+    return template
+
+def get_codec(codec, nodes):
+    '''
+        get_codec: Resolves the codec argument of RaftNode and MultiRaftHost.
+        Inputs:
+            codec: (str, codec or None)
+                'json' or None for JsonCodec, 'binary' for a BinaryCodec over
+                nodes, or a codec to use as is.
+            nodes: (list of str)
+                Addresses of the nodes in the cluster.
+    '''
+    if ((codec is None) or (codec == 'json')):
+        return JsonCodec()
+    elif (codec == 'binary'):
+        return BinaryCodec(sorted(nodes))
+    return codec
+
+class JsonCodec(object):
+    '''
+        JsonCodec: Sends messages as the json of their jsonify dict.
+    '''
+    def encode(self, msg):
+        return json.dumps(msg, default=list).encode()                       # PackedEntries go as the list of entries they hold.
+
+    def encode_batch(self, receiver, frames):
+        ''' Return one frame holding several encoded messages for receiver. '''
+        return b'{"receiver": ' + json.dumps(receiver).encode() + b', "batch": [' + b', '.join(frames) + b']}'
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+class BinaryCodec(object):
+    '''
+        BinaryCodec: Sends messages in a compact binary format. A fixed
+            header holds the type, direction and a bitmask of the fields
+            that aren't None, followed by the int, bool and node fields
+            packed at fixed width and then the variable length ones.
+            Addresses in the node table are sent as their 2 byte index,
+            others as strings. Log entries are sent as their term and a
+            length prefixed payload, the same one CompactLog stores, and are
+            decoded into a PackedEntries so they're only parsed if read. Every
+            node in the cluster needs a codec with the same node table,
+            frames from a codec with a different one are rejected. json
+            frames are decoded too, so a cluster can be switched over one
+            node at a time.
+        Inputs:
+            nodes: (list of str)
+                Addresses of the nodes, in the same order on every node.
+    '''
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self._index = {address: i for i, address in enumerate(self.nodes)}
+        self.fingerprint = zlib.crc32('\n'.join(self.nodes).encode()) & 0xffff
+
+    def encode(self, msg):
+        if ('batch' in msg):
+            return self._encode_batch(msg)
+        type_ = msg['type']
+        results = msg.get('results') or {}
+        mask = 0
+        fixed = []
+        tail = []
+        for bit, (key, result_key, kind) in enumerate(get_fields(type_)):
+            value = msg.get(key) if (result_key is None) else results.get(result_key)
+            if (value is None):
+                continue
+            mask |= 1 << bit
+            if (kind == 'n'):
+                fixed.append(self._pack_node(value, tail))
+            elif (kind == 'e'):
+                tail.append(self._pack_entries(value))
+            elif (kind == 's'):
+                tail.append(self._pack_bytes(value.encode()))
+            elif (kind == 'j'):
+                tail.append(self._pack_bytes(json.dumps(value).encode()))
+            else:
+                fixed.append(value)
+        return header.pack(binary_magic, type_, msg['direction'], self.fingerprint, mask) + get_plan(type_, mask)[0].pack(*fixed) + b''.join(tail)
+
+    def decode(self, frame):
+        if (frame[0] != binary_magic):
+            return json.loads(frame)
+        _, type_, direction, fingerprint, mask = header.unpack_from(frame)
+        if (fingerprint != self.fingerprint):
+            raise NodeTableMismatch('frame was encoded with node table ' + format(fingerprint, '04x') + ', this node has ' + format(self.fingerprint, '04x'))
+        if (type_ == batch_type):
+            return self._decode_batch(frame, mask)
+
+        # Start from every field set to None and only visit the ones present
+        fixed_struct, present = get_plan(type_, mask)
+        fixed = iter(fixed_struct.unpack_from(frame, header.size))
+        offset = header.size + fixed_struct.size
+        template, results_template = get_template(type_)
+        msg = template.copy()
+        msg['type'] = type_
+        msg['direction'] = direction
+        results = msg['results'] = results_template.copy()
+        for key, result_key, kind in present:
+            if (kind == 'n'):
+                value, offset = self._unpack_node(next(fixed), frame, offset)
+            elif (kind == 'e'):
+                value, offset = self._unpack_entries(frame, offset)
+            elif (kind == 's'):
+                value, offset = self._unpack_bytes(frame, offset)
+                value = value.decode()
+            elif (kind == 'j'):
+                value, offset = self._unpack_bytes(frame, offset)
+                value = json.loads(value)
+            else:
+                value = next(fixed)
+            if (result_key is None):
+                msg[key] = value
+            else:
+                results[result_key] = value
+        return msg
+
+    def encode_batch(self, receiver, frames):
+        ''' Return one frame holding several encoded messages for receiver. '''
+        # The count goes where the bitmask would be, then the receiver and each length prefixed message
+        tail = []
+        receiver = no_node if (receiver is None) else self._pack_node(receiver, tail)
+        parts = [header.pack(binary_magic, batch_type, 0, self.fingerprint, len(frames)), length.pack(receiver)] + tail
+        parts.extend(self._pack_bytes(frame) for frame in frames)
+        return b''.join(parts)
+
+    def _encode_batch(self, msg):
+        return self.encode_batch(msg['receiver'], [self.encode(message) for message in msg['batch']])
+
+    def _decode_batch(self, frame, count):
+        receiver = length.unpack_from(frame, header.size)[0]
+        offset = header.size + length.size
+        if (receiver == no_node):
+            receiver = None
+        else:
+            receiver, offset = self._unpack_node(receiver, frame, offset)
+        batch = []
+        for _ in range(count):
+            message, offset = self._unpack_bytes(frame, offset)
+            batch.append(self.decode(message))
+        return {'receiver': receiver, 'batch': batch}
+
+    def _pack_node(self, address, tail):
+        index = self._index.get(address)
+        if (index is None):
+            tail.append(self._pack_bytes(address.encode()))
+            return inline_node
+        return index
+
+    def _unpack_node(self, index, frame, offset):
+        if (index == inline_node):
+            address, offset = self._unpack_bytes(frame, offset)
+            return address.decode(), offset
+        return self.nodes[index], offset
+
+    def _pack_bytes(self, data):
+        return length.pack(len(data)) + data
+
+    def _unpack_bytes(self, frame, offset):
+        end = offset + length.size + length.unpack_from(frame, offset)[0]
+        return bytes(frame[offset + length.size:end]), end
+
+    def _pack_entries(self, entries):
+        parts = [length.pack(len(entries))]
+        if (isinstance(entries, PackedEntries)):
+            for term, payload in zip(entries.terms, entries.payloads):
+                parts.append(entry_header.pack(term, len(payload)))
+                parts.append(payload)
+            return b''.join(parts)
+        for entry in entries:
+            payload = pack_entry(entry)
+            parts.append(entry_header.pack(entry['term'], len(payload)))
+            parts.append(payload)
+        return b''.join(parts)
+
+    def _unpack_entries(self, frame, offset):
+        terms = []
+        payloads = []
+        offset += length.size
+        for _ in range(length.unpack_from(frame, offset - length.size)[0]):
+            term, size = entry_header.unpack_from(frame, offset)
+            offset += entry_header.size
+            terms.append(term)
+            payloads.append(bytes(frame[offset:offset + size]))
+            offset += size
+        return PackedEntries(terms, payloads), offset
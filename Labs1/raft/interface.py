@@ -1,20 +1,82 @@
+import os
 import zmq
 import time
+import struct
+import threading
 import multiprocessing
-from queue import Empty
+from queue import Queue, Empty
+from collections import deque
 
 from .protocol import MessageType
+from .codec import JsonCodec, NodeTableMismatch
+
+# In directed mode every message is published under a topic, and each Listener only subscribes to its own and the broadcast one
+broadcast_topic = b'* '
+
+def get_topic(receiver):
+	# The trailing space stops one address from prefix matching another, e.g. :556 and :5567
+	return broadcast_topic if (receiver is None) else receiver.encode() + b' '
+
+def subscribe(sub_sock, my_id, directed):
+	if (directed):
+		sub_sock.setsockopt(zmq.SUBSCRIBE, get_topic(my_id))
+		sub_sock.setsockopt(zmq.SUBSCRIBE, broadcast_topic)
+	else:
+		sub_sock.setsockopt(zmq.SUBSCRIBE, b'')
+
+def send_frame(pub_socket, msg, directed, codec):
+	send_encoded(pub_socket, msg['receiver'], codec.encode(msg), directed)
+
+def send_encoded(pub_socket, receiver, frame, directed):
+	if (directed):
+		pub_socket.send_multipart([get_topic(receiver), frame])
+	else:
+		pub_socket.send(frame)
+
+# Frames dropped because they came from a node with a different node table, see recv_frame
+mismatched_frames = 0
+
+def recv_frame(sub_sock, my_id, directed, codec):
+	# Returns the messages in the frame, unpacking batches. Nothing for broadcast mode frames meant for someone else, or frames that can't be decoded
+	global mismatched_frames
+	try:
+		if (directed):
+			msg = codec.decode(sub_sock.recv_multipart(zmq.NOBLOCK)[1])
+		else:
+			msg = codec.decode(sub_sock.recv(zmq.NOBLOCK))
+		receiver = msg['receiver']
+	except NodeTableMismatch as e:
+		# A misconfigured node keeps sending, so only report every 1000th
+		mismatched_frames += 1
+		if (mismatched_frames % 1000 == 1):
+			print(my_id + ': dropped ' + str(mismatched_frames) + ' frame(s) so far, ' + str(e))
+		return []
+	except (ValueError, struct.error, IndexError, KeyError):
+		return []
+	if ((receiver == my_id) or (receiver is None)):
+		return msg.get('batch', [msg])
+	return []
 
 class Talker(multiprocessing.Process):
-	def __init__(self, identity):
+	def __init__(self, identity, directed=False, codec=None):
 		super(Talker, self).__init__()
 
 		# Port to talk from
 		self.address = identity['my_id']
 
+		# If True, messages are published under their receiver's topic so they only reach that node. Every node has to agree
+		self.directed = directed
+
+		# Turns messages into frames and back, every node has to agree. See raft.codec
+		self.codec = codec if (codec is not None) else JsonCodec()
+
 		# Backoff amounts
 		self.initial_backoff = 1.0
-		self.operation_backoff = 0.0001
+		self.operation_backoff = 0.1		# How long to block waiting for outgoing messages before checking for a stop
+
+		# Coalescing, messages queued for the same receiver are sent as one frame
+		self.max_frame_bytes = 65536		# Stop collecting messages once this many encoded bytes are waiting to be sent.
+		self.max_frame_delay = 0.0			# How long to wait for more messages after the first one. 0 only takes what's already queued.
 
 		# Place to store outgoing messages
 		self.messages = multiprocessing.Queue()
@@ -45,18 +107,43 @@ class Talker(multiprocessing.Process):
 
 		while not self._stop_event.is_set():
 			try:
-				pub_socket.send_json(self.messages.get_nowait())
+				self._send_coalesced(pub_socket, self.messages.get(timeout=self.operation_backoff))
 			except Empty:
-				try:
-					time.sleep(self.operation_backoff)
-				except KeyboardInterrupt:
-					break
+				pass
 			except KeyboardInterrupt:
 				break
 		
 		pub_socket.unbind("tcp://%s" % self.address)
 		pub_socket.close()
 
+	def _send_coalesced(self, pub_socket, msg):
+		'''
+			_send_coalesced: Encodes msg and whatever else is queued (or 
+				arrives within max_frame_delay), up to max_frame_bytes, then 
+				sends one frame per receiver in the order they first appeared.
+				Messages to each receiver keep their order.
+		'''
+		frames = {}
+		frames_bytes = 0
+		deadline = time.time() + self.max_frame_delay
+		while True:
+			# Batches that were already put together (see MultiRaftHost) are merged into the rest
+			for message in msg.get('batch', [msg]):
+				frame = self.codec.encode(message)
+				frames.setdefault(message['receiver'], []).append(frame)
+				frames_bytes += len(frame)
+			if (frames_bytes >= self.max_frame_bytes):
+				break
+			try:
+				remaining = deadline - time.time()
+				msg = self.messages.get(timeout=remaining) if (remaining > 0) else self.messages.get_nowait()
+			except Empty:
+				break
+
+		for receiver, batch in frames.items():
+			frame = batch[0] if (len(batch) == 1) else self.codec.encode_batch(receiver, batch)
+			send_encoded(pub_socket, receiver, frame, self.directed)
+
 	def send_message(self, msg):
 		self.messages.put(msg)
 	
@@ -66,19 +153,26 @@ class Talker(multiprocessing.Process):
 		return True
 
 class Listener(multiprocessing.Process):
-	def __init__(self, port_list, identity):
+	def __init__(self, port_list, identity, directed=False, codec=None):
 		super(Listener, self).__init__()
 
 		# List of ports to subscribe to
 		self.address_list = port_list
 		self.identity = identity
 
+		# If True, only subscribe to messages for you and broadcasts, see Talker
+		self.directed = directed
+		self.codec = codec if (codec is not None) else JsonCodec()
+
 		# Backoff amounts
 		self.initial_backoff = 1.0
 
 		# Place to store incoming messages
 		self.messages = multiprocessing.Queue()
 
+		# Addresses to subscribe to or unsubscribe from, as ('connect', address) or ('disconnect', address)
+		self._subscriptions = multiprocessing.Queue()
+
 		# Signals
 		self._stop_event = multiprocessing.Event()
 
@@ -89,7 +183,7 @@ class Listener(multiprocessing.Process):
 		# All of the zmq initialization has to be in the same function for some reason
 		context = zmq.Context()
 		sub_sock = context.socket(zmq.SUB)
-		sub_sock.setsockopt(zmq.SUBSCRIBE, b'')
+		subscribe(sub_sock, self.identity['my_id'], self.directed)
 		for a in self.address_list:
 			sub_sock.connect("tcp://%s" % a)
 
@@ -102,19 +196,177 @@ class Listener(multiprocessing.Process):
 
 		while not self._stop_event.is_set():
 			try:
+				self._update_subscriptions(sub_sock)
 				obj = dict(poller.poll(100))
 				if sub_sock in obj and obj[sub_sock] == zmq.POLLIN:
-					msg = sub_sock.recv_json()	
-					if ((msg['receiver'] == self.identity['my_id']) or (msg['receiver'] is None)):
+					for msg in recv_frame(sub_sock, self.identity['my_id'], self.directed, self.codec):
 						self.messages.put(msg)
 			except KeyboardInterrupt:
 				break
 		
 		sub_sock.close()
 	
-	def get_message(self):
-		# If there's nothing in the queue Queue.Empty will be thrown
+	def _update_subscriptions(self, sub_sock):
+		while True:
+			try:
+				action, address = self._subscriptions.get_nowait()
+			except Empty:
+				return
+			try:
+				if (action == 'connect'):
+					sub_sock.connect("tcp://%s" % address)
+				else:
+					sub_sock.disconnect("tcp://%s" % address)
+			except zmq.ZMQError:
+				pass
+
+	def connect(self, address):
+		# Start receiving messages from another node, takes effect within one poll
+		self._subscriptions.put(('connect', address))
+
+	def disconnect(self, address):
+		# Stop receiving messages from a node
+		self._subscriptions.put(('disconnect', address))
+
+	def get_message(self, timeout=0):
+		# Block for up to timeout seconds. If there's nothing in the queue Queue.Empty will be thrown
 		try:
+			if (timeout > 0):
+				return self.messages.get(timeout=timeout)
 			return self.messages.get_nowait()
 		except Empty:
-			return None
\ No newline at end of file
+			return None
+
+	def wake(self):
+		# Unblock anyone waiting in get_message, they'll get None back
+		self.messages.put(None)
+
+class InProcessTalker(object):
+	'''
+		InProcessTalker: Drop in replacement for Talker that doesn't start a
+			process. Messages are published straight from the thread that
+			sends them, instead of being pickled into a queue for the Talker
+			process to send.
+	'''
+	def __init__(self, identity, directed=False, codec=None):
+		# Port to talk from
+		self.address = identity['my_id']
+		self.directed = directed
+		self.codec = codec if (codec is not None) else JsonCodec()
+
+		# Backoff amounts
+		self.initial_backoff = 1.0
+
+		# Groups on a MultiRaftHost share a Talker, zmq sockets can't be used by two threads at once
+		self._lock = threading.Lock()
+		self._pub_socket = None
+
+	def start(self):
+		self._pub_socket = zmq.Context.instance().socket(zmq.PUB)
+		while True:
+			try:
+				self._pub_socket.bind("tcp://%s" % self.address)
+				break
+			except zmq.ZMQError:
+				time.sleep(0.1)
+
+	def stop(self):
+		with self._lock:
+			self._pub_socket.close(linger=0)
+
+	def send_message(self, msg):
+		with self._lock:
+			send_frame(self._pub_socket, msg, self.directed, self.codec)
+
+	def wait_until_ready(self):
+		return True
+
+class InProcessListener(object):
+	'''
+		InProcessListener: Drop in replacement for Listener that doesn't start
+			a process. get_message polls the socket and decodes the message 
+			in the calling thread, instead of a Listener process decoding it
+			and pickling it into a queue. wake writes to a pipe the poll also
+			waits on.
+	'''
+	def __init__(self, port_list, identity, directed=False, codec=None):
+		# List of ports to subscribe to
+		self.address_list = port_list
+		self.identity = identity
+		self.directed = directed
+		self.codec = codec if (codec is not None) else JsonCodec()
+
+		# Backoff amounts
+		self.initial_backoff = 1.0
+
+		# Addresses to subscribe to or unsubscribe from, applied by the thread reading the socket
+		self._subscriptions = Queue()
+
+		# Writing to the pipe wakes a blocked get_message
+		self._wake_read, self._wake_write = os.pipe()
+		os.set_blocking(self._wake_write, False)
+		self._sub_sock = None
+		self._poller = None
+
+		# Rest of the last batch received, handed out before reading the socket again
+		self._pending = deque()
+
+	def start(self):
+		self._sub_sock = zmq.Context.instance().socket(zmq.SUB)
+		subscribe(self._sub_sock, self.identity['my_id'], self.directed)
+		for a in self.address_list:
+			self._sub_sock.connect("tcp://%s" % a)
+		self._poller = zmq.Poller()
+		self._poller.register(self._sub_sock, zmq.POLLIN)
+		self._poller.register(self._wake_read, zmq.POLLIN)
+
+	def stop(self):
+		self._sub_sock.close(linger=0)
+		os.close(self._wake_read)
+		os.close(self._wake_write)
+
+	def connect(self, address):
+		self._subscriptions.put(('connect', address))
+
+	def disconnect(self, address):
+		self._subscriptions.put(('disconnect', address))
+
+	def get_message(self, timeout=0):
+		# Block for up to timeout seconds, returns None if nothing arrives or someone calls wake
+		while True:
+			try:
+				action, address = self._subscriptions.get_nowait()
+			except Empty:
+				break
+			try:
+				if (action == 'connect'):
+					self._sub_sock.connect("tcp://%s" % address)
+				else:
+					self._sub_sock.disconnect("tcp://%s" % address)
+			except zmq.ZMQError:
+				pass
+
+		if (self._pending):
+			return self._pending.popleft()
+
+		deadline = time.time() + timeout
+		while True:
+			events = dict(self._poller.poll(max(0, deadline - time.time()) * 1000))
+			if (self._wake_read in events):
+				os.read(self._wake_read, 4096)
+				return None
+			if (self._sub_sock not in events):
+				return None
+			try:
+				self._pending.extend(recv_frame(self._sub_sock, self.identity['my_id'], self.directed, self.codec))
+			except zmq.Again:
+				continue
+			if (self._pending):
+				return self._pending.popleft()
+
+	def wake(self):
+		# Unblock anyone waiting in get_message, they'll get None back. A full pipe means a wake is already pending
+		try:
+			os.write(self._wake_write, b'w')
+		except BlockingIOError:
+			pass
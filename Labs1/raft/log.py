@@ -0,0 +1,192 @@
+import json
+from array import array
+
+def pack_entry(entry):
+    '''
+        pack_entry: Serializes an entry's payload, its 'entry', 'id' and 
+            'session' if it has one. The term is kept separately.
+    '''
+    payload = [entry['entry'], entry['id']]
+    if (entry.get('session') is not None):
+        payload.append(entry['session'])
+    return json.dumps(payload).encode()
+
+# json.loads on bytes detects their encoding and builds a decoder on every call, entries are decoded often enough for that to show
+scan_payload = json.JSONDecoder().scan_once
+
+def unpack_entry(term, payload):
+    ''' Return the entry dict for a term and a payload from pack_entry. '''
+    payload = scan_payload(payload.decode(), 0)[0]
+
+    # Ids are used as dict keys, json turns tuples into lists
+    id_num = tuple(payload[1]) if isinstance(payload[1], list) else payload[1]
+    entry = {'term': term, 'entry': payload[0], 'id': id_num}
+    if (len(payload) > 2):
+        entry['session'] = payload[2]
+    return entry
+
+def check_payload(payload):
+    ''' Raise ValueError unless payload is one pack_entry could have made. '''
+    text = payload.decode()
+    try:
+        value, end = scan_payload(text, 0)
+    except StopIteration:
+        raise ValueError('entry payload is not json')
+    if ((end != len(text)) or (not isinstance(value, list)) or (len(value) not in (2, 3))):
+        raise ValueError('entry payload is not a packed entry')
+
+class PackedEntries(object):
+    '''
+        PackedEntries: A batch of entries still in their serialized form, as 
+            sliced out of a CompactLog or read off the wire by a BinaryCodec.
+            Looks like a list of entry dicts, but an entry's payload is only
+            decoded when it's read. Appending it to a CompactLog copies the
+            payloads without decoding them, so ones read off the wire should
+            be checked with validate first.
+        Inputs:
+            terms: (list of int)
+            payloads: (list of bytes)
+                Payloads from pack_entry.
+    '''
+    __slots__ = ('terms', 'payloads')
+
+    def __init__(self, terms, payloads):
+        self.terms = terms
+        self.payloads = payloads
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        for term, payload in zip(self.terms, self.payloads):
+            yield unpack_entry(term, payload)
+
+    def __getitem__(self, position):
+        if (isinstance(position, slice)):
+            return PackedEntries(self.terms[position], self.payloads[position])
+        return unpack_entry(self.terms[position], self.payloads[position])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def term(self, position):
+        ''' Return the term of an entry without decoding its payload. '''
+        return self.terms[position]
+
+    def validate(self):
+        ''' Raise ValueError if any payload couldn't be decoded. '''
+        for payload in self.payloads:
+            check_payload(payload)
+
+    def nbytes(self):
+        ''' Return the total size of the payloads. '''
+        return sum(len(payload) for payload in self.payloads)
+
+class CompactLog(object):
+    '''
+        CompactLog: The raft log, stored compactly. Terms are kept in an array
+            of 64 bit ints, and each entry's payload (its 'entry', 'id' and 
+            'session' if it has one) is serialized into one contiguous 
+            buffer, with an array of offsets marking where each one ends. 
+            Entries are decoded back into dicts when they're read. Looks like the
+            list of dicts it replaces: supports len, iteration, indexing,
+            slicing, append, extend, and deleting a suffix. Position 0 is the
+            entry at the snapshot index, as before.
+        Inputs:
+            entries: (list of dicts with the attributes 'term', 'entry' and 'id')
+                Entries to start with.
+    '''
+    def __init__(self, entries=()):
+        self._terms = array('q')
+        self._ends = array('q')                                             # Offset in _data where each entry's payload ends.
+        self._data = bytearray()
+        self.extend(entries)
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __iter__(self):
+        for position in range(len(self._terms)):
+            yield self._decode(position)
+
+    def __getitem__(self, position):
+        if (isinstance(position, slice)):
+            return [self._decode(p) for p in range(*position.indices(len(self._terms)))]
+        if (position < 0):
+            position += len(self._terms)
+        if ((position < 0) or (position >= len(self._terms))):
+            raise IndexError('log index out of range')
+        return self._decode(position)
+
+    def __delitem__(self, position):
+        # Only cutting off the end of the log is supported, it's the only way raft shortens a log
+        if ((not isinstance(position, slice)) or (position.stop is not None) or (position.step is not None)):
+            raise TypeError('only a suffix of the log can be deleted')
+        self.truncate(position.start or 0)
+
+    def append(self, entry):
+        self._data += pack_entry(entry)
+        self._terms.append(entry['term'])
+        self._ends.append(len(self._data))
+
+    def extend(self, entries):
+        if (isinstance(entries, PackedEntries)):
+            for payload in entries.payloads:
+                self._data += payload
+                self._ends.append(len(self._data))
+            self._terms.extend(entries.terms)
+            return
+        for entry in entries:
+            self.append(entry)
+
+    def term(self, position):
+        ''' Return the term of an entry without decoding its payload. '''
+        return self._terms[position]
+
+    def raw(self, position):
+        ''' Return the serialized payload of an entry. '''
+        start = self._ends[position - 1] if (position > 0) else 0
+        return bytes(self._data[start:self._ends[position]])
+
+    def packed(self, start, stop):
+        ''' Return the entries from start up to stop as a PackedEntries, without decoding them. '''
+        stop = min(stop, len(self._terms))
+        return PackedEntries(self._terms[start:stop].tolist(), [self.raw(position) for position in range(start, stop)])
+
+    def truncate(self, position):
+        '''
+            truncate: Drops every entry from position on. Only shrinks the
+                arrays and the buffer, nothing before position is copied.
+        '''
+        if (position >= len(self._terms)):
+            return
+        position = max(position, 0)
+        end = self._ends[position - 1] if (position > 0) else 0
+        del self._data[end:]
+        del self._terms[position:]
+        del self._ends[position:]
+
+    def compact(self, position, placeholder):
+        '''
+            compact: Drops every entry before position and replaces the one at
+                position with a placeholder, which becomes position 0. Copies
+                the entries that are kept, so it's done once per snapshot.
+            Inputs:
+                position: (int)
+                placeholder: (dict with the attributes 'term', 'entry' and 'id')
+        '''
+        kept = CompactLog([placeholder])
+        if (position + 1 < len(self._terms)):
+            start = self._ends[position]
+            kept._terms.extend(self._terms[position + 1:])
+            kept._data += self._data[start:]
+            shift = kept._ends[0] - start
+            kept._ends.extend(end + shift for end in self._ends[position + 1:])
+        self._terms, self._ends, self._data = kept._terms, kept._ends, kept._data
+
+    def nbytes(self):
+        ''' Return roughly how many bytes the log takes up. '''
+        return (self._terms.itemsize * len(self._terms)) + (self._ends.itemsize * len(self._ends)) + len(self._data)
+
+    def _decode(self, position):
+        return unpack_entry(self._terms[position], self.raw(position))
@@ -0,0 +1,287 @@
+import json
+import time
+import zlib
+import bisect
+import threading
+from queue import Queue, Empty
+
+from storage import CachedKVStorage
+from .raft import RaftNode
+from .codec import get_codec
+from .interface import Listener, Talker, InProcessListener, InProcessTalker
+from .protocol import MessageType
+
+class HashPartitioner(object):
+    '''
+        HashPartitioner: Spreads keys evenly over the groups by hashing them.
+            The hash is stable across processes, so every host routes a key
+            to the same group.
+    '''
+    def __init__(self, groups):
+        self.groups = list(groups)
+
+    def group_for(self, key):
+        return self.groups[zlib.crc32(json.dumps(key).encode()) % len(self.groups)]
+
+class RangePartitioner(object):
+    '''
+        RangePartitioner: Splits the keyspace into contiguous ranges, so keys
+            that sort together live in the same group.
+            RangePartitioner(['g0', 'g1', 'g2'], ['m', 't']) puts keys below
+            'm' in g0, keys from 'm' up to 't' in g1 and the rest in g2.
+    '''
+    def __init__(self, groups, boundaries):
+        if (len(boundaries) != len(groups) - 1):
+            raise ValueError('need one boundary fewer than groups')
+        self.groups = list(groups)
+        self.boundaries = list(boundaries)
+
+    def group_for(self, key):
+        return self.groups[bisect.bisect_right(self.boundaries, key)]
+
+class GroupListener(object):
+    '''
+        GroupListener: Stands in for a Listener for one raft group on a
+            MultiRaftHost. The host's dispatcher puts the group's messages
+            in its inbox.
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.initial_backoff = 0
+        self.messages = Queue()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_message(self, timeout=0):
+        try:
+            if (timeout > 0):
+                return self.messages.get(timeout=timeout)
+            return self.messages.get_nowait()
+        except Empty:
+            return None
+
+    def wake(self):
+        self.messages.put(None)
+
+    def connect(self, address):
+        self.host._connect(address)
+
+    def disconnect(self, address):
+        self.host._disconnect(address)
+
+class GroupTalker(object):
+    '''
+        GroupTalker: Stands in for a Talker for one raft group on a
+            MultiRaftHost. Stamps the group id in each message's header and
+            hands it to the host's shared Talker, heartbeats are coalesced
+            with those of the other groups.
+    '''
+    def __init__(self, host, group):
+        self.host = host
+        self.group = group
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def send_message(self, msg):
+        msg['group'] = self.group
+        if (msg['type'] == MessageType.Heartbeat):
+            self.host._queue_heartbeat(msg)
+        else:
+            self.host.talker.send_message(msg)
+
+class MultiRaftHost(object):
+    '''
+        MultiRaftHost: Runs many independent raft groups in one process. The
+            groups share a single Talker and Listener, a dispatcher thread
+            routes incoming messages to each group by the group id in their
+            header. Heartbeats (and their acknowledgements) headed to the same
+            host within coalesce_window are sent as a single frame. Each group
+            keeps its own KVStorage shard, and a partitioner picks the group
+            that owns each key. Every host in the address book runs every
+            group.
+        Inputs:
+            config: (dict or str)
+                Address book of the hosts, same format as for RaftNode.
+            name: (str)
+                Name of this host in the address book.
+            groups: (int or list)
+                Number of groups, or their ids.
+            partitioner:
+                Object with a group_for(key) method. Defaults to a
+                HashPartitioner over the groups.
+            storage_factory: (callable)
+                Called with a group id to create its KVStorage. Defaults to a
+                CachedKVStorage per group.
+            directed: (bool)
+                Use the directed transport, see Talker.
+            in_process: (bool)
+                Read and write the sockets from this process, see 
+                InProcessListener.
+            codec: (str or codec)
+                'json', 'binary' or a codec from raft.codec, every host has
+                to use the same one.
+    '''
+    def __init__(self, config, name, groups, partitioner=None, storage_factory=None, verbose=False, directed=False, in_process=False, codec=None):
+        self._name = name
+        self._terminate = False
+        self.coalesce_window = 0.002                                        # How long to hold a heartbeat for others headed to the same host.
+
+        if (isinstance(groups, int)):
+            groups = list(range(groups))
+        self.partitioner = partitioner if (partitioner is not None) else HashPartitioner(groups)
+        if (storage_factory is None):
+            storage_factory = lambda group: CachedKVStorage(f"raft_node_{name}_group_{group}.db")
+
+        # The shared interface
+        if (not isinstance(config, dict)):
+            with open(config, 'r') as infile:
+                config = json.load(infile)
+        all_ids = [config[a]['ip'] + ':' + config[a]['port'] for a in config if a != 'leader']
+        identity = {'my_id': config[name]['ip'] + ':' + config[name]['port'], 'my_name': name}
+        codec = get_codec(codec, all_ids)
+        if (in_process):
+            self.listener = InProcessListener(port_list=all_ids, identity=identity, directed=directed, codec=codec)
+            self.talker = InProcessTalker(identity=identity, directed=directed, codec=codec)
+        else:
+            self.listener = Listener(port_list=all_ids, identity=identity, directed=directed, codec=codec)
+            self.talker = Talker(identity=identity, directed=directed, codec=codec)
+        self._subscriptions = {address: len(groups) for address in all_ids} # Number of groups subscribed to each address, every group starts out subscribed to every host.
+        self._subscription_lock = threading.Lock()
+
+        # Heartbeats waiting to be coalesced, keyed by receiver
+        self._heartbeats = {}
+        self._heartbeat_lock = threading.Lock()
+        self._heartbeat_ready = threading.Event()
+
+        # The groups
+        self.nodes = {}
+        self._inboxes = {}
+        for group in groups:
+            listener = GroupListener(self)
+            self._inboxes[group] = listener.messages
+            self.nodes[group] = RaftNode(config, name, verbose=verbose, storage=storage_factory(group), interface=(listener, GroupTalker(self, group)))
+
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._flusher = threading.Thread(target=self._flush_heartbeats, daemon=True)
+
+    def start(self):
+        '''
+            start: Starts the shared interface, then every group.
+        '''
+        self.listener.start()
+        self.talker.start()
+        self._dispatcher.start()
+        self._flusher.start()
+        time.sleep(self.listener.initial_backoff)
+        for node in self.nodes.values():
+            node.start()
+
+    def stop(self):
+        '''
+            stop: Stops every group, then the shared interface.
+        '''
+        for node in self.nodes.values():
+            node.stop()
+        self._terminate = True
+        self._heartbeat_ready.set()
+        self._dispatcher.join()
+        self._flusher.join()
+        self.talker.stop()
+        self.listener.stop()
+
+    @property
+    def name(self):
+        ''' Return the name of the host. '''
+        return self._name
+
+    def group_for(self, key):
+        ''' Return the id of the group that owns a key. '''
+        return self.partitioner.group_for(key)
+
+    def node_for(self, key):
+        ''' Return this host's RaftNode for the group that owns a key. '''
+        return self.nodes[self.group_for(key)]
+
+    def client_request(self, value, id_num=None, timeout=None):
+        '''
+            client_request: Public function to enqueue a value in the group
+                that owns value['key']. See RaftNode.client_request.
+        '''
+        return self.node_for(value['key']).client_request(value, id_num, timeout)
+
+    def linearizable_read(self, key):
+        '''
+            linearizable_read: Public function to read a key from the group
+                that owns it. See RaftNode.linearizable_read.
+        '''
+        return self.node_for(key).linearizable_read(key)
+
+    def follower_read(self, key, max_lag=None, max_age=None):
+        '''
+            follower_read: Public function to read a key from this host's copy
+                of the group that owns it. See RaftNode.follower_read.
+        '''
+        return self.node_for(key).follower_read(key, max_lag, max_age)
+
+    def leaders(self):
+        ''' Return the ids of the groups this host leads. '''
+        return [group for group, node in self.nodes.items() if node.check_role() == 'leader']
+
+    def _dispatch(self):
+        '''
+            _dispatch: Routes messages from the shared Listener to the inbox
+                of the group in their header. The Listener has already 
+                unpacked coalesced frames.
+        '''
+        while (not self._terminate):
+            msg = self.listener.get_message(0.1)
+            if (msg is None):
+                continue
+            inbox = self._inboxes.get(msg.get('group'))
+            if (inbox is not None):
+                inbox.put(msg)
+
+    def _queue_heartbeat(self, msg):
+        with self._heartbeat_lock:
+            self._heartbeats.setdefault(msg['receiver'], []).append(msg)
+        self._heartbeat_ready.set()
+
+    def _flush_heartbeats(self):
+        '''
+            _flush_heartbeats: Waits for a heartbeat, gives the other groups
+                coalesce_window to add theirs, then sends one frame per
+                receiver.
+        '''
+        while (not self._terminate):
+            self._heartbeat_ready.wait()
+            time.sleep(self.coalesce_window)
+            with self._heartbeat_lock:
+                self._heartbeat_ready.clear()
+                heartbeats = self._heartbeats
+                self._heartbeats = {}
+            for receiver, messages in heartbeats.items():
+                if (len(messages) == 1):
+                    self.talker.send_message(messages[0])
+                else:
+                    self.talker.send_message({'receiver': receiver, 'batch': messages})
+
+    def _connect(self, address):
+        with self._subscription_lock:
+            self._subscriptions[address] = self._subscriptions.get(address, 0) + 1
+            if (self._subscriptions[address] == 1):
+                self.listener.connect(address)
+
+    def _disconnect(self, address):
+        with self._subscription_lock:
+            self._subscriptions[address] -= 1
+            if (self._subscriptions[address] == 0):
+                del self._subscriptions[address]
+                self.listener.disconnect(address)
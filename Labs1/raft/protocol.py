@@ -10,12 +10,15 @@ class MessageType(object):
 	AppendEntries = 4
 	Committal = 5
 	ClientRequest = 6
+	InstallSnapshot = 7
 
 class MessageDirection(object):
 	Request = 0
 	Response = 1	
 
 class RequestVotesResults(object): 
+	__slots__ = ('_term', '_vote_granted')
+
 	def __init__(self, term=None, vote_granted=None, message=None):
 		if (message is not None):
 			self.un_jsonify(message)
@@ -42,12 +45,17 @@ class RequestVotesResults(object):
 		}
 
 class AppendEntriesResults(object):
-	def __init__(self, term=None, success=None, message=None):
+	__slots__ = ('_term', '_success', '_match_index', '_conflict_term', '_conflict_index')
+
+	def __init__(self, term=None, success=None, match_index=None, conflict_term=None, conflict_index=None, message=None):
 		if (message is not None):
 			self.un_jsonify(message)
 		else:
 			self._term = term
 			self._success = success
+			self._match_index = match_index
+			self._conflict_term = conflict_term
+			self._conflict_index = conflict_index
 
 	@property
 	def term(self):
@@ -57,17 +65,41 @@ class AppendEntriesResults(object):
 	def success(self):
 		return self._success
 
+	@property
+	def match_index(self):
+		return self._match_index
+
+	@property
+	def conflict_term(self):
+		return self._conflict_term
+
+	@property
+	def conflict_index(self):
+		return self._conflict_index
+
 	def un_jsonify(self, message):
-		self._term = 	message['term']     
-		self._success =	message['success']     
+		self._term = 			message['term']     
+		self._success =			message['success']     
+		self._match_index =		message['match_index']
+		self._conflict_term =	message['conflict_term']
+		self._conflict_index =	message['conflict_index']
 
 	def jsonify(self):
 		return {
-			'term':      	self._term,
-			'success':      self._success
+			'term':      		self._term,
+			'success':      	self._success,
+			'match_index':		self._match_index,
+			'conflict_term':	self._conflict_term,
+			'conflict_index':	self._conflict_index
 		}
 
 class BaseMessage(object):
+	'''
+		BaseMessage: Messages are parsed for every frame received, heartbeats
+			included, so they're slotted and their results are only built
+			when they're read. Until then _results holds the results dict.
+	'''
+	__slots__ = ('_timestamp', '_type', '_term', '_sender', '_receiver', '_direction', '_results', '_group')
 
 	def __init__(self, type_, term, sender, receiver, direction, results):
 		self._timestamp = int(time.time())
@@ -77,6 +109,7 @@ class BaseMessage(object):
 		self._receiver = receiver
 		self._direction = direction
 		self._results = results
+		self._group = None
 
 	@property
 	def timestamp(self):
@@ -104,8 +137,15 @@ class BaseMessage(object):
 
 	@property
 	def results(self):
+		if (isinstance(self._results, dict)):
+			results_class = RequestVotesResults if (self._type == MessageType.RequestVotes) else AppendEntriesResults
+			self._results = results_class(message=self._results)
 		return self._results
 
+	@property
+	def group(self):
+		return self._group
+
 	def un_jsonify(self, message):
 		self._type = 			message['type']     
 		self._term = 			message['term']     
@@ -113,10 +153,8 @@ class BaseMessage(object):
 		self._sender = 			message['sender']
 		self._receiver = 		message['receiver'] 
 		self._direction = 		message['direction']
-		if (self._type == MessageType.RequestVotes):
-			self._results = RequestVotesResults(message=message['results'])
-		else:
-			self._results = AppendEntriesResults(message=message['results'])
+		self._group = 			message.get('group')
+		self._results = 		message['results']
 
 	def jsonify(self):
 		return {
@@ -126,10 +164,13 @@ class BaseMessage(object):
 			'sender':    	self._sender,
 			'receiver':  	self._receiver,
 			'direction': 	self._direction,
-			'results': 		self._results.jsonify()
+			'results': 		self._results if isinstance(self._results, dict) else self._results.jsonify(),
+			'group': 		self._group
 		}
 
 class RequestVotesMessage(BaseMessage):
+	__slots__ = ('_candidate_id', '_last_log_index', '_last_log_term')
+
 	def __init__(self, type_=None, term=None, sender=None, receiver=None, direction=None, results=None, candidate_id=None, last_log_index=None, last_log_term=None, message=None):
 		if (message is not None):
 			self.un_jsonify(message)
@@ -169,7 +210,15 @@ class RequestVotesMessage(BaseMessage):
 		return message
 
 class AppendEntriesMessage(BaseMessage):
-	def __init__(self, type_=None, term=None, sender=None, receiver=None, direction=None, results=None, leader_id=None, prev_log_index=None, prev_log_term=None, entries=None, leader_commit=None, message=None):
+	'''
+		AppendEntriesMessage: entries is a list of entry dicts, or a 
+			PackedEntries holding their serialized payloads when it came 
+			from the log or a BinaryCodec. Those are only decoded if 
+			they're read.
+	'''
+	__slots__ = ('_leader_id', '_prev_log_index', '_prev_log_term', '_entries', '_leader_commit', '_read_round')
+
+	def __init__(self, type_=None, term=None, sender=None, receiver=None, direction=None, results=None, leader_id=None, prev_log_index=None, prev_log_term=None, entries=None, leader_commit=None, read_round=None, message=None):
 		if (message is not None):
 			self.un_jsonify(message)
 		else:
@@ -181,6 +230,7 @@ class AppendEntriesMessage(BaseMessage):
 			self._prev_log_term = prev_log_term
 			self._entries = entries
 			self._leader_commit = leader_commit
+			self._read_round = read_round
 
 	@property
 	def leader_id(self):
@@ -202,6 +252,10 @@ class AppendEntriesMessage(BaseMessage):
 	def leader_commit(self):
 		return self._leader_commit
 
+	@property
+	def read_round(self):
+		return self._read_round
+
 	def un_jsonify(self, message):
 		BaseMessage.un_jsonify(self, message)
 		self._leader_id = 		message['leader_id']
@@ -209,6 +263,7 @@ class AppendEntriesMessage(BaseMessage):
 		self._prev_log_term = 	message['prev_log_term']
 		self._entries = 			message['entries']
 		self._leader_commit = 	message['leader_commit']
+		self._read_round = 		message['read_round']
 
 	def jsonify(self):
 		message = BaseMessage.jsonify(self)
@@ -217,7 +272,70 @@ class AppendEntriesMessage(BaseMessage):
 			'prev_log_index': 	self._prev_log_index,
 			'prev_log_term': 	self._prev_log_term,
 			'entries': 			self._entries,
-			'leader_commit': 	self._leader_commit
+			'leader_commit': 	self._leader_commit,
+			'read_round': 		self._read_round
+		})
+		return message
+
+class InstallSnapshotMessage(BaseMessage):
+	__slots__ = ('_leader_id', '_last_included_index', '_last_included_term', '_offset', '_data', '_done')
+
+	def __init__(self, type_=None, term=None, sender=None, receiver=None, direction=None, results=None, leader_id=None, last_included_index=None, last_included_term=None, offset=None, data=None, done=None, message=None):
+		if (message is not None):
+			self.un_jsonify(message)
+		else:
+			if (results is None):
+				results = AppendEntriesResults()
+			BaseMessage.__init__(self, type_, term, sender, receiver, direction, results)
+			self._leader_id = leader_id
+			self._last_included_index = last_included_index
+			self._last_included_term = last_included_term
+			self._offset = offset
+			self._data = data
+			self._done = done
+
+	@property
+	def leader_id(self):
+		return self._leader_id
+
+	@property
+	def last_included_index(self):
+		return self._last_included_index
+
+	@property
+	def last_included_term(self):
+		return self._last_included_term
+
+	@property
+	def offset(self):
+		return self._offset
+
+	@property
+	def data(self):
+		return self._data
+
+	@property
+	def done(self):
+		return self._done
+
+	def un_jsonify(self, message):
+		BaseMessage.un_jsonify(self, message)
+		self._leader_id = 				message['leader_id']
+		self._last_included_index = 	message['last_included_index']
+		self._last_included_term = 		message['last_included_term']
+		self._offset = 					message['offset']
+		self._data = 					message['data']
+		self._done = 					message['done']
+
+	def jsonify(self):
+		message = BaseMessage.jsonify(self)
+		message.update({
+			'leader_id': 				self._leader_id,
+			'last_included_index': 	self._last_included_index,
+			'last_included_term': 		self._last_included_term,
+			'offset': 					self._offset,
+			'data': 					self._data,
+			'done': 					self._done
 		})
 		return message
 
@@ -226,5 +344,7 @@ def parse_json_message(json_message):
 		return None
 	elif json_message['type'] == MessageType.RequestVotes:
 		return RequestVotesMessage(message=json_message)
+	elif json_message['type'] == MessageType.InstallSnapshot:
+		return InstallSnapshotMessage(message=json_message)
 	else:
 		return AppendEntriesMessage(message=json_message)
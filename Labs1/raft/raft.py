@@ -9,15 +9,21 @@ from past.utils import old_div
 
 import time
 import json
+import uuid
+import heapq
 import random
 import threading
 from queue import Queue, Empty
+from collections import deque, OrderedDict
+from concurrent.futures import Future, TimeoutError
 
-from storage import KVStorage
-from .interface import Listener, Talker
+from storage import CachedKVStorage
+from .log import CompactLog, PackedEntries
+from .codec import get_codec
+from .interface import Listener, Talker, InProcessListener, InProcessTalker
 from .protocol import MessageType, MessageDirection, RequestVotesResults, \
     AppendEntriesResults, RequestVotesMessage, AppendEntriesMessage, \
-    parse_json_message
+    InstallSnapshotMessage, parse_json_message
 
 # Adjust these to test
 address_book_fname = 'address_book.json'
@@ -25,8 +31,49 @@ total_nodes = 1
 local_ip = '127.0.0.1'
 start_port = 5557
 
+# Key the cluster's address book is stored under, membership changes are log entries that set it
+config_key = '_raft_config'
+
+# Prefix of the keys each client session's last applied request is stored under
+session_key_prefix = '_raft_session/'
+
+class LeadershipLost(Exception):
+    ''' 
+        LeadershipLost: Set on a client request's future when the node loses 
+            its leader (or its leadership) before the request commits. The 
+            request may or may not commit later, so it should be retried.
+    '''
+    pass
+
+class NotLeader(LeadershipLost):
+    ''' 
+        NotLeader: Set on a read's future when it was made on a node that 
+            isn't the leader. leader_id is who the node thinks the leader is,
+            if anyone, so the read can be redirected there.
+    '''
+    def __init__(self, message, leader_id=None):
+        super(NotLeader, self).__init__(message)
+        self.leader_id = leader_id
+
+class StaleRead(NotLeader):
+    ''' 
+        StaleRead: Set on a follower read's future when the follower is 
+            further behind the leader than the read allows. leader_id is who
+            the node thinks the leader is, if anyone, so the read can be 
+            redirected there.
+    '''
+    pass
+
+class SupersededRequest(Exception):
+    ''' 
+        SupersededRequest: Set on a client session request's future when the
+            leader has already appended that sequence, or a later one, of the 
+            session under another id. The request won't be applied.
+    '''
+    pass
+
 class RaftNode(threading.Thread):
-    def __init__(self, config, name, role='follower', verbose=True):
+    def __init__(self, config, name, role='follower', verbose=True, storage=None, interface=None, directed=False, in_process=False, codec=None):
         threading.Thread.__init__(self) 
         
         self._terminate = False
@@ -37,31 +84,65 @@ class RaftNode(threading.Thread):
         # Where incoming client requests go
         self.client_queue = Queue()
         self.client_lock = threading.Lock()
+        self._client_wakeup = threading.Event()                             # Set once the node has been woken for pending client requests.
+        self.client_futures = {}                                            # Futures of client requests made on this node that haven't committed, keyed by request id.
+        self._client_deadlines = []                                         # Heap of (deadline, sequence, request id) for client requests with a timeout.
+        self._client_sequence = 0                                           # Tie breaker for the deadline heap.
+        self.read_queue = Queue()                                           # Linearizable reads waiting for the leader, (key, future) pairs.
+        self.config_queue = Queue()                                         # Membership changes waiting for the leader, (id, name, address book entry) tuples.
+        self.sessions = OrderedDict()                                       # (sequence, commit index) of the last applied request of recent client sessions, oldest first. Others are loaded from storage.
+        self._sessions_appended = OrderedDict()                             # (sequence, id) of the latest request of recent client sessions appended while you've been the leader, oldest first.
+        self.max_sessions = 10000                                           # Max number of client sessions kept in sessions and _sessions_appended.
 
         # List of known nodes and their communication information
         if (isinstance(config, dict)):
             address_book = config
         else:
             address_book = self._load_config(config, name)
-        self.all_ids = [address_book[a]['ip'] + ':' + address_book[a]['port'] for a in address_book if a != 'leader']
+        self.address_book = {a: address_book[a] for a in address_book if a != 'leader'}
+        self.initial_address_book = self.address_book                       # Membership you started with, in force until a change to it commits.
         self.my_id = address_book[name]['ip'] + ':' + address_book[name]['port']
+        self.all_ids, self.learner_ids = self._get_config_ids(self.address_book)
+        self.is_learner = self.my_id in self.learner_ids                    # Learners replicate the log but never vote, run for election, or count towards a majority.
+        self._config_index = 0                                              # Index of the log entry the address book came from. 0 if it's committed or from the config passed in.
 
         # Timing variables
-        self.election_timeout = random.uniform(0.1, 0.1+0.05*len(self.all_ids)) # Failed vote backoff, used for pretty much all timing related things.
+        self.min_election_timeout = 0.1                                     # Shortest election timeout any node can pick.
+        self.election_timeout = random.uniform(self.min_election_timeout, self.min_election_timeout+0.05*len(self.all_ids)) # Failed vote backoff, used for pretty much all timing related things.
         self.heartbeat_frequency = 0.01                                     # How often to send heartbeat (should be less than the election timeout).
         self.resend_time = 2.0                                              # How often to resend an append entries if you havent heard from a node in a while. 
 
+        # Batching variables
+        self.max_batch_entries = 64                                         # Max number of entries sent in a single append entries. Set to 1 to disable batching.
+        self.max_batch_bytes = 65536                                        # Max (approximate) serialized size of the entries sent in a single append entries.
+        self.batch_linger = 0.0                                             # How long to wait for more client requests before sending a partial batch.
+        self.pipeline_depth = 4                                             # Max number of unacknowledged append entries in flight to each node. Set to 1 to disable pipelining.
+        self.send_committals = False                                        # If True, the leader also sends a committal to each node when the commit index advances. Otherwise nodes learn it from append entries and heartbeats.
+
+        # Lease variables
+        self.lease_reads = False                                            # If True, a leader that a majority has heard from recently serves reads locally. Must be enabled on every node.
+        self.lease_margin = 0.02                                            # Safety margin for clock drift, the lease lasts min_election_timeout minus this.
+
+        # Snapshot variables
+        self.snapshot_threshold = 10000                                     # Snapshot and compact the log once this many applied entries are past the last snapshot. None disables compaction.
+        self.snapshot_chunk_size = 65536                                    # Max size of the snapshot data sent in a single install snapshot.
+
         # State variables that I've added
         self._name = name                                                   # Your name. Used mostly for debugging.
         self.current_num_nodes = len(self.all_ids)                          # Number of nodes in the system.
+        self.voters = [i not in self.learner_ids for i in self.all_ids]     # Whether each node counts towards a majority.
+        self.num_voters = sum(self.voters)                                  # Number of nodes that count towards a majority.
         self.current_role = role                                            # Your role in the system (follower, candidate, leader, pending).
         self.leader_id = None                                               # Who you think the current leader is.
         
         # Persistent state variables
         self.current_term = 1                                               # Your current election term.
         self.voted_for = None                                               # Who have you voted in this term. None means you haven't voted for anyone. 
-        self.log = [{'term': 1, 'entry': 'Init Entry', 'id': -1}]           # Your log. Log entries are a dict with the following fields: term, entry, id.
-        self.log_hash = {}
+        self.log = CompactLog([{'term': 1, 'entry': 'Init Entry', 'id': -1}]) # Your log. Log entries are a dict with the following fields: term, entry, id. self.log[0] is the entry at snapshot_index.
+        self.log_hash = OrderedDict()                                       # Recently committed entries keyed by request id, oldest first. Older ones are looked up in storage.
+        self.max_log_hash_entries = 10000                                   # Max number of request ids kept in log_hash.
+        self.snapshot_index = 0                                             # Index of the last entry covered by the snapshot. Entries up to here have been compacted out of the log.
+        self.snapshot_term = 1                                              # Term of the last entry covered by the snapshot.
     
         # Volatile state variables
         self.commit_index = 0                                               # Index of the highest known committed entry in the system.
@@ -69,77 +150,309 @@ class RaftNode(threading.Thread):
         self.last_applied_term = 1                                          # Term of the highest entry you have committed.
 
         # Volotile state leader variables 
-        self.next_index = [None for _ in range(self.current_num_nodes)]     # Index to send to each node next. None means up to date
+        self.next_index = [1 for _ in range(self.current_num_nodes)]        # Index to send to each node next. 
         self.match_index = [0 for _ in range(self.current_num_nodes)]       # Index of highest committed entry on each node
         self.heard_from = [0 for _ in range(self.current_num_nodes)]        # Time last heard from each node. 
-
-        # Start both ends of your interface
-        identity = {'my_id': self.my_id, 'my_name': name}
-        self.listener = Listener(port_list=self.all_ids, identity=identity)
+        self.replied_at = [0 for _ in range(self.current_num_nodes)]        # Time of the last reply from each node, unlike heard_from resends don't move it.
+        self.in_flight = [deque() for _ in range(self.current_num_nodes)]   # (first, last) index of each unacknowledged append entries sent to each node.
+        self.probing = [False for _ in range(self.current_num_nodes)]       # True while searching for the point where a node's log matches, only one append entries is sent at a time.
+        self.snapshot_transfer = [None for _ in range(self.current_num_nodes)] # Snapshot being sent to each node and the offset of the chunk in flight. None means no snapshot is being sent.
+        self._snapshot_cache = None                                         # (index, term, data) of the serialized snapshot sent to lagging nodes.
+        self._reads_waiting = []                                            # Reads waiting for the next leadership confirmation round.
+        self._read_round = 0                                                # Number of the latest heartbeat that asked nodes to confirm your leadership.
+        self._read_round_sent = {}                                          # Time each recent confirmation heartbeat was sent, keyed by its number.
+        self._read_round_start = 0                                          # First confirmation heartbeat that counts for the reads in progress.
+        self._read_round_reads = None                                       # Reads waiting on the round in progress. None means no round is in progress.
+        self._read_round_index = 0                                          # Commit index when the round in progress started, reads are served once it's applied.
+        self._read_round_acks = set()                                       # Nodes that have confirmed your leadership in the round in progress.
+        self.lease_confirmed = [0 for _ in range(self.current_num_nodes)]   # Send time of the latest heartbeat each node has confirmed.
+        self.lease_expiry = 0                                               # Time your lease runs out. Reads are served locally until then.
+        self.lease_hits = 0                                                 # Reads served locally under the lease.
+        self.lease_misses = 0                                               # Reads that found the lease expired and fell back to a confirmation round.
+
+        # Volatile state follower variables
+        self.leader_commit = 0                                              # Highest commit index the leader has told you about.
+        self._verified_index = 0                                            # Your log matches the leader of _verified_term's up to here, it's safe to commit up to it from a heartbeat.
+        self._verified_term = None
+        self.leader_contact = None                                          # Last time you heard from the leader. None if you haven't yet.
+        self._snapshot_chunks = []                                          # Chunks of the snapshot being received from the leader.
+        self._snapshot_received = 0                                         # Length of the snapshot data received so far.
+
+        # Start both ends of your interface, or use a (listener, talker) pair shared with other raft groups (see MultiRaftHost). 
+        # In process, the node thread reads and writes the sockets itself rather than passing messages through other processes.
+        # codec is 'json', 'binary' or a codec from raft.codec, every node has to use the same one
+        if (interface is not None):
+            self.listener, self.talker = interface
+        elif (in_process):
+            identity = {'my_id': self.my_id, 'my_name': name}
+            codec = get_codec(codec, self.all_ids)
+            self.listener = InProcessListener(port_list=self.all_ids, identity=identity, directed=directed, codec=codec)
+            self.talker = InProcessTalker(identity=identity, directed=directed, codec=codec)
+        else:
+            identity = {'my_id': self.my_id, 'my_name': name}
+            codec = get_codec(codec, self.all_ids)
+            self.listener = Listener(port_list=self.all_ids, identity=identity, directed=directed, codec=codec)
+            self.talker = Talker(identity=identity, directed=directed, codec=codec)
         self.listener.start()
-        self.talker = Talker(identity=identity)
         self.talker.start()
 
-        # Initialize storage
-        self.storage = KVStorage(f"raft_node_{name}.db")
+        # Initialize storage, pass in a KVStorage to pick its journal, synchronous, group commit and cache settings
+        self.storage = storage if (storage is not None) else CachedKVStorage(f"raft_node_{name}.db")
 
         # Initialize commit tracking
         self.last_committed_index = self.storage.get_last_committed_index()
         self.commit_index = self.last_committed_index
 
+        # Resume from the last snapshot, if there is one
+        snapshot_index, snapshot_term = self.storage.get_snapshot_meta()
+        if (snapshot_index > 0):
+            self.log = CompactLog([{'term': snapshot_term, 'entry': 'Snapshot', 'id': -1}])
+            self.snapshot_index = self.last_applied_index = snapshot_index
+            self.snapshot_term = self.last_applied_term = snapshot_term
+
+        # The membership may have changed since the address book you were given was written
+        self._apply_config(*self._get_latest_config())
+
     def stop(self):
         """
         Extend stop method to close storage properly
         """
+        # Let the node thread finish what it's committing before closing storage
+        self._terminate = True
+        self.listener.wake()
+        if (self.is_alive() and (threading.current_thread() is not self)):
+            self.join(self.election_timeout + 1.0)
         self.storage.close()
         self.talker.stop()
         self.listener.stop()
-        self._terminate = True
+        self._fail_client_futures(LeadershipLost(self._name + ' stopped'))
 
     @property
     def name(self):
         ''' Return the name of the node. '''
         return self._name
         
-    def client_request(self, value, id_num=-1):
+    def client_request(self, value, id_num=None, timeout=None, client_id=None, sequence=None):
         '''
             client_request: Public function to enqueue a value. If the node
-                is not the leader, this request will be forewarded to the 
+                is not the leader, this request will be forewarded to the
                 leader before being appended. If the system is in a transition
-                state, the request may not be appended at all, so this should 
-                be retried. If no id_num is specified, the id is set to -1.
+                state, the request may not be appended at all, so this should
+                be retried. If no id_num is specified, a unique id is
+                generated.
             Inputs:
                 value: any singleton data type.
-                id_num: any immutable object.
+                id_num: any immutable, json serializable object.
+                timeout: (float or None)
+                    Seconds to wait for the request to commit before failing
+                    the future with a TimeoutError. None waits forever.
+                client_id: (str or int)
+                    Makes the request part of a client session, so retrying 
+                    it is safe. A request is applied at most once per 
+                    (client_id, sequence), retries resolve with the commit 
+                    index of the first one. 
+                sequence: (int)
+                    Must increase with every new request of the session, and
+                    a session's requests should all be made on one node. 
+                    Retries of anything but the latest applied request 
+                    resolve with None, or fail with SupersededRequest if the 
+                    leader has already appended a later one. Each session 
+                    keeps one key in storage for good, so client_id should 
+                    name a client, not a request.
+            Returns:
+                A concurrent.futures.Future that resolves with the commit 
+                index once this node applies the entry, or fails with
+                LeadershipLost or TimeoutError. Use asyncio.wrap_future to 
+                await it from a coroutine. Requesting an id that is still
+                pending returns the same future. A session request is sent
+                again too, the first attempt may have been lost with a leader,
+                other requests aren't since they could be applied twice.
         '''
+        if (id_num is None):
+            id_num = (client_id, sequence) if (client_id is not None) else uuid.uuid4().hex
+
+        future, pending = self._register_client_future(id_num, timeout)
+        if (pending and (client_id is None)):
+            return future
 
         entry = {
             'term': self.current_term,
             'entry': value,
             'id': id_num
         }
+        if (client_id is not None):
+            entry['session'] = [client_id, sequence]
         self.client_queue.put(entry)
 
+        # Wake the node if it's waiting on messages, once is enough until it drains the queue
+        if (not self._client_wakeup.is_set()):
+            self._client_wakeup.set()
+            self.listener.wake()
+
+        return future
+
+    def linearizable_read(self, key):
+        '''
+            linearizable_read: Public function to read a key without going 
+                through the log. Only the leader serves these: it records its
+                commit index, confirms it's still the leader with one
+                heartbeat round, waits for that index to be applied, then
+                reads from storage. Reads that arrive while a round is in
+                progress share the next round. With lease_reads on, a leader
+                holding a valid lease serves the read immediately instead.
+            Inputs:
+                key: the key to read.
+            Returns:
+                A concurrent.futures.Future that resolves with the value (None 
+                if the key isn't set), or fails with NotLeader if this node
+                isn't the leader, or LeadershipLost if it stops being the
+                leader before the read is served. Use future.result(timeout) 
+                to bound the wait.
+        '''
+        future = Future()
+        if (self.check_role() != 'leader'):
+            future.set_exception(NotLeader(self._name + ' is not the leader', self.leader_id))
+            return future
+
+        # Under a valid lease no other node can have been elected, so serve it right away
+        if (self.lease_reads):
+            if ((time.time() < self.lease_expiry) and (self.last_applied_term == self.current_term)):
+                self.lease_hits += 1
+                self.storage.flush()
+                future.set_result(self.storage.get_value(key))
+                return future
+            self.lease_misses += 1
+
+        self.read_queue.put((key, future))
+        if (not self._client_wakeup.is_set()):
+            self._client_wakeup.set()
+            self.listener.wake()
+        return future
+
+    def add_node(self, name, ip, port, learner=False, timeout=None):
+        '''
+            add_node: Public function to add a node to the cluster while it 
+                runs. Only the leader makes membership changes. The change
+                is replicated through the log one node at a time, and every
+                node switches to the new membership as soon as the entry
+                reaches its log. Start the new node with an address book that
+                includes itself before adding it. Adding a node that's
+                already a member changes its learner flag, so a node can be
+                added as a learner, catch up, then be promoted to a voter.
+            Inputs:
+                name: (str)
+                    Name of the node in the address book.
+                ip: (str)
+                port: (str)
+                learner: (bool)
+                    If True, the node replicates the log but doesn't vote.
+                timeout: (float or None)
+                    Seconds to wait for the change to commit before failing 
+                    the future with a TimeoutError. None waits forever.
+            Returns:
+                A concurrent.futures.Future that resolves with the commit 
+                index of the change, or fails with NotLeader, LeadershipLost,
+                TimeoutError, or ValueError if the name is taken by another 
+                address.
+        '''
+        member = {'ip': ip, 'port': str(port)}
+        if (learner):
+            member['learner'] = True
+        return self._request_config_change(name, member, timeout)
+
+    def remove_node(self, name, timeout=None):
+        '''
+            remove_node: Public function to remove a node from the cluster 
+                while it runs. See add_node. A leader that removes itself
+                steps down once the change commits.
+            Inputs:
+                name: (str)
+                    Name of the node in the address book.
+                timeout: (float or None)
+                    Seconds to wait for the change to commit before failing 
+                    the future with a TimeoutError. None waits forever.
+            Returns:
+                A concurrent.futures.Future that resolves with the commit 
+                index of the change, or fails with NotLeader, LeadershipLost,
+                TimeoutError, or ValueError if there's no such node.
+        '''
+        return self._request_config_change(name, None, timeout)
+
+    def follower_read(self, key, max_lag=None, max_age=None):
+        '''
+            follower_read: Public function to read a key from this node's 
+                own storage without contacting the leader. The read may be
+                stale, by at most max_lag committed entries and max_age
+                seconds since the leader was last heard from. The leader
+                serves these as well, it's never behind itself, but it may
+                have been deposed without knowing, so max_age also holds it to
+                having heard from a majority within max_age seconds.
+            Inputs:
+                key: the key to read.
+                max_lag: (int)
+                    Max number of entries the leader may have committed that 
+                    this node hasn't applied yet. None means no bound.
+                max_age: (float)
+                    Max seconds since this node last heard from the leader, or
+                    on the leader since it last heard from a majority. None 
+                    means no bound.
+            Returns:
+                A concurrent.futures.Future that resolves with the value (None
+                if the key isn't set), or fails with StaleRead if this node
+                is outside the bounds.
+        '''
+        future = Future()
+        if (self.check_role() == 'leader'):
+            if ((max_age is not None) and (time.time() - self._majority_replied_at() > max_age)):
+                future.set_exception(StaleRead(self._name + ' has not heard from a majority in ' + str(max_age) + 's', self.leader_id))
+                return future
+        else:
+            if ((max_lag is not None) and (self.leader_commit - self.commit_index > max_lag)):
+                future.set_exception(StaleRead(self._name + ' is ' + str(self.leader_commit - self.commit_index) + ' entries behind the leader', self.leader_id))
+                return future
+            if ((max_age is not None) and ((self.leader_contact is None) or (time.time() - self.leader_contact > max_age))):
+                future.set_exception(StaleRead(self._name + ' has not heard from the leader in ' + str(max_age) + 's', self.leader_id))
+                return future
+
+        self.storage.flush()
+        future.set_result(self.storage.get_value(key))
+        return future
+
+    def lease_stats(self):
+        '''
+            lease_stats: Public function to check the state of the read 
+                lease. expires_in is negative once the lease has run out.
+        '''
+        return {
+            'enabled': self.lease_reads,
+            'valid': (self.check_role() == 'leader') and (time.time() < self.lease_expiry),
+            'expiry': self.lease_expiry,
+            'expires_in': self.lease_expiry - time.time(),
+            'hits': self.lease_hits,
+            'misses': self.lease_misses
+        }
+
     def check_committed_entry(self, id_num=None):
         """
         Public function to check the last entry committed.
         Now also checks persistent storage.
+        Recent request ids are answered from memory, older ones with a 
+        single indexed lookup in storage. Ids compacted into a snapshot are
+        gone and return None.
         """
         if id_num is None:
             with self.client_lock:
-                if self.commit_index < len(self.log):
-                    return self.log[self.commit_index]['entry']
+                if (self.snapshot_index <= self.commit_index <= self._log_max_index()):
+                    return self._log_entry(self.commit_index)['entry']
                 return None
 
         with self.client_lock:
             # First check in-memory log hash
-            mem_result = self.log_hash.get(id_num, None)
-            if mem_result:
-                return mem_result
+            if (id_num in self.log_hash):
+                return self.log_hash[id_num]
 
-            # If not found in memory, check storage
-            stored_entry = self.storage.get_value(str(id_num))
-            return stored_entry
+        # If not found in memory, check storage
+        return self.storage.get_entry_by_request_id(id_num)
 
     def check_role(self):
         ''' 
@@ -187,7 +500,13 @@ class RaftNode(threading.Thread):
                 elif self.check_role() == 'candidate':
                     self._candidate()
                 else:
-                    time.sleep(1)
+                    # Paused, client requests made in the meantime still time out
+                    self._expire_client_futures()
+                    wait = 1
+                    with self.client_lock:
+                        if (self._client_deadlines):
+                            wait = min(wait, max(0, self._client_deadlines[0][0] - time.time()))
+                    time.sleep(wait)
         except KeyboardInterrupt:
             self.stop()
 
@@ -199,6 +518,7 @@ class RaftNode(threading.Thread):
                         is more up-to-date than they are. 
                     - Replicate entries sent by the leader. 
                     - Commit entries committed by the leader. 
+                    - Forward client requests to the leader. 
                     - Promote self to candidate if the leader has crashed. 
         ''' 
 
@@ -206,21 +526,27 @@ class RaftNode(threading.Thread):
         most_recent_heartbeat = time.time()
 
         while ((not self._terminate) and (self.check_role() == 'follower')):
-            incoming_message = self._get_message()
+            self._expire_client_futures()
+
+            # Sleep until a message arrives or it's time to start an election
+            incoming_message = self._get_message(most_recent_heartbeat + self.election_timeout)
             if (incoming_message is not None):
 
                 # Followers only handle requests
                 if (incoming_message.direction == MessageDirection.Request):
 
-                    # Incoming message is a new election candidate
-                    if (incoming_message.type == MessageType.RequestVotes):
+                    # Incoming message is a new election candidate. Under leases, ignore it if you've heard from the leader too recently for its lease to have run out
+                    if ((incoming_message.type == MessageType.RequestVotes) and self.lease_reads and (self.leader_id is not None) and ((time.time() - most_recent_heartbeat) < self.min_election_timeout)):
+                        pass
+
+                    elif (incoming_message.type == MessageType.RequestVotes):
 
                         # If this election is for a new term, update your term
                         if (incoming_message.term > self.current_term):
                             self._increment_term(incoming_message.term)
                             
-                        # If you haven't already voted and you're less up to date than the candidate, send your vote
-                        if ((self.voted_for is None) and (incoming_message.last_log_index >= self.last_applied_index) and (incoming_message.last_log_term >= self.last_applied_term)):
+                        # If you haven't already voted and you're less up to date than the candidate, send your vote. Learners don't vote
+                        if ((not self.is_learner) and (self.voted_for is None) and (incoming_message.last_log_index >= self.last_applied_index) and (incoming_message.last_log_term >= self.last_applied_term)):
                             self._send_vote(incoming_message.sender)
                         else: 
                             self._send_vote(incoming_message.sender, False)
@@ -228,44 +554,88 @@ class RaftNode(threading.Thread):
                         # If there's currently a candidate running, then you shouldn't promote yourself
                         most_recent_heartbeat = time.time()
 
+                    # Incoming message is a heartbeat from a deposed leader, it isn't leading anymore so it can't stand in for the leader
+                    elif ((incoming_message.type == MessageType.Heartbeat) and (incoming_message.term < self.current_term)):
+                        pass
+
                     # Incoming message is a heartbeat, make sure you're up to date, restart the timer
                     elif (incoming_message.type == MessageType.Heartbeat):
                         if (incoming_message.term > self.current_term):
                             self._increment_term(incoming_message.term)
-                        self.leader_id = incoming_message.leader_id
+                        self._follow_leader(incoming_message.leader_id)
                         most_recent_heartbeat = time.time()
+                        self.leader_contact = most_recent_heartbeat
+                        self.leader_commit = max(self.leader_commit, incoming_message.leader_commit)
+
+                        # Commit whatever the leader has committed of the part of your log you've matched with it
+                        self._commit_verified(incoming_message.term, incoming_message.leader_commit)
 
-                        # If leader has been resolved, check for any client requests
-                        if (self.leader_id):
-                            client_request = self._get_client_request()
-                            if (client_request is not None):
-                                self._send_client_request(incoming_message.leader_id, client_request)
+                        # The leader is confirming its leadership to serve reads, let it know you still follow it
+                        if (incoming_message.read_round is not None):
+                            self._send_heartbeat_acknowledge(incoming_message.leader_id, incoming_message.read_round)
                         
                     # Incoming message is some data to append
                     elif (incoming_message.type == MessageType.AppendEntries):
-                        
+
+                        # A leader of a newer term, catch up to it so your acks carry its term
+                        if (incoming_message.term > self.current_term):
+                            self._increment_term(incoming_message.term)
+
                         # Reply false if message term is less than current_term, this is an invalid entry
                         if (incoming_message.term < self.current_term):
-                            self._send_acknowledge(incoming_message.leader_id, False)
+                            self._send_acknowledge(incoming_message.leader_id, False, prev_index=incoming_message.prev_log_index)
 
-                        # Reply false if log doesnt contain an entry at prev_log_index whose term matches prev_log_term
+                        # Reply false if log doesnt contain an entry at prev_log_index whose term matches prev_log_term. Include where the conflict starts so the leader can skip straight to it
                         elif (not self._verify_entry(incoming_message.prev_log_index, incoming_message.prev_log_term)):
-                            self._send_acknowledge(incoming_message.leader_id, False)
+                            conflict_term, conflict_index = self._get_conflict_hint(incoming_message.prev_log_index)
+                            self._send_acknowledge(incoming_message.leader_id, False, prev_index=incoming_message.prev_log_index, conflict_term=conflict_term, conflict_index=conflict_index)
 
-                        # Else if the previous index and term match, append the entry and reply true
+                        # Entries that can't be decoded never reach the log, treat the message as lost and the leader resends it
+                        elif (not self._entries_valid(incoming_message.entries)):
+                            if (self.verbose):
+                                print(self._name + ': dropped append entries with malformed entries after ' + str(incoming_message.prev_log_index))
+
+                        # Else if the previous index and term match, append the entries and reply true
                         else:
+                            # Entries from the current leader count as a heartbeat, a long stream of them shouldn't trigger an election
+                            most_recent_heartbeat = time.time()
+                            self.leader_contact = most_recent_heartbeat
+                            self.leader_commit = max(self.leader_commit, incoming_message.leader_commit)
+                            self._append_entries(incoming_message.entries, prev_index=incoming_message.prev_log_index)
+                            match_index = incoming_message.prev_log_index + len(incoming_message.entries)
+                            if (incoming_message.term != self._verified_term):
+                                self._verified_term = incoming_message.term
+                                self._verified_index = 0
+                            self._verified_index = max(self._verified_index, match_index)
                             if (incoming_message.leader_commit > self.commit_index):
-                                self._append_entry(incoming_message.entries, commit=True, prev_index=incoming_message.prev_log_index)
-                            else:
-                                self._append_entry(incoming_message.entries, commit=False, prev_index=incoming_message.prev_log_index)
-                            self._send_acknowledge(incoming_message.leader_id, True)
+                                self._commit_entry(min(incoming_message.leader_commit, match_index))
+                            self._send_acknowledge(incoming_message.leader_id, True, prev_index=incoming_message.prev_log_index, match_index=match_index)
                     
                     # Incoming message is a commit message
                     elif (incoming_message.type == MessageType.Committal):
-                        self._commit_entry(incoming_message.prev_log_index, incoming_message.prev_log_term)
+                        self._commit_verified(incoming_message.term, incoming_message.prev_log_index)
 
-            # If you haven't heard a heartbeat in a while, promote yourself to a candidate
-            if ((time.time() - most_recent_heartbeat) > (self.election_timeout)):
+                    # Incoming message is a chunk of the leader's snapshot, you're too far behind to catch up from its log
+                    elif (incoming_message.type == MessageType.InstallSnapshot):
+                        if (incoming_message.term < self.current_term):
+                            self._send_snapshot_acknowledge(incoming_message.leader_id, False, self._snapshot_received)
+                        else:
+                            most_recent_heartbeat = time.time()
+                            self._receive_snapshot_chunk(incoming_message)
+
+            # Only the leader serves linearizable reads
+            if (not self.read_queue.empty()):
+                self._fail_reads(NotLeader(self._name + ' is not the leader', self.leader_id))
+
+            # If leader has been resolved, forward all pending client requests to it, batched
+            if (self.leader_id):
+                client_requests = self._drop_duplicate_requests(self._get_client_batch())
+                while (client_requests):
+                    self._send_client_request(self.leader_id, client_requests)
+                    client_requests = self._drop_duplicate_requests(self._get_client_batch())
+
+            # If you haven't heard a heartbeat in a while, promote yourself to a candidate. Learners wait for a new leader to find them
+            if ((not self.is_learner) and ((time.time() - most_recent_heartbeat) > (self.election_timeout))):
                 self._set_current_role('candidate')
                 return
 
@@ -274,7 +644,7 @@ class RaftNode(threading.Thread):
     def _candidate(self):
         ''' 
             _candidate: Nodes will start here if they have not heard the leader 
-                for a period of time. The responsibilities of the candidate 
+                for a period of time. The responsibilities of the candidate
                 nodes are:
                     - Call for a new election and await the results: 
                     - If you recieve more than half of the votes in the system, 
@@ -308,14 +678,17 @@ class RaftNode(threading.Thread):
         time_election_going = time.time()
 
         while ((not self._terminate) and (self.check_role() == 'candidate')):
-            incoming_message = self._get_message()
+            self._expire_client_futures()
+
+            # Sleep until a message arrives or the election times out
+            incoming_message = self._get_message(time_election_going + self.election_timeout)
             if (incoming_message is not None):
 
                 # Handle responses to your election
                 if (incoming_message.direction == MessageDirection.Response):
                 
                     # If it is a vote, then tally for or against you
-                    if (incoming_message.type == MessageType.RequestVotes):
+                    if ((incoming_message.type == MessageType.RequestVotes) and (incoming_message.sender in self.all_ids) and self.voters[self._get_node_index(incoming_message.sender)]):
                         if (incoming_message.results.vote_granted):
                             votes_for_me += 1
                         total_votes += 1
@@ -324,7 +697,7 @@ class RaftNode(threading.Thread):
                         #print(self._name + ": total votes " + str(total_votes))
                             
                         # If you have a majority, promote yourself
-                        if ((votes_for_me > int(old_div(self.current_num_nodes, 2))) or (self.current_num_nodes == 1)):
+                        if (votes_for_me >= self._majority()):
                             self._set_current_role('leader')
                             return
 
@@ -359,7 +732,7 @@ class RaftNode(threading.Thread):
     def _leader(self):
         ''' 
             _leader: Nodes will start here if they have won an election and 
-                promoted themselves. The responsibilities of the leader nodes 
+                promoted themselves. The responsibilities of the leader nodes
                 are:
                     - Send a periodic heartbeat. 
                     - Keep track of who is active in the system and their 
@@ -390,16 +763,24 @@ class RaftNode(threading.Thread):
 
         # Assume all other nodes are up to date with your log
         self.match_index = [self.commit_index for _ in range(self.current_num_nodes)]
-        self.next_index = [None for _ in range(self.current_num_nodes)]
+        self.next_index = [self._log_max_index() + 1 for _ in range(self.current_num_nodes)]
+        self.in_flight = [deque() for _ in range(self.current_num_nodes)]
+        self.probing = [False for _ in range(self.current_num_nodes)]
+        self.snapshot_transfer = [None for _ in range(self.current_num_nodes)]
 
         # Reset heard from
         self.heard_from = [time.time() for _ in range(self.current_num_nodes)]
+        self.replied_at = [0 for _ in range(self.current_num_nodes)]
+        self._sessions_appended = OrderedDict()
+        self.lease_confirmed = [0 for _ in range(self.current_num_nodes)]
+        self.lease_expiry = 0
 
         # Broadcast an entry to get everyone on the same page
         entry = {'term': self.current_term, 'entry': 'Leader Entry', 'id': -1}
-        self._broadcast_append_entries(entry)
+        self._broadcast_append_entries([entry])
 
         while ((not self._terminate) and (self.check_role() == 'leader')):
+            self._expire_client_futures()
 
             # First, send a heartbeat
             if ((time.time() - most_recent_heartbeat) > self.heartbeat_frequency):
@@ -410,63 +791,62 @@ class RaftNode(threading.Thread):
                     #print(self._name + ': sent heartbeat')
                     #print(self._name + ': max committed index: ' + str(self.commit_index))
 
-            # If you haven't heard from a node in a while and it's not up to date, resend the most recent append entries
-            for node, index in enumerate(self.next_index):
-                if ((index is not None) and ((time.time() - self.heard_from[node]) > self.resend_time)):
-                    self._send_append_entries(index - 1, self.log[index - 1]['term'], self.log[index], self.all_ids[node])
-                    self.heard_from[node] = time.time()
-
-            # Watch for messages
-            incoming_message = self._get_message()
+            # If you haven't heard from a node in a while and it has append entries or a snapshot chunk in flight, assume they were lost and resend
+            self._resend_lost()
+
+            # Sleep until a message or client request arrives, or the next heartbeat or resend is due
+            wake_time = most_recent_heartbeat + self.heartbeat_frequency
+            for node, in_flight in enumerate(self.in_flight):
+                if (in_flight or (self.snapshot_transfer[node] is not None)):
+                    wake_time = min(wake_time, self.heard_from[node] + self.resend_time)
+            if ((not self.client_queue.empty()) or (not self.read_queue.empty())):
+                wake_time = None
+            if ((not self.config_queue.empty()) and (self._config_index <= self.commit_index) and (self.last_applied_term == self.current_term)):
+                wake_time = None
+            incoming_message = self._get_message(wake_time)
             if (incoming_message is not None):
 
-                # Handle incoming responses 
-                if (incoming_message.direction == MessageDirection.Response):
+                # Handle incoming responses, nodes that have been removed aren't tracked anymore
+                if ((incoming_message.direction == MessageDirection.Response) and (incoming_message.sender in self.all_ids)):
 
                     # Incoming message is an ack, update next_index and see if there's more log to send
                     if (incoming_message.type == MessageType.Acknowledge):
+                        self._receive_acknowledge(incoming_message)
+
+                    # Incoming message is an ack for a snapshot chunk, send the next chunk or resume sending entries after the snapshot
+                    elif (incoming_message.type == MessageType.InstallSnapshot):
                         sender_index = self._get_node_index(incoming_message.sender)
                         self.heard_from[sender_index] = time.time()
-
-                        # If you haven't already gotten a positive ack for this operation 
-                        if (self.next_index[sender_index] is not None):
-
-                            # If the append entries was successful, then increment next index to send, otherwise decrement
-                            if (incoming_message.results.success):
-                                self.match_index[sender_index] = self.next_index[sender_index]
-                                self.next_index[sender_index] += 1
+                        self.replied_at[sender_index] = self.heard_from[sender_index]
+                        transfer = self.snapshot_transfer[sender_index]
+
+                        if (transfer is not None):
+                            if (not incoming_message.results.success):
+                                self.snapshot_transfer[sender_index] = None
+                            elif (incoming_message.results.match_index is not None):
+                                self.snapshot_transfer[sender_index] = None
+                                self.match_index[sender_index] = max(self.match_index[sender_index], incoming_message.results.match_index)
+                                self.next_index[sender_index] = incoming_message.results.match_index + 1
+                                self.in_flight[sender_index].clear()
+                                self.probing[sender_index] = False
+                                self._replicate(sender_index)
                             else:
-                                if (self.next_index[sender_index] != 1):
-                                    self.next_index[sender_index] -= 1
+                                transfer['offset'] = incoming_message.offset
+                                self._send_snapshot_chunk(sender_index)
 
-                            # Are there more entries to send to bring this node up to date?
-                            if self.next_index[sender_index] > self._log_max_index():
-                                self.next_index[sender_index] = None
-                            else:
-                                next_index = self.next_index[sender_index]
-                                self._send_append_entries(next_index - 1, self.log[next_index - 1]['term'], self.log[next_index], incoming_message.sender)
-                            
-                            if (self.verbose):
-                                print(self._name + ": updated standing is " + str(self.match_index) + " my index: " + str(self._log_max_index()))
-
-                            # Determine the 'committable' indices
-                            log_lengths = [int(i) for i in self.match_index if (i is not None)]
-                            log_lengths.sort(reverse=True)
-                            max_committable_index = 0
-                            for index in log_lengths:
-                                # Count how many other nodes this index is replicated on
-                                replicated_on = sum([1 if index <= i else 0 for i in log_lengths])
-                                if (replicated_on >= (int(old_div(self.current_num_nodes, 2)) + 1)):
-                                    max_committable_index = index
-
-                            # If there's a new committable index, then send the commit
-                            if (max_committable_index > self.commit_index):
-                                    self._broadcast_commmit_entries(max_committable_index)
-
-                    # If its a client then it's a new request
+                    # Incoming message is a reply to a heartbeat, count it towards confirming your leadership for reads
+                    elif (incoming_message.type == MessageType.Heartbeat):
+                        sender_index = self._get_node_index(incoming_message.sender)
+                        self.heard_from[sender_index] = time.time()
+                        self.replied_at[sender_index] = self.heard_from[sender_index]
+                        if (incoming_message.term == self.current_term):
+                            self._confirm_read_round(sender_index, incoming_message.read_round)
+
+                    # If its a client then it's a batch of new requests forwarded by a follower, replicate them in one step
                     elif (incoming_message.type == MessageType.ClientRequest):
-                        client_request = incoming_message.entries
-                        self._broadcast_append_entries(client_request)
+                        client_requests = self._drop_duplicate_requests(incoming_message.entries, appending=True)
+                        if (client_requests):
+                            self._broadcast_append_entries(client_requests)
 
                 # Handle incoming requests
                 elif (incoming_message.direction == MessageDirection.Request):
@@ -482,10 +862,18 @@ class RaftNode(threading.Thread):
                                 print(self._name + ': saw higher term, demoting')
                             return
             
-            # Get any pending client requests
-            client_request = self._get_client_request()
-            if (client_request is not None):
-                self._broadcast_append_entries(client_request)
+            # Get any pending client requests, replicate them as a single batch
+            client_requests = self._drop_duplicate_requests(self._get_client_batch(), appending=True)
+            if (client_requests):
+                self._broadcast_append_entries(client_requests)
+
+            # Get any pending reads, confirm your leadership for them
+            self._start_read_round()
+
+            # Start the next membership change. If you removed yourself, step down once it's committed
+            self._start_config_change()
+            if (self.is_learner and (self._config_index <= self.commit_index)):
+                self._set_current_role('follower')
 
         return
 
@@ -497,26 +885,252 @@ class RaftNode(threading.Thread):
         '''
         self.talker.send_message(message.jsonify())
 
-    def _get_message(self):
+    def _get_message(self, wake_time=None):
         '''
-            _get_message: A wrapper to get a message. If there are no pending 
-                messages returns None. 
+            _get_message: A wrapper to get a message. Blocks until a message 
+                arrives, a client request wakes the node, or wake_time passes.
+                If there are no pending messages returns None. 
+            Inputs:
+                wake_time: (float or None)
+                    Time (as returned by time.time()) to stop waiting at. If 
+                    None, returns immediately.
         '''
-        return parse_json_message(self.listener.get_message())
+        timeout = 0 if (wake_time is None) else max(0, wake_time - time.time())
+        return parse_json_message(self.listener.get_message(timeout))
 
     def _load_config(self, config, name):
         with open(config, 'r') as infile:
             data = json.load(infile)
         return data
 
-    def _get_client_request(self):
+    def _register_client_future(self, id_num, timeout):
         '''
-            _get_node_index: Pops the most recent client request. 
+            _register_client_future: Creates the future for a request made on
+                this node, it resolves when _commit_entry applies the entry
+                with the same id. Returns (future, True) if a request with
+                that id is still pending, its future is reused.
         '''
-        try:
-            return self.client_queue.get(block=False)
-        except Empty:
-            return None
+        with self.client_lock:
+            future = self.client_futures.get(id_num)
+            if (future is not None):
+                return future, True
+            future = Future()
+            self.client_futures[id_num] = future
+            if (timeout is not None):
+                self._client_sequence += 1
+                heapq.heappush(self._client_deadlines, (time.time() + timeout, self._client_sequence, id_num))
+        return future, False
+
+    def _request_config_change(self, name, member, timeout):
+        '''
+            _request_config_change: Queues a membership change for the leader
+                thread, see add_node and remove_node.
+            Inputs:
+                name: (str)
+                member: (dict or None)
+                    New address book entry for the node, None removes it.
+                timeout: (float or None)
+        '''
+        if (self.check_role() != 'leader'):
+            future = Future()
+            future.set_exception(NotLeader(self._name + ' is not the leader', self.leader_id))
+            return future
+
+        id_num = uuid.uuid4().hex
+        future, _ = self._register_client_future(id_num, timeout)
+        self.config_queue.put((id_num, name, member))
+        if (not self._client_wakeup.is_set()):
+            self._client_wakeup.set()
+            self.listener.wake()
+        return future
+
+    def _start_config_change(self):
+        '''
+            _start_config_change: Should be called only by the leader. Appends
+                the next queued membership change, once the previous one has
+                committed and an entry from your own term has committed. Only
+                one change is ever uncommitted, so the old and new majorities
+                always overlap.
+        '''
+        if ((self._config_index > self.commit_index) or (self.last_applied_term != self.current_term)):
+            return
+
+        while True:
+            try:
+                id_num, name, member = self.config_queue.get(block=False)
+            except Empty:
+                return
+
+            # The request already timed out
+            with self.client_lock:
+                future = self.client_futures.get(id_num)
+            if (future is None):
+                continue
+
+            address_book = dict(self.address_book)
+            error = None
+            if (member is None):
+                if (name not in address_book):
+                    error = ValueError(name + ' is not a member')
+                else:
+                    del address_book[name]
+            else:
+                address = member['ip'] + ':' + member['port']
+                if (address in self.all_ids) and ((name not in address_book) or (address_book[name]['ip'] + ':' + address_book[name]['port'] != address)):
+                    error = ValueError(address + ' is already a member')
+                elif ((name in address_book) and (address_book[name]['ip'] + ':' + address_book[name]['port'] != address)):
+                    error = ValueError(name + ' is already a member at a different address')
+                else:
+                    address_book[name] = member
+            if (error is not None):
+                with self.client_lock:
+                    self.client_futures.pop(id_num, None)
+                future.set_exception(error)
+                continue
+
+            entry = {'term': self.current_term, 'entry': {'key': config_key, 'value': address_book}, 'id': id_num}
+            self._broadcast_append_entries([entry])
+            return
+
+    def _get_config_ids(self, address_book):
+        '''
+            _get_config_ids: Returns the addresses of every node in an address
+                book, with yours added if you aren't a member, and the
+                addresses of its learners.
+        '''
+        all_ids = [address_book[a]['ip'] + ':' + address_book[a]['port'] for a in address_book if a != 'leader']
+        if (self.my_id not in all_ids):
+            all_ids.append(self.my_id)
+        learner_ids = [address_book[a]['ip'] + ':' + address_book[a]['port'] for a in address_book if (a != 'leader') and address_book[a].get('learner', False)]
+        return all_ids, learner_ids
+
+    def _is_config_entry(self, entry):
+        return isinstance(entry['entry'], dict) and (entry['entry'].get('key') == config_key)
+
+    def _has_config_entry(self, entries):
+        # Packed entries are only decoded if their payload mentions the config key
+        if (isinstance(entries, PackedEntries)):
+            return any((config_key.encode() in payload) and self._is_config_entry(entries[i]) for i, payload in enumerate(entries.payloads))
+        return any(self._is_config_entry(entry) for entry in entries)
+
+    def _get_latest_config(self):
+        '''
+            _get_latest_config: Returns (address book, index) of the latest 
+                membership. A node uses the newest change in its log whether or
+                not it has committed. Without one, it's the committed
+                membership in storage, or the address book you started with.
+                Not self.address_book, that may be a change just cut from the
+                log.
+        '''
+        with self.client_lock:
+            for offset in range(len(self.log) - 1, 0, -1):
+                if ((config_key.encode() in self.log.raw(offset)) and self._is_config_entry(self.log[offset])):
+                    return self.log[offset]['entry']['value'], self.snapshot_index + offset
+        self.storage.flush()
+        address_book = self.storage.get_value(config_key)
+        return (address_book if (address_book is not None) else self.initial_address_book), 0
+
+    def _apply_config(self, address_book, index):
+        '''
+            _apply_config: Switches to a new membership. Subscribes to nodes 
+                that joined, unsubscribes from nodes that left, and carries
+                the replication state of the remaining nodes over to their
+                new positions in the per node lists. You stay in all_ids even
+                if you've been removed, as a node that can't vote.
+            Inputs:
+                address_book: (dict)
+                    Same format as the address book json.
+                index: (int)
+                    Index of the log entry it came from, 0 if it's committed.
+        '''
+        old_ids = self.all_ids
+        self.address_book = address_book
+        self._config_index = index
+        self.all_ids, self.learner_ids = self._get_config_ids(address_book)
+        members = [address_book[a]['ip'] + ':' + address_book[a]['port'] for a in address_book]
+        self.voters = [(i in members) and (i not in self.learner_ids) for i in self.all_ids]
+        self.num_voters = sum(self.voters)
+        self.is_learner = not self.voters[self._get_node_index(self.my_id)]
+        if (self.all_ids == old_ids):
+            return
+
+        for address in self.all_ids:
+            if (address not in old_ids):
+                self.listener.connect(address)
+        for address in old_ids:
+            if (address not in self.all_ids):
+                self.listener.disconnect(address)
+
+        # Nodes that joined start from the end of your log and probe back from there
+        old_index = {address: node for node, address in enumerate(old_ids)}
+        def carry(values, default):
+            return [values[old_index[a]] if (a in old_index) else default() for a in self.all_ids]
+        self.next_index = carry(self.next_index, lambda: self._log_max_index())
+        self.match_index = carry(self.match_index, lambda: 0)
+        self.heard_from = carry(self.heard_from, time.time)
+        self.replied_at = carry(self.replied_at, lambda: 0)
+        self.in_flight = carry(self.in_flight, deque)
+        self.probing = carry(self.probing, lambda: False)
+        self.snapshot_transfer = carry(self.snapshot_transfer, lambda: None)
+        self.lease_confirmed = carry(self.lease_confirmed, lambda: 0)
+        self.current_num_nodes = len(self.all_ids)
+
+        # Confirmations from the old membership don't count towards the new majority
+        self._read_round_start = self._read_round + 1
+        self._read_round_acks = set([self._get_node_index(self.my_id)]) if (not self.is_learner) else set()
+
+        if (self.verbose):
+            print(self._name + ': membership is now ' + str(sorted(address_book)))
+
+    def _get_client_batch(self):
+        '''
+            _get_client_batch: Drains pending client requests into a batch. 
+                Stops once max_batch_entries or max_batch_bytes is reached. If
+                the queue runs dry before the batch is full, waits up to
+                batch_linger for more requests. Under light load this returns
+                single entries with no added latency, under heavy load the
+                batches grow towards the limits.
+        '''
+        self._client_wakeup.clear()
+        batch = []
+        batch_bytes = 0
+        linger_until = None
+        while ((len(batch) < self.max_batch_entries) and (batch_bytes < self.max_batch_bytes)):
+            try:
+                if (linger_until is None):
+                    entry = self.client_queue.get(block=False)
+                else:
+                    remaining = linger_until - time.time()
+                    if (remaining <= 0):
+                        break
+                    entry = self.client_queue.get(timeout=remaining)
+            except Empty:
+                if (batch and (self.batch_linger > 0) and (linger_until is None)):
+                    linger_until = time.time() + self.batch_linger
+                    continue
+                break
+            batch.append(entry)
+            batch_bytes += len(json.dumps(entry))
+        return batch
+
+    def _get_log_batch(self, start_index):
+        '''
+            _get_log_batch: Returns the slice of the log starting at 
+                start_index that fits in a single append entries.
+            Inputs:
+                start_index: (int)
+                    First log index to send.
+            Returns:
+                A PackedEntries.
+        '''
+        batch_bytes = 0
+        start_offset = stop_offset = start_index - self.snapshot_index
+        while ((stop_offset < min(start_offset + self.max_batch_entries, len(self.log))) and ((stop_offset == start_offset) or (batch_bytes < self.max_batch_bytes))):
+            batch_bytes += len(self.log.raw(stop_offset))
+            stop_offset += 1
+
+        # Sent as the serialized payloads, they're never decoded on the way to the other logs
+        return self.log.packed(start_offset, stop_offset)
     
     def _set_current_role(self, role):
         '''
@@ -527,8 +1141,179 @@ class RaftNode(threading.Thread):
                     Node's new role
         '''
         with self.client_lock:
+            old_role = self.current_role
             self.current_role = role
 
+        # Losing your leadership, or your leader, leaves pending requests with an unknown outcome
+        if ((role != old_role) and ((old_role == 'leader') or (role in ['candidate', 'none']))):
+            self._fail_client_futures(LeadershipLost(self._name + ' went from ' + old_role + ' to ' + role))
+            self._fail_reads(LeadershipLost(self._name + ' went from ' + old_role + ' to ' + role))
+        if (old_role == 'leader'):
+            self.lease_expiry = 0
+
+            # Their futures have been failed above
+            while True:
+                try:
+                    self.config_queue.get(block=False)
+                except Empty:
+                    break
+
+    def _follow_leader(self, leader_id):
+        '''
+            _follow_leader: Should be called only by followers. Makes leader_id
+                the leader you forward requests to. If it replaces another
+                leader, the requests you've forwarded to that one may have been
+                lost with it, so their futures fail with LeadershipLost.
+            Inputs: 
+                leader_id: (str)
+                    Address of the leader.
+        '''
+        if ((self.leader_id is not None) and (leader_id != self.leader_id)):
+            self._fail_client_futures(LeadershipLost(self._name + ' switched from leader ' + str(self.leader_id) + ' to ' + str(leader_id)))
+        self.leader_id = leader_id
+
+    def _fail_client_futures(self, exception):
+        '''
+            _fail_client_futures: Fails the futures of every pending client 
+                request made on this node.
+            Inputs: 
+                exception: (Exception)
+                    Set on each future.
+        '''
+        with self.client_lock:
+            futures = list(self.client_futures.values())
+            self.client_futures = {}
+            self._client_deadlines = []
+        for future in futures:
+            future.set_exception(exception)
+
+    def _fail_reads(self, exception):
+        '''
+            _fail_reads: Fails every queued and pending linearizable read.
+            Inputs: 
+                exception: (Exception)
+                    Set on each future.
+        '''
+        with self.client_lock:
+            reads = self._reads_waiting + (self._read_round_reads or [])
+            self._reads_waiting = []
+            self._read_round_reads = None
+        while True:
+            try:
+                reads.append(self.read_queue.get(block=False))
+            except Empty:
+                break
+        for _, future in reads:
+            future.set_exception(exception)
+
+    def _start_read_round(self):
+        '''
+            _start_read_round: Should be called only by the leader. Picks up 
+                queued reads and, if no round is in progress, starts a
+                leadership confirmation round for all of them by recording
+                the commit index and sending a heartbeat that asks for
+                replies. Waits until an entry from your own term has
+                committed, before then your commit index may be stale.
+        '''
+        while True:
+            try:
+                self._reads_waiting.append(self.read_queue.get(block=False))
+            except Empty:
+                break
+
+        if ((not self._reads_waiting) or (self._read_round_reads is not None) or (self.last_applied_term != self.current_term)):
+            return
+
+        with self.client_lock:
+            self._read_round_reads = self._reads_waiting
+            self._reads_waiting = []
+        self._read_round_start = self._read_round + 1
+        self._read_round_index = self.commit_index
+        self._read_round_acks = set([self._get_node_index(self.my_id)])
+        if (len(self._read_round_acks) >= self._majority()):
+            self._serve_reads()
+        else:
+            self._send_heartbeat()
+
+    def _confirm_read_round(self, node, read_round):
+        '''
+            _confirm_read_round: Should be called only by the leader. Counts 
+                a node's reply to a confirmation heartbeat. Extends your lease,
+                and serves the reads in progress once a majority has replied
+                to a heartbeat sent after they arrived.
+            Inputs: 
+                node: (int)
+                    Index of the node that replied.
+                read_round: (int)
+                    Number of the heartbeat the reply is for.
+        '''
+        if (not self.voters[node]):
+            return
+        majority = self._majority()
+
+        # The lease runs from when the heartbeat was sent, the node can't have started an election before it got it
+        sent = self._read_round_sent.get(read_round)
+        if (self.lease_reads and (sent is not None) and (sent > self.lease_confirmed[node])):
+            self.lease_confirmed[node] = sent
+            self.lease_confirmed[self._get_node_index(self.my_id)] = time.time()
+            lease_start = sorted([c for c, voter in zip(self.lease_confirmed, self.voters) if voter], reverse=True)[majority - 1]
+            self.lease_expiry = lease_start + self.min_election_timeout - self.lease_margin
+
+        if ((self._read_round_reads is None) or (read_round is None) or (read_round < self._read_round_start)):
+            return
+        self._read_round_acks.add(node)
+        if (len(self._read_round_acks) >= majority):
+            self._serve_reads()
+
+    def _serve_reads(self):
+        '''
+            _serve_reads: Should be called only by the leader once the round 
+                in progress is confirmed. Serves its reads from storage.
+        '''
+        with self.client_lock:
+            reads = self._read_round_reads or []
+            self._read_round_reads = None
+
+        # The leader applies as it commits, but make sure group commits have reached storage
+        self._commit_entry(self._read_round_index)
+        self.storage.flush()
+        for key, future in reads:
+            future.set_result(self.storage.get_value(key))
+
+    def _expire_client_futures(self):
+        '''
+            _expire_client_futures: Fails the futures of pending client 
+                requests whose timeout has passed with a TimeoutError.
+        '''
+        if (not self._client_deadlines):
+            return
+        expired = []
+        with self.client_lock:
+            while (self._client_deadlines and (self._client_deadlines[0][0] <= time.time())):
+                _, _, id_num = heapq.heappop(self._client_deadlines)
+                future = self.client_futures.pop(id_num, None)
+                if (future is not None):
+                    expired.append(future)
+        for future in expired:
+            future.set_exception(TimeoutError('client request timed out before committing'))
+
+    def _majority_replied_at(self):
+        '''
+            _majority_replied_at: Should be called only by the leader. Returns
+                the latest time by which a majority of voters, counting
+                yourself, had replied to you.
+        '''
+        me = self._get_node_index(self.my_id)
+        replied = [time.time() if (node == me) else at for node, at in enumerate(self.replied_at) if self.voters[node]]
+        return sorted(replied, reverse=True)[self._majority() - 1]
+
+    def _majority(self):
+        '''
+            _majority: Returns the number of voters needed for a majority, 
+                learners don't count.
+        '''
+        return int(old_div(self.num_voters, 2)) + 1
+
     def _get_node_index(self, node_address):
         '''
             _get_node_index: Retuns the index of a specific node address,
@@ -544,9 +1329,27 @@ class RaftNode(threading.Thread):
     def _log_max_index(self):
         '''
             _log_max_index: Returns the max index of the log. Used for 
-                convenience. 
+                convenience.
         '''
-        return len(self.log) - 1
+        return self.snapshot_index + len(self.log) - 1
+
+    def _log_entry(self, index):
+        '''
+            _log_entry: Returns the log entry at a given index. The index 
+                must not be before the snapshot.
+            Inputs: 
+                index: (int)
+        '''
+        return self.log[index - self.snapshot_index]
+
+    def _log_term(self, index):
+        '''
+            _log_term: Returns the term of the log entry at a given index. The
+                index must not be before the snapshot.
+            Inputs: 
+                index: (int)
+        '''
+        return self.log.term(index - self.snapshot_index)
 
     def _increment_term(self, term=None):
         '''
@@ -570,8 +1373,8 @@ class RaftNode(threading.Thread):
             _verify_entry: Should be called whenever checking if an entry can 
                 be appended to the log. Checks that the log has enough entries
                 that the target index will not cause an error. Then checks if
-                the target index has the same term as the target term. If it 
-                does then this is a valid entry. 
+                the target index has the same term as the target term. If it
+                does then this is a valid entry.
             Input: 
                 prev_index: (int)
                     Index to check.
@@ -579,106 +1382,553 @@ class RaftNode(threading.Thread):
                     Term to check.
         '''
         
-        if (len(self.log) <= prev_index):
+        # Anything covered by the snapshot was committed, so it matches
+        if (prev_index < self.snapshot_index):
+            return True
+        if (self._log_max_index() < prev_index):
             return False
-        if (self.log[prev_index]['term'] == prev_term):
+        if (self._log_term(prev_index) == prev_term):
             return True
         return False
 
-    def _append_entry(self, entry, commit=False, prev_index=None):
+    def _get_conflict_hint(self, prev_index):
+        '''
+            _get_conflict_hint: Should be called when rejecting an append 
+                entries. Returns the term of the conflicting entry and the
+                first index of that term in the log. If the log is too short
+                to contain prev_index, the term is None and the index is the
+                length of the log.
+            Input: 
+                prev_index: (int)
+                    The prev_log_index that failed _verify_entry.
+        '''
+        if (self._log_max_index() < prev_index):
+            return None, self._log_max_index() + 1
+
+        conflict_term = self._log_term(prev_index)
+        conflict_index = prev_index
+        while ((conflict_index > self.snapshot_index + 1) and (self._log_term(conflict_index - 1) == conflict_term)):
+            conflict_index -= 1
+        return conflict_term, conflict_index
+
+    def _get_conflict_next_index(self, prev_index, conflict_term, conflict_index):
         '''
-            _append_entry: Appends entries to the log and optionally commits. 
-                Assumes that the entry has already been verified (see 
-                _verify_entry).
+            _get_conflict_next_index: Should be called only by the leader. 
+                Uses the hint from a rejected append entries to pick the next 
+                index to send, skipping a whole term per round trip rather
+                than a single entry. If the node's conflicting term is also in
+                your log, resume just after your last entry of that term, 
+                otherwise resume at the first index of the node's term.
+            Input: 
+                prev_index: (int)
+                    The prev_log_index of the rejected append entries.
+                conflict_term: (int or None)
+                    Term of the node's entry at prev_index, None if its log is
+                    too short.
+                conflict_index: (int or None)
+                    First index of conflict_term in the node's log, or the 
+                    length of its log.
+        '''
+        # No hint, step back one entry
+        if (conflict_index is None):
+            return max(1, prev_index)
+
+        if (conflict_term is not None):
+            for index in range(min(prev_index, self._log_max_index()), self.snapshot_index, -1):
+                if (self._log_term(index) == conflict_term):
+                    return index + 1
+                if (self._log_term(index) < conflict_term):
+                    break
+
+        return max(1, min(conflict_index, prev_index))
+
+    def _get_committable_index(self):
+        '''
+            _get_committable_index: Should be called only by the leader. 
+                Returns the highest index a majority of voters have in their 
+                log, 0 if there's none. Learners don't count.
+        '''
+        # Determine the 'committable' indices, the first one from the top that's on a majority is the highest
+        log_lengths = [int(i) for i, voter in zip(self.match_index, self.voters) if ((i is not None) and voter)]
+        log_lengths.sort(reverse=True)
+        max_committable_index = 0
+        for index in log_lengths:
+            # Count how many other nodes this index is replicated on
+            replicated_on = sum([1 if index <= i else 0 for i in log_lengths])
+            if (replicated_on >= self._majority()):
+                max_committable_index = index
+                break
+        return max_committable_index
+
+    def _append_entries(self, entries, commit=False, prev_index=None):
+        '''
+            _append_entries: Appends a batch of entries to the log and 
+                optionally commits. The whole batch is appended under a single
+                lock so readers never see a partial batch. Entries already in
+                the log are skipped, so duplicate or reordered append entries
+                never drop acknowledged entries. Assumes that the entries have
+                already been verified (see _verify_entry).
             Inputs:
-                entry: (dict with the attributes 'term' and 'entry') 
-                    Stores  whatever information to append to the log. 
+                entries: (list of dicts with the attributes 'term', 'entry' and 'id', or a PackedEntries)
+                    Stores whatever information to append to the log. 
                 commit: (bool) 
-                    If True, will update the last applied index and term after
-                    writing to the log. If false will do nothing. 
+                    If True, will commit up to the last appended entry. If 
+                    false will do nothing. 
                 prev_index: (int) 
-                    If None, will append the entry to the end of the log. Else 
-                    will append the entry to the index specified.
+                    If None, will append the entries to the end of the log. 
+                    Else will append the entries after the index specified.
         '''
 
-    
-        # If prev_term was specified, might have to cut the log short
-        if (prev_index is None):
-            prev_index = len(self.log) - 1
-        else:
-            self.log = self.log[:prev_index+1]
-        
-        # Add this to the log
-        prev_term = self.log[-1]['term']
+        removed = []
         with self.client_lock:
-            self.log.append(entry)
-            self.log_hash[entry['id']] = entry
+            if (prev_index is None):
+                new_entries = entries
+            else:
+                # Skip entries you already have (or have compacted), only cut the log short where it conflicts with the new entries
+                new_entries = []
+                terms = entries.terms if isinstance(entries, PackedEntries) else [entry['term'] for entry in entries]
+                for offset, term in enumerate(terms):
+                    index = prev_index + 1 + offset
+                    if (index <= self.snapshot_index):
+                        continue
+                    if ((index > self._log_max_index()) or (self._log_term(index) != term)):
+                        removed = self.log[index - self.snapshot_index:]
+                        del self.log[index - self.snapshot_index:]
+                        new_entries = entries[offset:]
+                        break
+
+            # Add these to the log
+            self.log.extend(new_entries)
+
+        # Membership changes take effect as soon as they're in the log, and are undone if they're cut from it
+        if (self._has_config_entry(new_entries) or self._has_config_entry(removed)):
+            self._apply_config(*self._get_latest_config())
 
         # Maybe commit
-        if (commit):
-            self._commit_entry(prev_index, entry['term'])
+        if (commit and entries):
+            self._commit_entry(self._log_max_index())
 
-        return prev_index, prev_term
+    def _entries_valid(self, entries):
+        '''
+            _entries_valid: Returns whether the entries of an append entries 
+                from the wire can be appended, packed payloads are only
+                decoded once they're in the log.
+        '''
+        if (isinstance(entries, PackedEntries)):
+            try:
+                entries.validate()
+            except ValueError:
+                return False
+            return True
+        return all(isinstance(entry, dict) and ('term' in entry) and ('entry' in entry) and ('id' in entry) for entry in entries)
+
+    def _commit_verified(self, term, index):
+        '''
+            _commit_verified: Commits up to index, as told by the leader of 
+                term in a heartbeat or committal, but no further than the part
+                of your log you've matched with that leader. Past that your
+                log may still hold entries the leader doesn't have.
+        '''
+        if ((term == self._verified_term) and (index is not None) and (index > self.commit_index)):
+            self._commit_entry(min(index, self._verified_index))
 
-    def _commit_entry(self, index, term):
+    def _commit_entry(self, index):
         """
-        Commit an entry at the given index and term.
+        Commit all entries up to and including the given index.
         Updates storage and internal state tracking.
         """
+        # Nothing new to apply, entries past the end of the log can't be applied yet
+        index = min(index, self._log_max_index())
+        if index <= self.last_applied_index:
+            return
+        first_index = self.last_applied_index + 1
+
         # Cập nhật internal state như hiện tại
         self.last_applied_index = index
-        self.last_applied_term = term
+        self.last_applied_term = self._log_term(index)
 
         # Commit index có thể được truy cập song song bởi client
         with self.client_lock:
             self.commit_index = index
 
-        # Lưu entry vào storage
-        if index < len(self.log):
-            entry = self.log[index]
-            self.storage.commit_log(index, term, entry['entry'])
+        # Lưu các entry vào storage trong một transaction
+        committed = []
+        ids = []
+        results = []
+        for i in range(first_index, index + 1):
+            entry = self._log_entry(i)
+            ids.append(entry['id'])
+            session = entry.get('session')
+            if (session is None):
+                committed.append((i, entry['term'], entry['entry'], entry['id']))
+                results.append(i)
+                continue
+
+            # A session's request that's already been applied is a retry, it leaves the state alone and gets the first one's result
+            client_id, sequence = session
+            last = self._get_session(client_id)
+            if ((last is not None) and (sequence <= last[0])):
+                committed.append((i, entry['term'], None, None))
+                results.append(last[1] if (sequence == last[0]) else None)
+            else:
+                self.sessions[client_id] = (sequence, i)
+                self.sessions.move_to_end(client_id)
+                committed.append((i, entry['term'], entry['entry'], entry['id'], {session_key_prefix + json.dumps(client_id): [sequence, i]}))
+                results.append(i)
+        self.storage.commit_logs(committed)
+
+        # Forget the oldest sessions once there are too many, they're read back from storage so it has to be up to date
+        if (len(self.sessions) > self.max_sessions):
+            self.storage.flush()
+            while (len(self.sessions) > old_div(self.max_sessions, 2)):
+                self.sessions.popitem(last=False)
+
+        # Update log hash cho client queries, the oldest ids are left to storage
+        with self.client_lock:
+            for committed_entry in committed:
+                id_num = committed_entry[3]
+                if (id_num is not None):
+                    self.log_hash[id_num] = committed_entry[2]
+                    self.log_hash.move_to_end(id_num)
+            while (len(self.log_hash) > self.max_log_hash_entries):
+                self.log_hash.popitem(last=False)
+
+        # Resolve the futures of client requests made on this node
+        if (self.client_futures):
+            resolved = []
+            with self.client_lock:
+                for id_num, result in zip(ids, results):
+                    future = self.client_futures.pop(id_num, None)
+                    if (future is not None):
+                        resolved.append((future, result))
+            for future, result in resolved:
+                future.set_result(result)
+
+        # Compact the log once enough has been applied since the last snapshot
+        if ((self.snapshot_threshold is not None) and (self.last_applied_index - self.snapshot_index >= self.snapshot_threshold)):
+            self._take_snapshot()
+
+    def _get_session(self, client_id):
+        '''
+            _get_session: Returns (sequence, commit index) of the last applied 
+                request of a client session, None if it hasn't made any.
+        '''
+        if (client_id not in self.sessions):
+            last = self.storage.get_value(session_key_prefix + json.dumps(client_id))
+            if (last is None):
+                return None
+            self.sessions[client_id] = tuple(last)
+        self.sessions.move_to_end(client_id)
+        return self.sessions[client_id]
 
-            # Update log hash cho client queries
-            self.log_hash[entry['id']] = entry['entry']
+    def _drop_duplicate_requests(self, entries, appending=False):
+        '''
+            _drop_duplicate_requests: Filters out retries of client session 
+                requests that have already been applied, answering the ones
+                made on this node straight away. The leader also drops
+                retries of the request it has appended last for a session
+                but not yet applied, their futures resolve when the original
+                is applied, and fails older sequences of the session, or the
+                same one under another id, with SupersededRequest. Requests
+                the leader can't answer because they were forwarded are
+                appended anyway, they leave the state alone when applied and
+                that resolves them on the node they were made on.
+            Inputs:
+                entries: (list of dicts with the attributes 'term', 'entry' and 'id')
+                appending: (bool)
+                    True if you're the leader and are about to append them.
+        '''
+        kept = []
+        for entry in entries:
+            session = entry.get('session')
+            if (session is None):
+                kept.append(entry)
+                continue
+
+            # Forwarded ids arrive as json, where tuples are lists
+            client_id, sequence = session
+            id_num = tuple(entry['id']) if isinstance(entry['id'], list) else entry['id']
+            last = self._get_session(client_id)
+            appended = self._sessions_appended.get(client_id) if (appending) else None
+            if ((last is not None) and (sequence <= last[0])):
+                with self.client_lock:
+                    future = self.client_futures.pop(id_num, None)
+                if (future is not None):
+                    future.set_result(last[1] if (sequence == last[0]) else None)
+                elif (appending):
+                    kept.append(entry)
+            elif ((appended is not None) and (sequence <= appended[0])):
+                if ((sequence, id_num) == appended):
+                    continue
+                with self.client_lock:
+                    future = self.client_futures.pop(id_num, None)
+                if (future is not None):
+                    future.set_exception(SupersededRequest('sequence ' + str(sequence) + ' of session ' + str(client_id) + ' was superseded by sequence ' + str(appended[0])))
+                else:
+                    kept.append(entry)
+            else:
+                if (appending):
+                    self._sessions_appended[client_id] = (sequence, id_num)
+                    self._sessions_appended.move_to_end(client_id)
+                    if (len(self._sessions_appended) > self.max_sessions):
+                        self._sessions_appended.popitem(last=False)
+                kept.append(entry)
+        return kept
+
+    def _take_snapshot(self):
+        '''
+            _take_snapshot: Snapshots the key value store at the last applied 
+                index, then drops everything up to that index from the log and
+                from committed_logs. log[0] becomes a placeholder holding the
+                term of the last entry in the snapshot.
+        '''
+        index = self.last_applied_index
+        term = self.last_applied_term
+
+        self.storage.flush()
+        self.storage.compact(index, term)
+        with self.client_lock:
+            self.log.compact(index - self.snapshot_index, {'term': term, 'entry': 'Snapshot', 'id': -1})
+            self.snapshot_index = index
+            self.snapshot_term = term
+
+        if (self.verbose):
+            print(self._name + ': compacted log up to ' + str(index))
 
-    def _broadcast_append_entries(self, entry):
+    def _install_snapshot(self, index, term, items):
         '''
-            _broadcast_append_entries: Should be called only by the leader. 
-                Sends an append entries message to all nodes for the given 
-                entry.
+            _install_snapshot: Replaces your state with a snapshot from the 
+                leader. If your log has the snapshot's last entry, the entries
+                after it are kept, otherwise the whole log is discarded.
             Inputs:
-                entry: (dict with the attributes 'term' and 'entry') 
-                    Entry to append to all nodes.    
+                index: (int)
+                    Index of the last entry covered by the snapshot.
+                term: (int)
+                    Term of the last entry covered by the snapshot.
+                items: (list)
+                    Rows of the leader's key value store, see 
+                    KVStorage.get_snapshot.
         '''
-        # Append the new entry 
-        prev_index, prev_term = self._append_entry(entry, commit=False)
+        # You've already applied past this snapshot
+        if (index <= self.last_applied_index):
+            return
+
+        self.storage.flush()
+        self.storage.install_snapshot(index, term, items)
+        with self.client_lock:
+            if ((index <= self._log_max_index()) and (self._log_term(index) == term)):
+                self.log.compact(index - self.snapshot_index, {'term': term, 'entry': 'Snapshot', 'id': -1})
+            else:
+                self.log = CompactLog([{'term': term, 'entry': 'Snapshot', 'id': -1}])
+            self.snapshot_index = index
+            self.snapshot_term = term
+            self.commit_index = index
+        self.last_applied_index = index
+        self.last_applied_term = term
+        self.sessions = OrderedDict()
+        self._apply_config(*self._get_latest_config())
 
-        # Send out other append entries
-        for node, index in enumerate(self.next_index):
-            # Only send out append entries to nodes that are up-to-date. Also they will now be out of date so update next. 
-            if (index is None):
-                self._send_append_entries(prev_index, prev_term, entry, self.all_ids[node])
-                self.next_index[node] = self._log_max_index()
+        if (self.verbose):
+            print(self._name + ': installed snapshot up to ' + str(index))
+
+    def _receive_snapshot_chunk(self, message):
+        '''
+            _receive_snapshot_chunk: Buffers a chunk of the leader's snapshot
+                and acknowledges with the offset you expect next. Once the
+                last chunk arrives, installs the snapshot.
+            Inputs:
+                message: (InstallSnapshotMessage)
+        '''
+        if (message.offset == 0):
+            self._snapshot_chunks = []
+            self._snapshot_received = 0
+
+        # Out of order chunk, ask for the one you're missing
+        if (message.offset != self._snapshot_received):
+            self._send_snapshot_acknowledge(message.leader_id, True, self._snapshot_received)
+            return
+
+        self._snapshot_chunks.append(message.data)
+        self._snapshot_received += len(message.data)
+        if (not message.done):
+            self._send_snapshot_acknowledge(message.leader_id, True, self._snapshot_received)
+            return
+
+        items = json.loads(''.join(self._snapshot_chunks))
+        self._snapshot_chunks = []
+        self._install_snapshot(message.last_included_index, message.last_included_term, items)
+        if (message.term != self._verified_term):
+            self._verified_term = message.term
+            self._verified_index = 0
+        self._verified_index = max(self._verified_index, message.last_included_index)
+        self._send_snapshot_acknowledge(message.leader_id, True, self._snapshot_received, match_index=message.last_included_index)
+
+    def _broadcast_append_entries(self, entries):
+        '''
+            _broadcast_append_entries: Should be called only by the leader. 
+                Appends a batch of entries and sends a single append entries
+                message containing the whole batch to every node with room in
+                its in flight window. The entries go in under your term, 
+                whatever term the node that took the request stamped them
+                with.
+            Inputs:
+                entries: (list of dicts with the attributes 'term', 'entry' and 'id') 
+                    Entries to append to all nodes.    
+        '''
+        # Append the new entries. Requests queued or forwarded during an election carry an older term, and an entry
+        # has to carry the term it was appended in or two logs can match on index and term but hold different entries
+        for entry in entries:
+            entry['term'] = self.current_term
+        self._append_entries(entries, commit=False)
 
         # Update your own information
-        self.next_index[self._get_node_index(self.my_id)] =  None
+        self.next_index[self._get_node_index(self.my_id)] = self._log_max_index() + 1
         self.match_index[self._get_node_index(self.my_id)] = self._log_max_index()
 
+        # Send out other append entries, nodes with a full window will pick these up as their acks arrive
+        for node in range(self.current_num_nodes):
+            self._replicate(node)
+
+    def _receive_acknowledge(self, message):
+        '''
+            _receive_acknowledge: Should be called only by the leader. Handles
+                a node's reply to an append entries: retires what it
+                acknowledged and commits what a majority has, or falls back to
+                probing if it rejected the oldest append entries in flight.
+                Then sends it whatever fits in its window.
+            Inputs:
+                message: (AppendEntriesMessage)
+                    The acknowledge.
+        '''
+        # An ack from another term is about a log that may have changed since, it can't move match_index
+        if (message.results.term != self.current_term):
+            return
+
+        sender_index = self._get_node_index(message.sender)
+        self.heard_from[sender_index] = time.time()
+        self.replied_at[sender_index] = self.heard_from[sender_index]
+
+        in_flight = self.in_flight[sender_index]
+
+        # If the append entries was successful, then move match index past everything the node has and retire the acknowledged append entries
+        if (message.results.success):
+            match_index = message.results.match_index
+            self.match_index[sender_index] = max(self.match_index[sender_index], match_index)
+            self.next_index[sender_index] = max(self.next_index[sender_index], match_index + 1)
+            while (in_flight and (in_flight[0][1] <= match_index)):
+                in_flight.popleft()
+            self.probing[sender_index] = False
+
+        # Otherwise, if this rejects the oldest append entries in flight, fall back to probing from where the node says the conflict starts. Rejections of later append entries are stale.
+        elif (in_flight and (in_flight[0][0] == message.prev_log_index + 1)):
+            in_flight.clear()
+            self.probing[sender_index] = True
+            self.next_index[sender_index] = self._get_conflict_next_index(message.prev_log_index, message.results.conflict_term, message.results.conflict_index)
+
+        # Are there more entries to send to bring this node up to date?
+        self._replicate(sender_index)
+
+        if (message.results.success):
+            if (self.verbose):
+                print(self._name + ": updated standing is " + str(self.match_index) + " my index: " + str(self._log_max_index()))
+
+            # If there's a new committable index, then send the commit
+            max_committable_index = self._get_committable_index()
+            if (max_committable_index > self.commit_index):
+                self._broadcast_commmit_entries(max_committable_index)
+
+    def _resend_lost(self):
+        '''
+            _resend_lost: Should be called only by the leader. Assumes the 
+                append entries or snapshot chunk in flight to a node you
+                haven't heard from in resend_time were lost, and sends them
+                again starting from the oldest one.
+        '''
+        for node, in_flight in enumerate(self.in_flight):
+            if ((time.time() - self.heard_from[node]) > self.resend_time):
+                if (self.snapshot_transfer[node] is not None):
+                    self._send_snapshot_chunk(node)
+                    self.heard_from[node] = time.time()
+                elif (in_flight):
+                    self.next_index[node] = in_flight[0][0]
+                    in_flight.clear()
+                    self._replicate(node)
+                    self.heard_from[node] = time.time()
+
+    def _replicate(self, node):
+        '''
+            _replicate: Should be called only by the leader. Sends append 
+                entries to a node until its in flight window is full or it has
+                been sent the whole log. While probing for a matching log
+                index the window is a single append entries.
+            Inputs:
+                node: (int)
+                    Index of the node to send to.
+        '''
+        if ((self.all_ids[node] == self.my_id) or (self.snapshot_transfer[node] is not None)):
+            return
+
+        # The entries this node needs have been compacted, send it the snapshot instead
+        if (self.next_index[node] <= self.snapshot_index):
+            index, term, data = self._get_snapshot_data()
+            self.snapshot_transfer[node] = {'index': index, 'term': term, 'data': data, 'offset': 0}
+            self.in_flight[node].clear()
+            self._send_snapshot_chunk(node)
+            return
+
+        window = 1 if self.probing[node] else self.pipeline_depth
+        while ((len(self.in_flight[node]) < window) and (self.next_index[node] <= self._log_max_index())):
+            first_index = self.next_index[node]
+            entries = self._get_log_batch(first_index)
+            self._send_append_entries(first_index - 1, self._log_term(first_index - 1), entries, self.all_ids[node])
+            self.next_index[node] = first_index + len(entries)
+            self.in_flight[node].append((first_index, self.next_index[node] - 1))
+
+    def _get_snapshot_data(self):
+        '''
+            _get_snapshot_data: Should be called only by the leader. Returns 
+                the index, term and serialized contents of the snapshot to
+                send to lagging nodes. The serialized snapshot is cached and
+                shared by every transfer until the log is compacted again.
+        '''
+        if ((self._snapshot_cache is None) or (self._snapshot_cache[0] < self.snapshot_index)):
+            self.storage.flush()
+            index, term, items = self.storage.get_snapshot()
+            self._snapshot_cache = (index, term, json.dumps(items))
+        return self._snapshot_cache
+
+    def _send_snapshot_chunk(self, node):
+        '''
+            _send_snapshot_chunk: Should be called only by the leader. Sends 
+                the chunk of the snapshot at the current transfer offset.
+            Inputs:
+                node: (int)
+                    Index of the node to send to.
+        '''
+        transfer = self.snapshot_transfer[node]
+        offset = transfer['offset']
+        data = transfer['data'][offset:offset + self.snapshot_chunk_size]
+        done = (offset + len(data) >= len(transfer['data']))
+        self._send_install_snapshot(transfer['index'], transfer['term'], offset, data, done, self.all_ids[node])
+
     def _broadcast_commmit_entries(self, index):
         '''
             _broadcast_commmit_entries: Should be called only by the leader. 
-                Sends a commit message to all nodes for the given index.
+                Commits up to the given index. Other nodes pick the new commit
+                index up from the next append entries or heartbeat, unless
+                send_committals is on.
             Inputs:
                 index: (int) 
                     Index to commit.          
         '''
         # Commit yourself
-        self._commit_entry(index, self.log[index]['term'])
+        self._commit_entry(index)
 
-        # Commit everybody else
-        for node, index in enumerate(self.match_index):
-            if (index >= index):
-                self._send_committal(index, self.all_ids[node])
+        # Commit everybody else, as far as they've replicated
+        if (self.send_committals):
+            for node, match_index in enumerate(self.match_index):
+                if ((self.all_ids[node] != self.my_id) and (match_index > 0)):
+                    self._send_committal(min(index, match_index), self.all_ids[node])
 
     def _send_request_vote(self, receiver=None):
         message = RequestVotesMessage(
@@ -712,6 +1962,14 @@ class RaftNode(threading.Thread):
         self.voted_for = candidate
 
     def _send_heartbeat(self):
+        # Ask nodes to confirm your leadership if there are reads waiting on it or you're keeping a lease
+        read_round = None
+        if ((self._read_round_reads is not None) or self.lease_reads):
+            self._read_round += 1
+            read_round = self._read_round
+            self._read_round_sent[read_round] = time.time()
+            self._read_round_sent.pop(read_round - 64, None)
+
         message = AppendEntriesMessage(
             type_ = MessageType.Heartbeat,
             term = self.current_term,
@@ -722,7 +1980,28 @@ class RaftNode(threading.Thread):
             prev_log_index = None,
             prev_log_term = None,
             entries = None,
-            leader_commit = self.commit_index
+            leader_commit = self.commit_index,
+            read_round = read_round
+        )
+        self._send_message(message)
+
+    def _send_heartbeat_acknowledge(self, receiver, read_round):
+        message = AppendEntriesMessage(
+            type_ = MessageType.Heartbeat,
+            term = self.current_term,
+            sender = self.my_id,
+            receiver = receiver,
+            direction = MessageDirection.Response,
+            leader_id = self.leader_id,
+            prev_log_index = None,
+            prev_log_term = None,
+            entries = None,
+            leader_commit = self.commit_index,
+            read_round = read_round,
+            results = AppendEntriesResults(
+                term = self.current_term,
+                success = True
+            )
         )
         self._send_message(message)
 
@@ -749,14 +2028,14 @@ class RaftNode(threading.Thread):
             receiver = receiver,
             direction = MessageDirection.Request,
             leader_id = self.my_id,
-            prev_log_index = self.last_applied_index,
+            prev_log_index = index,
             prev_log_term = self.last_applied_term,
             entries = None,
             leader_commit = self.commit_index
         )
         self._send_message(message)
 
-    def _send_acknowledge(self, receiver, success, entry=None):
+    def _send_acknowledge(self, receiver, success, entry=None, prev_index=None, match_index=None, conflict_term=None, conflict_index=None):
         message = AppendEntriesMessage(
             type_ = MessageType.Acknowledge,
             term = self.current_term,
@@ -764,18 +2043,58 @@ class RaftNode(threading.Thread):
             receiver = receiver,
             direction = MessageDirection.Response,
             leader_id =self.leader_id ,
-            prev_log_index = self.last_applied_index,
+            prev_log_index = prev_index,
             prev_log_term = self.last_applied_term,
             entries = entry,
             leader_commit = self.commit_index, 
             results = AppendEntriesResults(
                 term = self.current_term,
-                success = success
+                success = success,
+                match_index = match_index,
+                conflict_term = conflict_term,
+                conflict_index = conflict_index
             ) 
         )
         self._send_message(message)
 
-    def _send_client_request(self, receiver, entry):
+    def _send_install_snapshot(self, index, term, offset, data, done, receiver):
+        message = InstallSnapshotMessage(
+            type_ = MessageType.InstallSnapshot,
+            term = self.current_term,
+            sender = self.my_id,
+            receiver = receiver,
+            direction = MessageDirection.Request,
+            leader_id = self.my_id,
+            last_included_index = index,
+            last_included_term = term,
+            offset = offset,
+            data = data,
+            done = done
+        )
+        self._send_message(message)
+
+    def _send_snapshot_acknowledge(self, receiver, success, offset, match_index=None):
+        message = InstallSnapshotMessage(
+            type_ = MessageType.InstallSnapshot,
+            term = self.current_term,
+            sender = self.my_id,
+            receiver = receiver,
+            direction = MessageDirection.Response,
+            leader_id = self.leader_id,
+            last_included_index = self.snapshot_index,
+            last_included_term = self.snapshot_term,
+            offset = offset,
+            data = None,
+            done = (match_index is not None),
+            results = AppendEntriesResults(
+                term = self.current_term,
+                success = success,
+                match_index = match_index
+            )
+        )
+        self._send_message(message)
+
+    def _send_client_request(self, receiver, entries):
         message = AppendEntriesMessage(
             type_ = MessageType.ClientRequest,
             term = self.current_term,
@@ -785,7 +2104,7 @@ class RaftNode(threading.Thread):
             leader_id =self.leader_id ,
             prev_log_index = self.last_applied_index,
             prev_log_term = self.last_applied_term,
-            entries = entry,
+            entries = entries,
             leader_commit = self.commit_index
         )
         self._send_message(message)
@@ -1,16 +1,49 @@
 # storage.py
 import sqlite3
 import json
+import copy
 import threading
+from queue import Queue, LifoQueue, Empty
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote
 
 
 class KVStorage:
-    def __init__(self, db_file):
+    def __init__(self, db_file, journal_mode='WAL', synchronous='NORMAL', group_commit=False, concurrent_reads=True,
+                 max_readers=8):
+        """
+        journal_mode: SQLite journal mode, WAL lets readers run alongside the writer
+        synchronous: SQLite synchronous level (OFF, NORMAL, FULL, EXTRA), how often to fsync
+        group_commit: If True, commits are queued and written by a background thread
+            that coalesces everything pending into one transaction
+        concurrent_reads: If True, reads use a pool of read-only connections instead of
+            sharing the writer's connection and lock
+        max_readers: Most read-only connections to open, more concurrent reads wait for one
+        """
         self.db_file = db_file
         self.conn = sqlite3.connect(db_file, check_same_thread=False)
         self.lock = threading.Lock()
+        self.conn.execute(f'PRAGMA journal_mode={journal_mode}')
+        self.conn.execute(f'PRAGMA synchronous={synchronous}')
         self.create_tables()
 
+        # Pool of read-only connections, opened as needed up to max_readers
+        self.concurrent_reads = concurrent_reads
+        self.max_readers = max_readers
+        self._idle_conns = LifoQueue()
+        self._read_conns = []
+
+        # Background group commit
+        self.group_commit = group_commit
+        self._pending = Queue()
+        self._stop_event = threading.Event()
+        self._commit_thread = None
+        self.write_errors = 0           # Group commit batches that failed to be written
+        if group_commit:
+            self._commit_thread = threading.Thread(target=self._group_commit_loop, daemon=True)
+            self._commit_thread.start()
+
     def create_tables(self):
         with self.lock:
             cursor = self.conn.cursor()
@@ -20,9 +53,15 @@ class KVStorage:
                     id INTEGER PRIMARY KEY,
                     term INTEGER,
                     data TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    request_id TEXT
                 )
             ''')
+            # Databases from before request ids were stored need the column added
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(committed_logs)')]
+            if 'request_id' not in columns:
+                cursor.execute('ALTER TABLE committed_logs ADD COLUMN request_id TEXT')
+            cursor.execute('CREATE INDEX IF NOT EXISTS committed_logs_request_id ON committed_logs (request_id)')
             # Table for key-value pairs
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS key_value_store (
@@ -32,35 +71,125 @@ class KVStorage:
                     FOREIGN KEY (last_updated_index) REFERENCES committed_logs (id)
                 )
             ''')
+            # Single row describing the last entry covered by the snapshot
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS snapshot_meta (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    last_index INTEGER,
+                    last_term INTEGER
+                )
+            ''')
             self.conn.commit()
 
-    def commit_log(self, index, term, data):
+    def commit_log(self, index, term, data, request_id=None):
         """Commit a log entry to storage"""
+        return self.commit_logs([(index, term, data, request_id)])
+
+    def commit_logs(self, entries):
+        """
+        Commit a batch of (index, term, data) or (index, term, data, request_id) log entries to storage in one transaction.
+        A fifth element, a dict of key-value pairs, is written to the key-value store along with the entry.
+        """
+        if self.group_commit:
+            for entry in entries:
+                self._pending.put(entry)
+            return True
+        return self._write_logs(entries)
+
+    def _write_logs(self, entries):
+        """Write a batch of log entries and their key-value updates, then commit once"""
+        log_rows = []
+        kv_rows = []
+        try:
+            for entry in entries:
+                index, term, data = entry[:3]
+                request_id = json.dumps(entry[3]) if (len(entry) > 3) and (entry[3] is not None) else None
+                log_rows.append((index, term, json.dumps(data), request_id))
+
+                # If data contains key-value updates, store them
+                if isinstance(data, dict) and 'key' in data and 'value' in data:
+                    kv_rows.append((data['key'], json.dumps(data['value']), index))
+                if len(entry) > 4:
+                    kv_rows.extend((key, json.dumps(value), index) for key, value in entry[4].items())
+        except (TypeError, ValueError) as e:
+            print(f"Error encoding log: {e}")
+            return False
+
         with self.lock:
             cursor = self.conn.cursor()
             try:
-                cursor.execute('''
-                    INSERT INTO committed_logs (id, term, data)
+                # Replaying an index that is already stored overwrites it rather than failing the batch
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO committed_logs (id, term, data, request_id)
+                    VALUES (?, ?, ?, ?)
+                ''', log_rows)
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO key_value_store (key, value, last_updated_index)
                     VALUES (?, ?, ?)
-                ''', (index, term, json.dumps(data)))
-
-                # If data contains key-value updates, store them
-                if isinstance(data, dict) and 'key' in data and 'value' in data:
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO key_value_store (key, value, last_updated_index)
-                        VALUES (?, ?, ?)
-                    ''', (data['key'], json.dumps(data['value']), index))
+                ''', kv_rows)
 
                 self.conn.commit()
                 return True
             except sqlite3.Error as e:
+                self.conn.rollback()
                 print(f"Error committing log: {e}")
                 return False
 
+    def _group_commit_loop(self):
+        """Write everything that queued up while the previous transaction was running as one transaction"""
+        while not (self._stop_event.is_set() and self._pending.empty()):
+            try:
+                batch = [self._pending.get(timeout=0.1)]
+            except Empty:
+                continue
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except Empty:
+                    break
+            # Whatever goes wrong, the thread keeps running and flush doesn't wait forever on the batch
+            try:
+                if not self._write_logs(batch):
+                    self.write_errors += 1
+            except Exception as e:
+                self.write_errors += 1
+                print(f"Error in group commit: {e}")
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def flush(self):
+        """Block until every queued group commit has been written"""
+        if self.group_commit:
+            self._pending.join()
+
+    @contextmanager
+    def _reader(self):
+        """Connection to read from, doesn't wait on the writer when concurrent_reads is on"""
+        if not self.concurrent_reads:
+            with self.lock:
+                yield self.conn
+            return
+
+        try:
+            conn = self._idle_conns.get_nowait()
+        except Empty:
+            conn = None
+            with self.lock:
+                if len(self._read_conns) < self.max_readers:
+                    conn = sqlite3.connect(f'file:{quote(self.db_file)}?mode=ro', uri=True, check_same_thread=False)
+                    self._read_conns.append(conn)
+            if conn is None:
+                conn = self._idle_conns.get()
+        try:
+            yield conn
+        finally:
+            self._idle_conns.put(conn)
+
     def get_value(self, key):
         """Get value for a key from storage"""
-        with self.lock:
-            cursor = self.conn.cursor()
+        with self._reader() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
                 SELECT value FROM key_value_store WHERE key = ?
             ''', (key,))
@@ -68,20 +197,38 @@ class KVStorage:
             return json.loads(row[0]) if row else None
 
     def get_last_committed_index(self):
-        """Get the index of the last committed log"""
-        with self.lock:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT MAX(id) FROM committed_logs')
+        """Get the index of the last committed log, counting logs compacted into the snapshot"""
+        with self._reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT MAX(last_index) FROM (
+                    SELECT MAX(id) AS last_index FROM committed_logs
+                    UNION ALL
+                    SELECT last_index FROM snapshot_meta
+                )
+            ''')
             result = cursor.fetchone()
             return result[0] if result[0] is not None else 0
 
+    def get_entry_by_request_id(self, request_id):
+        """Get the data of the latest committed log entry with a request id, None if there isn't one"""
+        with self._reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT data FROM committed_logs
+                WHERE request_id = ?
+                ORDER BY id DESC LIMIT 1
+            ''', (json.dumps(request_id),))
+            row = cursor.fetchone()
+            return json.loads(row[0]) if row else None
+
     def get_log_entry(self, index):
         """Get a specific log entry by index"""
-        with self.lock:
-            cursor = self.conn.cursor()
+        with self._reader() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
                 SELECT term, data FROM committed_logs 
-                WHERE index = ?
+                WHERE id = ?
             ''', (index,))
             row = cursor.fetchone()
             if row:
@@ -91,7 +238,198 @@ class KVStorage:
                 }
             return None
 
+    def get_snapshot_meta(self):
+        """Get the (index, term) of the last entry covered by the snapshot, (0, None) if there is none"""
+        with self._reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT last_index, last_term FROM snapshot_meta WHERE id = 0')
+            row = cursor.fetchone()
+            return (row[0], row[1]) if row else (0, None)
+
+    def get_snapshot(self):
+        """
+        Get a consistent snapshot of the key-value store as (index, term, items),
+        where index and term are the last committed log it includes and items is a
+        list of [key, value, last_updated_index] rows with values still JSON encoded
+        """
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT id, term FROM committed_logs ORDER BY id DESC LIMIT 1')
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute('SELECT last_index, last_term FROM snapshot_meta WHERE id = 0')
+                row = cursor.fetchone() or (0, None)
+            cursor.execute('SELECT key, value, last_updated_index FROM key_value_store')
+            items = [list(item) for item in cursor.fetchall()]
+            return row[0], row[1], items
+
+    def compact(self, index, term):
+        """Record a snapshot at index and drop the committed logs it covers"""
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO snapshot_meta (id, last_index, last_term)
+                    VALUES (0, ?, ?)
+                ''', (index, term))
+                cursor.execute('DELETE FROM committed_logs WHERE id <= ?', (index,))
+                self.conn.commit()
+                return True
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                print(f"Error compacting logs: {e}")
+                return False
+
+    def install_snapshot(self, index, term, items):
+        """Replace the key-value store with a snapshot from get_snapshot and drop the committed logs it covers"""
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('DELETE FROM key_value_store')
+                cursor.executemany('''
+                    INSERT INTO key_value_store (key, value, last_updated_index)
+                    VALUES (?, ?, ?)
+                ''', items)
+                cursor.execute('''
+                    INSERT OR REPLACE INTO snapshot_meta (id, last_index, last_term)
+                    VALUES (0, ?, ?)
+                ''', (index, term))
+                cursor.execute('DELETE FROM committed_logs WHERE id <= ?', (index,))
+                self.conn.commit()
+                return True
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                print(f"Error installing snapshot: {e}")
+                return False
+
     def close(self):
-        """Close the database connection"""
+        """Close the database connections"""
+        if self._commit_thread is not None:
+            self._stop_event.set()
+            self._commit_thread.join()
         with self.lock:
-            self.conn.close()
\ No newline at end of file
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns = []
+            self.conn.close()
+
+
+class CachedKVStorage(KVStorage):
+    """
+    KVStorage with a size-bounded LRU cache of decoded values in front of get_value.
+    Committed writes update cached keys once they are in the database, so a cached
+    value is never older than the last_updated_index the database had when it was read.
+    get_value returns a copy of dicts and lists, so callers can't change what's cached.
+    """
+    def __init__(self, db_file, max_cache_entries=10000, max_cache_bytes=16 * 1024 * 1024, **kwargs):
+        """
+        max_cache_entries: Max number of keys to keep cached
+        max_cache_bytes: Max (approximate) size of the cached keys and JSON encoded values
+        Other arguments are passed to KVStorage
+        """
+        self.max_cache_entries = max_cache_entries
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = OrderedDict()     # key -> (value, last_updated_index, size), least recently used first
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        self._misses_reading = {}       # key -> number of misses reading it from the database right now
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        super().__init__(db_file, **kwargs)
+
+    def get_value(self, key):
+        """Get value for a key, from the cache if it's there"""
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._copy(cached[0])
+            self.misses += 1
+            self._misses_reading[key] = self._misses_reading.get(key, 0) + 1
+
+        # Misses read without the cache lock so hits don't wait on them. A commit to the key in the meantime
+        # caches its value (see _write_logs), and the newer of the two is kept
+        row = None
+        try:
+            with self._reader() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT value, last_updated_index FROM key_value_store WHERE key = ?
+                ''', (key,))
+                row = cursor.fetchone()
+            value = json.loads(row[0]) if row else None
+        finally:
+            with self._cache_lock:
+                self._misses_reading[key] -= 1
+                if self._misses_reading[key] == 0:
+                    del self._misses_reading[key]
+                if row is not None:
+                    cached = self._cache.get(key)
+                    if (cached is None) or (cached[1] < row[1]):
+                        self._cache_put(key, value, row[1], len(str(key)) + len(row[0]))
+                    else:
+                        value = cached[0]
+        return self._copy(value)
+
+    def cache_stats(self):
+        """Get the cache hit, miss and eviction counters and its current size"""
+        with self._cache_lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._cache),
+                'bytes': self._cache_bytes
+            }
+
+    def _write_logs(self, entries):
+        """Write the batch, then bring any cached keys it touched up to date"""
+        success = super()._write_logs(entries)
+        with self._cache_lock:
+            for entry in entries:
+                index, data = entry[0], entry[2]
+                updates = list(entry[4].items()) if len(entry) > 4 else []
+                if isinstance(data, dict) and 'key' in data and 'value' in data:
+                    updates.append((data['key'], data['value']))
+                for key, value in updates:
+                    cached = self._cache.get(key)
+                    if (cached is None) and (key not in self._misses_reading):
+                        continue
+                    if not success:
+                        self._cache_pop(key)
+                    elif (cached is None) or (index >= cached[1]):
+                        self._cache_put(key, value, index, len(str(key)) + len(json.dumps(value)))
+        return success
+
+    def install_snapshot(self, index, term, items):
+        """Install the snapshot and drop everything cached"""
+        success = super().install_snapshot(index, term, items)
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+        return success
+
+    @staticmethod
+    def _copy(value):
+        """Copy of a cached value that's safe to hand out"""
+        return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+    def _cache_put(self, key, value, index, size):
+        """Insert or replace a key, then evict least recently used keys until the cache fits. Call with the cache lock held"""
+        self._cache_pop(key)
+        if size > self.max_cache_bytes:
+            return
+        self._cache[key] = (value, index, size)
+        self._cache_bytes += size
+        while len(self._cache) > self.max_cache_entries or self._cache_bytes > self.max_cache_bytes:
+            _, (_, _, evicted_size) = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted_size
+            self.evictions += 1
+
+    def _cache_pop(self, key):
+        """Remove a key if it's cached. Call with the cache lock held"""
+        cached = self._cache.pop(key, None)
+        if cached is not None:
+            self._cache_bytes -= cached[2]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import pytest
+
+from raft.codec import BinaryCodec, JsonCodec, get_codec
+from raft.log import CompactLog, PackedEntries
+from raft.protocol import MessageType, MessageDirection, RequestVotesMessage, RequestVotesResults, \
+    AppendEntriesMessage, AppendEntriesResults, InstallSnapshotMessage, parse_json_message
+
+nodes = ['127.0.0.1:5557', '127.0.0.1:5558', '127.0.0.1:5559']
+
+
+def round_trip(message):
+    codec = BinaryCodec(nodes)
+    return codec.decode(codec.encode(message.jsonify()))
+
+
+def test_append_entries_round_trip():
+    """Entries, ids, sessions and the None fields all come back as sent"""
+    entries = [{'term': 3, 'entry': {'key': 'k', 'value': [1, 2]}, 'id': 'abc'},
+               {'term': 3, 'entry': 'x', 'id': ['c1', 4], 'session': ['c1', 4]}]
+    message = AppendEntriesMessage(type_=MessageType.AppendEntries, term=3, sender=nodes[0], receiver=nodes[2],
+                                   direction=MessageDirection.Request, leader_id=nodes[0], prev_log_index=10,
+                                   prev_log_term=2, entries=entries, leader_commit=9)
+    decoded = round_trip(message)
+    assert decoded['entries'][0] == entries[0]
+    assert decoded['entries'][1]['id'] == ('c1', 4)
+    assert dict(decoded, entries=None) == dict(message.jsonify(), entries=None)
+    assert parse_json_message(decoded).prev_log_index == 10
+
+
+def test_packed_entries_stay_packed():
+    """Entries sliced out of a log reach the other log as payloads, json still sends them as dicts"""
+    log = CompactLog([{'term': 1, 'entry': {'key': i}, 'id': i} for i in range(4)])
+    message = AppendEntriesMessage(type_=MessageType.AppendEntries, term=1, sender=nodes[0], receiver=nodes[1],
+                                   direction=MessageDirection.Request, leader_id=nodes[0], prev_log_index=0,
+                                   prev_log_term=1, entries=log.packed(1, 4), leader_commit=0)
+    parsed = parse_json_message(round_trip(message))
+    assert isinstance(parsed.entries, PackedEntries)
+    assert parsed.entries.payloads == [log.raw(i) for i in range(1, 4)]
+    assert JsonCodec().decode(JsonCodec().encode(message.jsonify()))['entries'] == log[1:4]
+    assert (parsed.results.success is None) and (not hasattr(parsed, '__dict__'))
+
+
+def test_vote_and_snapshot_round_trip():
+    """Bools, results and snapshot data survive, unknown addresses are sent inline"""
+    vote = RequestVotesMessage(type_=MessageType.RequestVotes, term=5, sender=nodes[1], receiver='10.0.0.9:6000',
+                               direction=MessageDirection.Response, candidate_id='10.0.0.9:6000', last_log_index=7,
+                               last_log_term=4, results=RequestVotesResults(term=5, vote_granted=False))
+    assert round_trip(vote) == vote.jsonify()
+
+    snapshot = InstallSnapshotMessage(type_=MessageType.InstallSnapshot, term=2, sender=nodes[0], receiver=nodes[1],
+                                      direction=MessageDirection.Request, leader_id=nodes[0], last_included_index=100,
+                                      last_included_term=2, offset=0, data='[["k", 1]]', done=True)
+    snapshot._group = 'g1'
+    assert round_trip(snapshot) == snapshot.jsonify()
+
+
+def test_heartbeat_is_smaller():
+    """A heartbeat is a fraction of its json size"""
+    heartbeat = AppendEntriesMessage(type_=MessageType.Heartbeat, term=3, sender=nodes[0], receiver=None,
+                                     direction=MessageDirection.Request, leader_id=nodes[0], leader_commit=12,
+                                     read_round=4, results=AppendEntriesResults())
+    frame = BinaryCodec(nodes).encode(heartbeat.jsonify())
+    assert len(frame) * 4 < len(JsonCodec().encode(heartbeat.jsonify()))
+    assert round_trip(heartbeat) == heartbeat.jsonify()
+
+
+def test_batches_json_and_node_tables():
+    """Batches unpack, json frames still decode, frames from another node table are rejected"""
+    codec = get_codec('binary', reversed(nodes))
+    heartbeat = AppendEntriesMessage(type_=MessageType.Heartbeat, term=1, sender=nodes[0], receiver=nodes[1],
+                                     direction=MessageDirection.Request, leader_id=nodes[0], leader_commit=0)
+    batch = {'receiver': nodes[1], 'batch': [heartbeat.jsonify(), heartbeat.jsonify()]}
+    assert codec.decode(codec.encode(batch)) == batch
+    assert codec.decode(codec.encode(dict(batch, receiver=None))) == dict(batch, receiver=None)
+    assert codec.decode(JsonCodec().encode(heartbeat.jsonify())) == heartbeat.jsonify()
+    with pytest.raises(ValueError):
+        BinaryCodec(nodes[:2]).decode(codec.encode(heartbeat.jsonify()))
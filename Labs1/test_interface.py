@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+from raft.codec import BinaryCodec
+from raft import interface
+from raft.interface import Talker, recv_frame
+
+nodes = ['127.0.0.1:5557', '127.0.0.1:5558', '127.0.0.1:5559']
+
+
+class FrameSocket(object):
+    def __init__(self, frame):
+        self.frame = frame
+
+    def recv(self, flags):
+        return self.frame
+
+
+class RecordingSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, parts):
+        self.sent.append(parts)
+
+
+def make_message(receiver, i):
+    return {'type': 2, 'term': 1, 'timestamp': 0, 'sender': nodes[0], 'receiver': receiver, 'direction': 0,
+            'results': {}, 'group': None, 'leader_id': nodes[0], 'prev_log_index': None, 'prev_log_term': None,
+            'entries': None, 'leader_commit': i, 'read_round': None}
+
+
+def test_talker_coalesces_per_receiver():
+    """Queued messages go out as one frame per receiver, in order, and a size cap splits them"""
+    codec = BinaryCodec(nodes)
+    talker = Talker(identity={'my_id': nodes[0]}, directed=True, codec=codec)
+    talker.max_frame_delay = 0.2
+    for i in range(1, 5):
+        talker.send_message(make_message(nodes[1] if (i % 2) else None, i))
+    socket = RecordingSocket()
+    talker._send_coalesced(socket, make_message(nodes[1], 0))
+
+    assert [topic for topic, _ in socket.sent] == [nodes[1].encode() + b' ', b'* ']
+    batch = codec.decode(socket.sent[0][1])
+    assert [msg['leader_commit'] for msg in batch['batch']] == [0, 1, 3]
+    assert [msg['leader_commit'] for msg in codec.decode(socket.sent[1][1])['batch']] == [2, 4]
+
+    talker.max_frame_bytes = 1
+    talker.send_message(make_message(nodes[2], 6))
+    socket = RecordingSocket()
+    talker._send_coalesced(socket, make_message(nodes[2], 5))
+    assert codec.decode(socket.sent[0][1])['leader_commit'] == 5
+
+
+def test_recv_frame_drops_bad_frames(capsys):
+    """Truncated and garbled frames are dropped, frames from another node table are reported too"""
+    codec = BinaryCodec(nodes)
+    frame = codec.encode(make_message(nodes[1], 7))
+    assert recv_frame(FrameSocket(frame), nodes[1], False, codec)[0]['leader_commit'] == 7
+    for bad in [frame[:6], frame[:-1], b'\xb1', b'{"type": 2}', b'{']:
+        assert recv_frame(FrameSocket(bad), nodes[1], False, codec) == []
+    assert capsys.readouterr().out == ''
+
+    interface.mismatched_frames = 0
+    assert recv_frame(FrameSocket(BinaryCodec(nodes[:2]).encode(make_message(nodes[1], 7))), nodes[1], False, codec) == []
+    assert 'node table' in capsys.readouterr().out
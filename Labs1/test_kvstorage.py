@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+from storage import KVStorage, CachedKVStorage
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+def test_commit_logs_batch(tmp_path):
+    """A batch is written in one call and the latest value for each key wins"""
+    storage = KVStorage(str(tmp_path / 'kv.db'))
+    entries = [(1, 1, {'key': 'a', 'value': 1}),
+               (2, 1, {'key': 'b', 'value': 2}),
+               (3, 2, {'key': 'a', 'value': 3})]
+    assert storage.commit_logs(entries)
+    assert storage.get_value('a') == 3
+    assert storage.get_value('b') == 2
+    assert storage.get_last_committed_index() == 3
+    storage.close()
+
+
+def test_commit_logs_replay(tmp_path):
+    """Committing an index that is already stored doesn't fail the batch"""
+    storage = KVStorage(str(tmp_path / 'kv.db'))
+    storage.commit_log(1, 1, {'key': 'a', 'value': 1})
+    assert storage.commit_logs([(1, 1, {'key': 'a', 'value': 1}), (2, 1, {'key': 'a', 'value': 2})])
+    assert storage.get_value('a') == 2
+    storage.close()
+
+
+def test_group_commit_flush(tmp_path):
+    """Queued group commits are visible after flush and survive a reopen"""
+    db_file = str(tmp_path / 'kv.db')
+    storage = KVStorage(db_file, synchronous='FULL', group_commit=True)
+    for i in range(1, 101):
+        storage.commit_log(i, 1, {'key': 'k', 'value': i})
+    storage.flush()
+    assert storage.get_value('k') == 100
+    storage.close()
+
+    storage = KVStorage(db_file)
+    assert storage.get_last_committed_index() == 100
+    storage.close()
+
+
+def test_concurrent_reads(tmp_path):
+    """Reads from other threads see committed data, short lived threads share a bounded pool of connections"""
+    storage = KVStorage(str(tmp_path / 'kv.db'), max_readers=2)
+    storage.commit_logs([(1, 1, {'key': 'a', 'value': 'x'}), (2, 3, 'no key')])
+    results = []
+    def reader():
+        results.append((storage.get_value('a'), storage.get_log_entry(2), storage.get_last_committed_index()))
+    threads = [threading.Thread(target=reader) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [('x', {'term': 3, 'data': 'no key'}, 2)] * 16
+    assert 1 <= len(storage._read_conns) <= 2
+    storage.close()
+
+
+def test_compact_and_install_snapshot(tmp_path):
+    """A compacted store keeps its state and index, and another store can install its snapshot"""
+    leader = KVStorage(str(tmp_path / 'leader.db'))
+    leader.commit_logs([(i, 1, {'key': f'k{i % 3}', 'value': i}) for i in range(1, 11)])
+    assert leader.compact(10, 1)
+    assert leader.get_last_committed_index() == 10
+    assert leader.get_snapshot_meta() == (10, 1)
+
+    index, term, items = leader.get_snapshot()
+    assert (index, term, len(items)) == (10, 1, 3)
+
+    follower = KVStorage(str(tmp_path / 'follower.db'))
+    follower.commit_logs([(1, 1, {'key': 'stale', 'value': 0})])
+    assert follower.install_snapshot(index, term, items)
+    assert follower.get_value('stale') is None
+    assert follower.get_value('k1') == 10
+    assert follower.get_last_committed_index() == 10
+    leader.close()
+    follower.close()
+
+
+def test_cache_hits_and_commit_updates(tmp_path):
+    """Repeat reads hit the cache and commits update cached keys"""
+    storage = CachedKVStorage(str(tmp_path / 'kv.db'))
+    storage.commit_log(1, 1, {'key': 'a', 'value': {'n': 1}})
+    assert storage.get_value('a') == {'n': 1}
+    assert storage.get_value('a') == {'n': 1}
+    storage.commit_log(2, 1, {'key': 'a', 'value': {'n': 2}})
+    assert storage.get_value('a') == {'n': 2}
+    stats = storage.cache_stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+    storage.close()
+
+
+def test_cache_eviction(tmp_path):
+    """The least recently used keys are evicted once the cache is over its entry limit"""
+    storage = CachedKVStorage(str(tmp_path / 'kv.db'), max_cache_entries=2)
+    storage.commit_logs([(i, 1, {'key': f'k{i}', 'value': i}) for i in range(1, 4)])
+    storage.get_value('k1')
+    storage.get_value('k2')
+    storage.get_value('k1')
+    storage.get_value('k3')
+    assert storage.cache_stats()['evictions'] == 1
+    storage.get_value('k1')
+    storage.get_value('k2')
+    assert storage.cache_stats()['misses'] == 4
+    storage.close()
+
+
+def test_entry_by_request_id(tmp_path):
+    """Committed entries can be found by their request id, including from databases that predate the column"""
+    db_file = str(tmp_path / 'kv.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE committed_logs (id INTEGER PRIMARY KEY, term INTEGER, data TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)')
+    conn.execute('INSERT INTO committed_logs (id, term, data) VALUES (1, 1, \'"old"\')')
+    conn.commit()
+    conn.close()
+
+    storage = KVStorage(db_file)
+    storage.commit_logs([(2, 1, {'key': 'a', 'value': 1}, 'req-2'), (3, 1, 'x', ('client', 7))])
+    assert storage.get_entry_by_request_id('req-2') == {'key': 'a', 'value': 1}
+    assert storage.get_entry_by_request_id(('client', 7)) == 'x'
+    assert storage.get_entry_by_request_id('missing') is None
+    assert storage.get_log_entry(1)['data'] == 'old'
+    storage.close()
+
+
+def test_group_commit_survives_bad_entry(tmp_path):
+    """An entry that can't be encoded fails its batch without stopping group commit"""
+    storage = KVStorage(str(tmp_path / 'kv.db'), group_commit=True)
+    storage.commit_log(1, 1, {'key': 'a', 'value': object()})
+    storage.flush()
+    assert storage.write_errors == 1
+    storage.commit_log(2, 1, {'key': 'a', 'value': 2})
+    storage.flush()
+    assert storage.get_value('a') == 2
+    storage.close()
+
+
+def test_cache_miss_racing_a_commit(tmp_path):
+    """A commit landing while a miss reads the database isn't overwritten by the older value"""
+    class RacingStorage(CachedKVStorage):
+        race = False
+
+        @contextmanager
+        def _reader(self):
+            with super()._reader() as conn:
+                rows = conn.execute('SELECT value, last_updated_index FROM key_value_store').fetchall()
+                yield RowsConnection(rows)
+            if self.race:
+                self.race = False
+                self.commit_log(2, 1, {'key': 'a', 'value': {'n': 2}})
+
+    class RowsConnection(object):
+        def __init__(self, rows):
+            self.rows = rows
+
+        def cursor(self):
+            return self
+
+        def execute(self, query, params):
+            pass
+
+        def fetchone(self):
+            return self.rows[0] if self.rows else None
+
+    storage = RacingStorage(str(tmp_path / 'kv.db'))
+    storage.commit_log(1, 1, {'key': 'a', 'value': {'n': 1}})
+    storage.race = True
+    assert storage.get_value('a') == {'n': 2}
+    storage.get_value('a')['n'] = 3
+    assert storage.get_value('a') == {'n': 2}
+    assert storage.cache_stats()['hits'] == 2
+    storage.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import pytest
+
+from raft.log import CompactLog, PackedEntries
+
+
+def make_log(n):
+    return CompactLog([{'term': 1 + i // 3, 'entry': {'key': i, 'value': 'v%d' % i}, 'id': i} for i in range(n)])
+
+
+def test_entries_round_trip():
+    """Entries read back as the dicts that were appended"""
+    log = make_log(5)
+    assert len(log) == 5
+    assert log[4] == {'term': 2, 'entry': {'key': 4, 'value': 'v4'}, 'id': 4}
+    assert log[-1] == log[4]
+    assert [e['id'] for e in log[1:3]] == [1, 2]
+    assert [log.term(i) for i in range(5)] == [1, 1, 1, 2, 2]
+    with pytest.raises(IndexError):
+        log[5]
+
+
+def test_truncate_suffix():
+    """Deleting a suffix drops those entries and appends pick up where it was cut"""
+    log = make_log(6)
+    del log[2:]
+    assert [e['id'] for e in log] == [0, 1]
+    log.append({'term': 7, 'entry': 'x', 'id': 'x'})
+    assert (log[2]['entry'] == 'x') and (log.term(2) == 7)
+    with pytest.raises(TypeError):
+        del log[0]
+
+
+def test_compact_keeps_entries_after_position():
+    """Compacting replaces everything up to the position with a placeholder"""
+    log = make_log(6)
+    log.compact(3, {'term': 2, 'entry': 'Snapshot', 'id': -1})
+    assert [e['id'] for e in log] == [-1, 4, 5]
+    assert log[1]['entry'] == {'key': 4, 'value': 'v4'}
+    log.compact(2, {'term': 2, 'entry': 'Snapshot', 'id': -1})
+    assert len(log) == 1
+
+
+def test_tuple_ids_stay_hashable():
+    """Ids come back as tuples so they can still key the futures"""
+    log = CompactLog([{'term': 1, 'entry': None, 'id': ('client', 3)}])
+    assert log[0]['id'] == ('client', 3)
+
+
+def test_packed_entries():
+    """Packed slices move entries between logs without changing them"""
+    log = make_log(6)
+    packed = log.packed(2, 10)
+    assert (len(packed) == 4) and (packed.term(3) == 2)
+    assert packed[1:].terms == [2, 2, 2]
+    other = make_log(2)
+    other.extend(packed)
+    other.append({'term': 9, 'entry': 'y', 'id': 'y'})
+    assert list(other)[:6] == list(log)
+    assert other[6]['entry'] == 'y'
+
+
+def test_packed_entries_validate():
+    """Payloads that couldn't have come from pack_entry are caught before they reach a log"""
+    make_log(4).packed(0, 4).validate()
+    for payload in [b'', b'[1]', b'{"a": 1}', b'["x", 1] junk', b'["x", 1', b'\xff']:
+        with pytest.raises(ValueError):
+            PackedEntries([1, 1], [b'["ok", 1]', payload]).validate()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+from storage import KVStorage
+from raft.multi import HashPartitioner, RangePartitioner, MultiRaftHost
+
+
+def test_hash_partitioner_is_stable():
+    """Every key maps to one of the groups, the same one every time"""
+    partitioner = HashPartitioner(range(8))
+    groups = [partitioner.group_for('k%d' % i) for i in range(1000)]
+    assert groups == [HashPartitioner(range(8)).group_for('k%d' % i) for i in range(1000)]
+    assert set(groups) == set(range(8))
+
+
+def test_range_partitioner_boundaries():
+    """Keys below the first boundary go to the first group, boundaries belong to the group above them"""
+    partitioner = RangePartitioner(['g0', 'g1', 'g2'], ['m', 't'])
+    assert partitioner.group_for('a') == 'g0'
+    assert partitioner.group_for('m') == 'g1'
+    assert partitioner.group_for('s') == 'g1'
+    assert partitioner.group_for('z') == 'g2'
+
+
+def test_shared_subscription_outlives_one_group(tmp_path):
+    """A group dropping a host doesn't unsubscribe the groups still using it"""
+    class Listener(object):
+        def __init__(self):
+            self.disconnected = []
+
+        def disconnect(self, address):
+            self.disconnected.append(address)
+
+    config = {'h0': {'ip': '127.0.0.1', 'port': '7301'}, 'h1': {'ip': '127.0.0.1', 'port': '7302'}}
+    host = MultiRaftHost(config, 'h0', 2, storage_factory=lambda group: KVStorage(str(tmp_path / f'{group}.db')))
+    host.listener = Listener()
+    try:
+        host.nodes[0].listener.disconnect('127.0.0.1:7302')
+        assert host.listener.disconnected == []
+        host.nodes[1].listener.disconnect('127.0.0.1:7302')
+        assert host.listener.disconnected == ['127.0.0.1:7302']
+    finally:
+        for node in host.nodes.values():
+            node.storage.close()
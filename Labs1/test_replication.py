@@ -0,0 +1,826 @@
+#!/usr/bin/env python
+
+import json
+import threading
+import time
+from queue import Queue
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError
+
+from raft.raft import RaftNode, StaleRead, SupersededRequest, NotLeader, LeadershipLost
+from raft.log import CompactLog
+from raft.protocol import MessageType, MessageDirection, AppendEntriesMessage, AppendEntriesResults
+from storage import CachedKVStorage
+
+
+def make_node(terms):
+    """Build a RaftNode with the given log terms without starting its interface"""
+    node = RaftNode.__new__(RaftNode)
+    node.client_lock = threading.Lock()
+    node.log = CompactLog([{'term': 1, 'entry': 'Init Entry', 'id': -1}])
+    node.log.extend([{'term': t, 'entry': i, 'id': i} for i, t in enumerate(terms, 1)])
+    node.log_hash = OrderedDict()
+    node.snapshot_index = 0
+    node.snapshot_term = 1
+    node.sessions = OrderedDict()
+    node._sessions_appended = OrderedDict()
+    node.max_sessions = 10
+    return node
+
+
+def make_leader(terms, nodes=3):
+    """make_node as the leader of a cluster of nodes voters in its current term, recording what it sends"""
+    class Listener(object):
+        def wake(self):
+            pass
+
+    class Storage(object):
+        values = {'k': 'v'}
+
+        def flush(self):
+            pass
+
+        def get_value(self, key):
+            return self.values.get(key)
+
+    leader = make_node(terms)
+    leader._name = 'node0'
+    leader.verbose = False
+    leader.current_role = 'leader'
+    leader.current_term = leader.last_applied_term = terms[-1] if terms else 1
+    leader.commit_index = leader._log_max_index()
+    leader.my_id = leader.leader_id = 'h:0'
+    leader.all_ids = [f'h:{i}' for i in range(nodes)]
+    leader.current_num_nodes = nodes
+    leader.voters = [True] * nodes
+    leader.num_voters = nodes
+    leader.listener = Listener()
+    leader.storage = Storage()
+    leader.client_futures = {}
+    leader._client_deadlines = []
+    leader._client_wakeup = threading.Event()
+    leader.read_queue = Queue()
+    leader.config_queue = Queue()
+    leader._reads_waiting = []
+    leader._read_round = 0
+    leader._read_round_sent = {}
+    leader._read_round_start = 0
+    leader._read_round_reads = None
+    leader._read_round_acks = set()
+    leader.lease_reads = False
+    leader.lease_expiry = 0
+    leader._commit_entry = lambda index: None
+    leader.next_index = [leader._log_max_index() + 1] * nodes
+    leader.match_index = [0] * nodes
+    leader.in_flight = [deque() for _ in range(nodes)]
+    leader.probing = [False] * nodes
+    leader.snapshot_transfer = [None] * nodes
+    leader.heard_from = [time.time()] * nodes
+    leader.replied_at = [0] * nodes
+    leader.pipeline_depth = 2
+    leader.max_batch_entries = 1
+    leader.max_batch_bytes = 1000
+    leader.resend_time = 1
+    leader.sent = []
+    leader._send_message = leader.sent.append
+    return leader
+
+
+def acknowledge(leader, node, success, prev_index, match_index=None, term=None, conflict_term=None, conflict_index=None):
+    """Hand the leader an ack from node to the append entries after prev_index"""
+    term = leader.current_term if term is None else term
+    leader._receive_acknowledge(AppendEntriesMessage(
+        type_ = MessageType.Acknowledge,
+        term = term,
+        sender = leader.all_ids[node],
+        receiver = leader.my_id,
+        direction = MessageDirection.Response,
+        leader_id = leader.my_id,
+        prev_log_index = prev_index,
+        prev_log_term = None,
+        entries = None,
+        leader_commit = None,
+        results = AppendEntriesResults(term=term, success=success, match_index=match_index, conflict_term=conflict_term, conflict_index=conflict_index)
+    ))
+
+
+def sent_entries(leader):
+    """(prev_log_index, receiver) of each append entries the leader has sent, clearing them"""
+    sent = [(message.prev_log_index, message.receiver) for message in leader.sent if message.type == MessageType.AppendEntries]
+    leader.sent.clear()
+    return sent
+
+
+def compact(node, index):
+    """Drop everything up to index from the log the way _take_snapshot does"""
+    term = node._log_term(index)
+    node.log.compact(index - node.snapshot_index, {'term': term, 'entry': 'Snapshot', 'id': -1})
+    node.snapshot_index = index
+    node.snapshot_term = term
+
+
+def test_conflict_hint_short_log():
+    """A follower missing prev_index reports the length of its log"""
+    follower = make_node([1, 1, 2])
+    assert follower._get_conflict_hint(10) == (None, 4)
+
+
+def test_conflict_hint_first_index_of_term():
+    """A follower with a conflicting entry reports the first index of that term"""
+    follower = make_node([1, 1, 2, 2, 2, 3])
+    assert follower._get_conflict_hint(5) == (2, 3)
+    assert follower._get_conflict_hint(2) == (1, 1)
+
+
+def test_conflict_next_index_skips_term():
+    """The leader resumes after its last entry of the follower's term, or at the follower's first index of it"""
+    leader = make_node([1, 1, 2, 2, 4, 4, 4])
+    assert leader._get_conflict_next_index(7, 2, 3) == 5
+    assert leader._get_conflict_next_index(7, 3, 5) == 5
+    assert leader._get_conflict_next_index(7, None, 4) == 4
+    assert leader._get_conflict_next_index(7, None, None) == 7
+
+
+def test_conflicting_follower_reconciled_a_term_per_round_trip():
+    """A follower with a long conflicting tail is brought in line with one rejected round trip per conflicting term, not per entry"""
+    leader = make_leader([1, 1, 1, 4, 4, 4, 4, 5, 5, 5])
+    leader.max_batch_entries = 100
+    leader.next_index[1] = leader._log_max_index()
+    follower = make_node([1, 1, 1, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3])
+
+    round_trips = 0
+    leader._replicate(1)
+    while (leader.sent):
+        round_trips += 1
+        requests = [message for message in leader.sent if message.type == MessageType.AppendEntries]
+        leader.sent.clear()
+        for message in requests:
+            if (follower._verify_entry(message.prev_log_index, message.prev_log_term)):
+                follower._append_entries(message.entries, prev_index=message.prev_log_index)
+                acknowledge(leader, 1, True, message.prev_log_index, match_index=message.prev_log_index + len(message.entries))
+            else:
+                conflict_term, conflict_index = follower._get_conflict_hint(message.prev_log_index)
+                acknowledge(leader, 1, False, message.prev_log_index, conflict_term=conflict_term, conflict_index=conflict_index)
+
+    # Rejected for term 3, rejected for term 2, then the rest of the log in one append entries
+    assert round_trips == 3
+    assert leader.match_index[1] == leader._log_max_index()
+    assert [follower._log_term(i) for i in range(follower._log_max_index() + 1)] == [leader._log_term(i) for i in range(leader._log_max_index() + 1)]
+
+
+def test_committable_index_needs_a_majority():
+    """An index commits once a majority has it, the nodes that are behind don't hold it back"""
+    leader = make_node([1, 1, 1, 1, 1])
+    leader.voters = [True] * 5
+    leader.num_voters = 5
+    leader.match_index = [5, 5, 1, 5, 2]
+    assert leader._get_committable_index() == 5
+    leader.match_index = [5, 4, 1, 3, 2]
+    assert leader._get_committable_index() == 3
+    leader.match_index = [5, 0, 0, 0, 2]
+    assert leader._get_committable_index() == 0
+
+
+def test_replication_window():
+    """Up to pipeline_depth append entries are in flight to a node, one while probing"""
+    leader = make_leader([1, 1, 1, 1, 1])
+    leader.next_index[1] = 2
+    leader._replicate(1)
+    leader._replicate(1)
+    assert sent_entries(leader) == [(1, 'h:1'), (2, 'h:1')]
+    assert list(leader.in_flight[1]) == [(2, 2), (3, 3)]
+    assert leader.next_index[1] == 4
+
+    leader.in_flight[1].clear()
+    leader.probing[1] = True
+    leader.next_index[1] = 2
+    leader._replicate(1)
+    assert sent_entries(leader) == [(1, 'h:1')]
+
+
+def test_only_rejecting_the_oldest_append_entries_starts_probing():
+    """A rejection of a later append entries in flight is stale, a rejection of the oldest probes back from the conflict"""
+    leader = make_leader([1, 1, 1, 1, 1])
+    leader.next_index[1] = 2
+    leader._replicate(1)
+    sent_entries(leader)
+
+    acknowledge(leader, 1, False, 2, conflict_index=1)
+    assert list(leader.in_flight[1]) == [(2, 2), (3, 3)]
+    assert not leader.probing[1]
+    assert sent_entries(leader) == []
+
+    acknowledge(leader, 1, False, 1, conflict_index=1)
+    assert leader.probing[1]
+    assert list(leader.in_flight[1]) == [(1, 1)]
+    assert sent_entries(leader) == [(0, 'h:1')]
+
+    # Once it matches the window opens up again
+    acknowledge(leader, 1, True, 0, match_index=1)
+    assert not leader.probing[1]
+    assert leader.match_index[1] == 1
+    assert list(leader.in_flight[1]) == [(2, 2), (3, 3)]
+    assert sent_entries(leader) == [(1, 'h:1'), (2, 'h:1')]
+
+
+def test_acks_from_an_earlier_term_are_dropped():
+    """An ack sent in an earlier term doesn't move match_index, the log it matched may have changed since"""
+    leader = make_leader([1, 1, 2, 2, 3])
+    leader.next_index[1] = 2
+    leader._replicate(1)
+    sent_entries(leader)
+
+    acknowledge(leader, 1, True, 1, match_index=3, term=2)
+    assert leader.match_index[1] == 0
+    assert list(leader.in_flight[1]) == [(2, 2), (3, 3)]
+    acknowledge(leader, 1, False, 1, conflict_index=1, term=2)
+    assert not leader.probing[1]
+    assert sent_entries(leader) == []
+
+
+def test_lost_append_entries_are_resent_from_the_oldest():
+    """A node that has gone quiet for resend_time is sent everything from its oldest unacknowledged append entries again"""
+    leader = make_leader([1, 1, 1, 1, 1])
+    leader.next_index[1] = 2
+    leader._replicate(1)
+    acknowledge(leader, 1, True, 1, match_index=2)
+    assert list(leader.in_flight[1]) == [(3, 3), (4, 4)]
+    sent_entries(leader)
+
+    leader._resend_lost()
+    assert sent_entries(leader) == []
+
+    leader.heard_from[1] -= 2 * leader.resend_time
+    leader._resend_lost()
+    assert sent_entries(leader) == [(2, 'h:1'), (3, 'h:1')]
+    assert list(leader.in_flight[1]) == [(3, 3), (4, 4)]
+    assert leader.next_index[1] == 5
+
+
+def test_append_entries_skips_duplicates():
+    """Resending entries the follower already has doesn't truncate the log"""
+    follower = make_node([1, 1, 2, 2])
+    follower._append_entries([{'term': 2, 'entry': 3, 'id': 3}], prev_index=2)
+    assert len(follower.log) == 5
+
+
+def test_append_entries_truncates_conflict():
+    """Entries that conflict with the log replace everything after them"""
+    follower = make_node([1, 1, 2, 2])
+    follower._append_entries([{'term': 3, 'entry': 'x', 'id': 'x'}], prev_index=2)
+    assert [e['term'] for e in follower.log] == [1, 1, 1, 3]
+
+
+def test_compacted_log_indexing():
+    """Indices keep their meaning after the log is compacted"""
+    node = make_node([1, 1, 2, 2, 3])
+    compact(node, 3)
+    assert node._log_max_index() == 5
+    assert node._log_entry(4)['entry'] == 4
+    assert node._verify_entry(1, 7)
+    assert node._verify_entry(3, 2)
+    assert not node._verify_entry(4, 3)
+    assert node._get_conflict_hint(5) == (3, 5)
+
+
+def test_append_entries_after_snapshot():
+    """Entries the snapshot already covers are skipped"""
+    node = make_node([1, 1, 2, 2])
+    compact(node, 3)
+    node._append_entries([{'term': 1, 'entry': 2, 'id': 2}, {'term': 2, 'entry': 3, 'id': 3},
+                          {'term': 2, 'entry': 4, 'id': 4}, {'term': 2, 'entry': 5, 'id': 5}], prev_index=1)
+    assert node._log_max_index() == 5
+    assert node._log_entry(5)['entry'] == 5
+
+
+def test_lease_runs_from_majority_send_time():
+    """The lease starts when the heartbeat a majority has confirmed was sent, not when the reply arrived"""
+    leader = make_node([1])
+    leader.all_ids = ['a', 'b', 'c']
+    leader.my_id = 'a'
+    leader.current_num_nodes = 3
+    leader.voters = [True, True, True]
+    leader.num_voters = 3
+    leader.lease_reads = True
+    leader.min_election_timeout = 0.1
+    leader.lease_margin = 0.02
+    leader.lease_confirmed = [0, 0, 0]
+    leader.lease_expiry = 0
+    leader._read_round_sent = {1: 100.0, 2: 105.0}
+    leader._read_round_reads = None
+    leader._confirm_read_round(2, 1)
+    assert abs(leader.lease_expiry - 100.08) < 1e-9
+    leader._confirm_read_round(1, 2)
+    assert abs(leader.lease_expiry - 105.08) < 1e-9
+    leader._confirm_read_round(1, 1)
+    assert abs(leader.lease_expiry - 105.08) < 1e-9
+
+
+def test_follower_read_bounds():
+    """A follower redirects reads it's too far behind for, and serves the rest from storage"""
+    class Storage(object):
+        def flush(self):
+            pass
+
+        def get_value(self, key):
+            return 'v'
+
+    follower = make_node([1, 1])
+    follower._name = 'node1'
+    follower.current_role = 'follower'
+    follower.leader_id = 'leader'
+    follower.storage = Storage()
+    follower.commit_index = 2
+    follower.leader_commit = 5
+    follower.leader_contact = time.time()
+    assert follower.follower_read('k', max_lag=3).result() == 'v'
+    assert follower.follower_read('k', max_age=1).result() == 'v'
+    error = follower.follower_read('k', max_lag=2).exception()
+    assert isinstance(error, StaleRead) and (error.leader_id == 'leader')
+    follower.leader_contact -= 2
+    assert isinstance(follower.follower_read('k', max_age=1).exception(), StaleRead)
+
+    # A leader cut off from the rest may have been deposed, it's held to hearing from a majority within max_age
+    leader = make_node([1, 1])
+    leader._name = 'node0'
+    leader.current_role = 'leader'
+    leader.my_id = leader.leader_id = 'h:0'
+    leader.all_ids = ['h:0', 'h:1', 'h:2']
+    leader.voters = [True, True, True]
+    leader.num_voters = 3
+    leader.storage = Storage()
+    leader.replied_at = [0, time.time(), 0]
+    assert leader.follower_read('k', max_age=1, max_lag=0).result() == 'v'
+    leader.replied_at[1] -= 2
+    error = leader.follower_read('k', max_age=1).exception()
+    assert isinstance(error, StaleRead) and (error.leader_id == 'h:0')
+    assert leader.follower_read('k').result() == 'v'
+
+
+def test_paused_node_times_out_requests():
+    """Requests made on a paused node still fail once their timeout passes"""
+    class Listener(object):
+        initial_backoff = 0
+
+    node = make_node([])
+    node._terminate = False
+    node.listener = Listener()
+    node.current_role = 'none'
+    node.client_futures = {}
+    node._client_deadlines = []
+    node._client_sequence = 0
+    future, _ = node._register_client_future('r', 0.05)
+    runner = threading.Thread(target=node.run)
+    runner.start()
+    try:
+        assert isinstance(future.exception(timeout=0.5), TimeoutError)
+    finally:
+        node._terminate = True
+        runner.join()
+
+
+def test_learners_dont_count_towards_majority():
+    """Only voters count towards a majority, so adding learners doesn't grow it"""
+    leader = make_node([1])
+    leader.voters = [True, True, True, False, False]
+    leader.num_voters = 3
+    assert leader._majority() == 2
+
+
+def test_membership_change_carries_replication_state():
+    """Nodes that stay keep their replication state, nodes that join start fresh and get subscribed to"""
+    class Listener(object):
+        def __init__(self):
+            self.connected = []
+            self.disconnected = []
+
+        def connect(self, address):
+            self.connected.append(address)
+
+        def disconnect(self, address):
+            self.disconnected.append(address)
+
+    book = {'a': {'ip': 'h', 'port': '1'}, 'b': {'ip': 'h', 'port': '2'}, 'c': {'ip': 'h', 'port': '3'}}
+    leader = make_node([1, 1])
+    leader._name = 'a'
+    leader.verbose = False
+    leader.my_id = 'h:1'
+    leader.listener = Listener()
+    leader.all_ids = ['h:1', 'h:2', 'h:3']
+    leader._read_round = 0
+    leader.match_index = [2, 1, 2]
+    for name in ['next_index', 'heard_from', 'replied_at', 'in_flight', 'probing', 'snapshot_transfer', 'lease_confirmed']:
+        setattr(leader, name, [name + str(i) for i in range(3)])
+
+    del book['b']
+    book['d'] = {'ip': 'h', 'port': '4', 'learner': True}
+    leader._apply_config(book, 3)
+    assert leader.all_ids == ['h:1', 'h:3', 'h:4']
+    assert leader.match_index == [2, 2, 0]
+    assert leader.probing[:2] == ['probing0', 'probing2']
+    assert (leader.voters == [True, True, False]) and (leader._majority() == 2)
+    assert (leader.listener.connected[-1] == 'h:4') and (leader.listener.disconnected == ['h:2'])
+
+
+def test_truncated_membership_change_is_undone():
+    """Cutting the first ever membership change from the log goes back to the address book the node started with"""
+    class Listener(object):
+        def connect(self, address):
+            pass
+
+        def disconnect(self, address):
+            pass
+
+    class Storage(object):
+        def flush(self):
+            pass
+
+        def get_value(self, key):
+            return None
+
+    book = {'a': {'ip': 'h', 'port': '1'}, 'b': {'ip': 'h', 'port': '2'}, 'c': {'ip': 'h', 'port': '3'}}
+    follower = make_leader([1, 1])
+    follower.current_role = 'follower'
+    follower.my_id = 'h:1'
+    follower.all_ids = ['h:1', 'h:2', 'h:3']
+    follower.address_book = follower.initial_address_book = book
+    follower.listener = Listener()
+    follower.storage = Storage()
+    for name in ['next_index', 'match_index', 'heard_from', 'replied_at', 'in_flight', 'probing', 'snapshot_transfer', 'lease_confirmed']:
+        setattr(follower, name, [0, 0, 0])
+
+    grown = dict(book, d={'ip': 'h', 'port': '4'})
+    follower._append_entries([{'term': 2, 'entry': {'key': '_raft_config', 'value': grown}, 'id': 'add d'}], prev_index=2)
+    assert (sorted(follower.address_book) == ['a', 'b', 'c', 'd']) and (follower.num_voters == 4)
+    follower._append_entries([{'term': 3, 'entry': 'x', 'id': 'x'}], prev_index=2)
+    assert (sorted(follower.address_book) == ['a', 'b', 'c']) and (follower.num_voters == 3)
+    assert follower.all_ids == ['h:1', 'h:2', 'h:3']
+
+
+def test_log_hash_is_bounded():
+    """Only the most recently committed ids stay in memory"""
+    class Storage(object):
+        def commit_logs(self, entries):
+            self.entries = entries
+
+    node = make_node([1, 1, 1, 1])
+    node.storage = Storage()
+    node.client_futures = {}
+    node.snapshot_threshold = None
+    node.last_applied_index = 0
+    node.max_log_hash_entries = 2
+    node._commit_entry(4)
+    assert list(node.log_hash) == [3, 4]
+    assert node.storage.entries[-1] == (4, 1, 4, 4)
+
+
+def test_session_retries_applied_once():
+    """A retry of a session's request that made it into the log is applied as a no-op and gets the original result"""
+    class Storage(object):
+        def commit_logs(self, entries):
+            self.entries = entries
+
+        def get_value(self, key):
+            return None
+
+    node = make_node([])
+    node.log.extend([{'term': 1, 'entry': {'key': 'a', 'value': v}, 'id': ('c', s), 'session': ['c', s]} for v, s in [(1, 1), (1, 1), (2, 2), (1, 1)]])
+    node.storage = Storage()
+    node.snapshot_threshold = None
+    node.last_applied_index = 0
+    node.max_log_hash_entries = 10
+    node.client_futures = {}
+    node._commit_entry(4)
+    assert [e[2] for e in node.storage.entries] == [{'key': 'a', 'value': 1}, None, {'key': 'a', 'value': 2}, None]
+    assert node.storage.entries[2][4] == {'_raft_session/"c"': [2, 3]}
+    assert node.sessions['c'] == (2, 3)
+
+
+def test_superseded_session_requests_fail():
+    """The leader only drops retries of the request it appended last, others fail or are appended instead of hanging"""
+    class Storage(object):
+        def get_value(self, key):
+            return None
+
+    def request(id_num, sequence):
+        return {'term': 1, 'entry': sequence, 'id': id_num, 'session': ['c', sequence]}
+
+    leader = make_node([])
+    leader.storage = Storage()
+    futures = {'retry': Future(), 'old': Future()}
+    leader.client_futures = dict(futures)
+    assert leader._drop_duplicate_requests([request(['c', 2], 2)], appending=True) == [request(['c', 2], 2)]
+    kept = leader._drop_duplicate_requests([request(['c', 2], 2), request('retry', 2), request('old', 1), request('forwarded', 1)],
+                                           appending=True)
+    assert kept == [request('forwarded', 1)]
+    assert leader.client_futures == {}
+    assert all(isinstance(future.exception(0), SupersededRequest) for future in futures.values())
+
+
+def test_forwarded_requests_take_the_leaders_term():
+    """A request stamped with an older term by the follower that took it goes into the leader's log under the leader's term"""
+    leader = make_node([1, 2])
+    leader.current_term = 3
+    leader.my_id = 'h:0'
+    leader.all_ids = ['h:0']
+    leader.current_num_nodes = 1
+    leader.next_index = [3]
+    leader.match_index = [2]
+    leader._broadcast_append_entries([{'term': 1, 'entry': 'x', 'id': 'x'}, {'term': 2, 'entry': 'y', 'id': 'y'}])
+    assert [leader._log_term(i) for i in range(leader._log_max_index() + 1)] == [1, 1, 2, 3, 3]
+    assert (leader.next_index, leader.match_index) == ([5], [4])
+
+
+def test_session_retries_are_sent_again():
+    """A pending session request is queued again when retried, sharing its future, a plain request isn't"""
+    node = make_leader([1])
+    node.client_queue = Queue()
+    first = node.client_request('a', client_id='c', sequence=1)
+    assert node.client_request('a', client_id='c', sequence=1) is first
+    plain = node.client_request('b', id_num='p')
+    assert node.client_request('b', id_num='p') is plain
+    queued = [node.client_queue.get_nowait() for _ in range(node.client_queue.qsize())]
+    assert [entry['id'] for entry in queued] == [('c', 1), ('c', 1), 'p']
+
+    # The leader appends the first and drops the retry, it still holds the same (sequence, id)
+    assert node._drop_duplicate_requests(queued[:2], appending=True) == queued[:1]
+
+
+def test_committal_stops_at_verified_index():
+    """A committal or heartbeat can't commit past what you've matched with the leader that sent it"""
+    follower = make_node([1, 1, 2, 2, 2])
+    follower.commit_index = 1
+    follower._verified_term = 2
+    follower._verified_index = 3
+    committed = []
+    follower._commit_entry = committed.append
+    follower._commit_verified(2, 5)
+    assert committed == [3]
+    follower.commit_index = 3
+    follower._commit_verified(3, 5)
+    follower._commit_verified(2, 2)
+    assert committed == [3]
+
+
+def wait_for(condition, timeout=10.0):
+    """Poll condition until it holds or timeout seconds pass"""
+    deadline = time.time() + timeout
+    while (time.time() < deadline):
+        if (condition()):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def cluster_node(tmp_path, config, name):
+    """A node of config over the in process transport, storing its data under tmp_path"""
+    return RaftNode(config, name, verbose=False, in_process=True, storage=CachedKVStorage(str(tmp_path / f'{name}.db')))
+
+
+def cluster_leader(nodes):
+    """The leader, if exactly one node thinks it's the leader"""
+    leaders = [node for node in nodes.values() if (node.check_role() == 'leader')]
+    return leaders[0] if (len(leaders) == 1) else None
+
+
+def test_cluster_commits_without_committals(tmp_path):
+    """Three nodes replicate a batch of writes and followers commit it from the append entries and heartbeats that follow"""
+    config = {f'node{i}': {'ip': '127.0.0.1', 'port': str(7311 + i)} for i in range(3)}
+    committals = []
+    nodes = {}
+    try:
+        for name in config:
+            nodes[name] = cluster_node(tmp_path, config, name)
+            nodes[name]._send_committal = lambda *args, **kwargs: committals.append(args)
+            nodes[name].start()
+        assert wait_for(lambda: cluster_leader(nodes) is not None)
+        futures = [cluster_leader(nodes).client_request({'key': f'k{i}', 'value': i}, timeout=5) for i in range(20)]
+        index = futures[-1].result(5)
+        assert wait_for(lambda: all(node.commit_index >= index for node in nodes.values()))
+        assert all(node.follower_read('k19').result() == 19 for node in nodes.values())
+        assert committals == []
+    finally:
+        for node in nodes.values():
+            node.stop()
+
+
+def test_cluster_adds_and_removes_members(tmp_path):
+    """A node joins a live cluster and catches up, then another leaves and the rest keep committing"""
+    config = {f'node{i}': {'ip': '127.0.0.1', 'port': str(7321 + i)} for i in range(3)}
+    nodes = {}
+    try:
+        for name in config:
+            nodes[name] = cluster_node(tmp_path, config, name)
+            nodes[name].start()
+        assert wait_for(lambda: cluster_leader(nodes) is not None)
+        cluster_leader(nodes).client_request({'key': 'k0', 'value': 0}, timeout=5).result()
+
+        config['node3'] = {'ip': '127.0.0.1', 'port': '7324'}
+        nodes['node3'] = cluster_node(tmp_path, config, 'node3')
+        nodes['node3'].start()
+        assert cluster_leader(nodes).add_node('node3', '127.0.0.1', '7324').result(5) is not None
+        assert wait_for(lambda: nodes['node3'].follower_read('k0').result() == 0)
+        assert cluster_leader(nodes).num_voters == 4
+
+        gone = [name for name, node in nodes.items() if (node is not cluster_leader(nodes)) and (name != 'node3')][0]
+        cluster_leader(nodes).remove_node(gone).result(5)
+        nodes.pop(gone).stop()
+        index = cluster_leader(nodes).client_request({'key': 'after', 'value': 1}, timeout=5).result()
+        assert wait_for(lambda: all(node.commit_index >= index for node in nodes.values()))
+        assert all((node.num_voters == 3) and (gone not in node.address_book) for node in nodes.values())
+    finally:
+        for node in nodes.values():
+            node.stop()
+
+
+def test_read_index_batches_reads_behind_one_round():
+    """Reads queued together share one confirmation round and are served once a majority acks it, later ones wait for the next"""
+    leader = make_leader([1, 1])
+    first = [leader.linearizable_read('k') for _ in range(3)]
+    leader._start_read_round()
+    assert [message.read_round for message in leader.sent] == [1]
+
+    later = leader.linearizable_read('k')
+    leader._start_read_round()
+    assert len(leader.sent) == 1
+    leader._confirm_read_round(1, 0)
+    assert not any(future.done() for future in first)
+
+    # One other voter is a majority of three
+    leader._confirm_read_round(1, 1)
+    assert [future.result(0) for future in first] == ['v'] * 3
+    assert not later.done()
+    leader._start_read_round()
+    leader._confirm_read_round(2, 2)
+    assert later.result(0) == 'v'
+
+
+def test_read_index_waits_for_an_entry_of_its_term():
+    """A new leader doesn't start a round until an entry of its own term has been applied"""
+    leader = make_leader([1, 1])
+    leader.current_term = 2
+    future = leader.linearizable_read('k')
+    leader._start_read_round()
+    assert (leader.sent == []) and (not future.done())
+    leader.last_applied_term = 2
+    leader._start_read_round()
+    leader._confirm_read_round(1, 1)
+    assert future.result(0) == 'v'
+
+
+def test_read_index_failures():
+    """A follower refuses reads with NotLeader, a leader that steps down fails the reads it holds with LeadershipLost"""
+    follower = make_leader([1, 1])
+    follower.current_role = 'follower'
+    follower.leader_id = 'h:1'
+    error = follower.linearizable_read('k').exception(0)
+    assert isinstance(error, NotLeader) and (error.leader_id == 'h:1')
+
+    leader = make_leader([1, 1])
+    in_round = leader.linearizable_read('k')
+    leader._start_read_round()
+    queued = leader.linearizable_read('k')
+    leader._set_current_role('follower')
+    assert all(isinstance(future.exception(0), LeadershipLost) for future in [in_round, queued])
+
+
+def test_client_futures_resolve_on_commit():
+    """A request's future resolves with its commit index once the entry is applied"""
+    class Storage(object):
+        def commit_logs(self, entries):
+            pass
+
+    node = make_leader([1, 1])
+    node.commit_index = node.last_applied_index = 0
+    node.storage = Storage()
+    node.snapshot_threshold = None
+    node.max_log_hash_entries = 10
+    del node._commit_entry
+    future, pending = node._register_client_future(2, None)
+    assert (not pending) and (node._register_client_future(2, None) == (future, True))
+    node._commit_entry(1)
+    assert not future.done()
+    node._commit_entry(2)
+    assert (future.result(0) == 2) and (node.client_futures == {})
+
+
+def test_client_futures_fail_on_leadership_loss():
+    """Pending requests fail when the leader steps down, or when a follower's leader is replaced by another"""
+    leader = make_leader([1, 1])
+    future, _ = leader._register_client_future('x', None)
+    leader._set_current_role('follower')
+    assert isinstance(future.exception(0), LeadershipLost)
+
+    follower = make_leader([1, 1])
+    follower.current_role = 'follower'
+    follower.leader_id = 'h:1'
+    future, _ = follower._register_client_future('y', None)
+    follower._follow_leader('h:1')
+    assert not future.done()
+    follower._follow_leader('h:2')
+    assert isinstance(future.exception(0), LeadershipLost) and (follower.leader_id == 'h:2')
+
+
+def test_follower_ignores_deposed_leaders_heartbeats():
+    """A heartbeat from an older term doesn't count as hearing from the leader, one from the current term does"""
+    def heartbeat(term, leader_id, leader_commit):
+        return AppendEntriesMessage(type_=MessageType.Heartbeat, term=term, sender=leader_id, receiver=None,
+                                    direction=MessageDirection.Request, leader_id=leader_id, leader_commit=leader_commit)
+
+    follower = make_leader([1, 2])
+    follower.current_role = 'follower'
+    follower.current_term = 2
+    follower.leader_id = 'h:1'
+    follower.leader_contact = 0
+    follower.leader_commit = 1
+    follower._verified_term = None
+    follower.is_learner = False
+    follower.election_timeout = 10
+    follower.lease_reads = False
+    follower._terminate = False
+    follower._get_client_batch = lambda: []
+    messages = [heartbeat(1, 'h:2', 5)]
+    def get_message(wake_time):
+        if (not messages):
+            follower._terminate = True
+            return None
+        return messages.pop(0)
+    follower._get_message = get_message
+
+    follower._follower()
+    assert (follower.leader_id, follower.leader_contact, follower.leader_commit) == ('h:1', 0, 1)
+    assert isinstance(follower.follower_read('k', max_age=1).exception(0), StaleRead)
+
+    follower._terminate = False
+    messages.append(heartbeat(2, 'h:1', 2))
+    follower._follower()
+    assert (follower.leader_commit == 2) and (follower.follower_read('k', max_age=1).result(0) == 'v')
+
+
+def batching_node(entries, max_batch_entries=100, max_batch_bytes=1000, batch_linger=0):
+    """make_leader with entries waiting in its client queue"""
+    node = make_leader([1])
+    node.client_queue = Queue()
+    node.max_batch_entries = max_batch_entries
+    node.max_batch_bytes = max_batch_bytes
+    node.batch_linger = batch_linger
+    for entry in entries:
+        node.client_queue.put(entry)
+    return node
+
+
+def test_client_batch_limits():
+    """A batch stops at max_batch_entries, or once it reaches max_batch_bytes, but always holds at least one request"""
+    requests = [{'term': 1, 'entry': i, 'id': i} for i in range(5)]
+    node = batching_node(requests, max_batch_entries=2)
+    assert [node._get_client_batch() for _ in range(4)] == [requests[0:2], requests[2:4], requests[4:5], []]
+
+    node = batching_node(requests, max_batch_bytes=2 * len(json.dumps(requests[0])))
+    assert [node._get_client_batch() for _ in range(4)] == [requests[0:2], requests[2:4], requests[4:5], []]
+
+    large = [{'term': 1, 'entry': 'x' * 100, 'id': i} for i in range(2)]
+    node = batching_node(large, max_batch_bytes=10)
+    assert [node._get_client_batch() for _ in range(3)] == [large[0:1], large[1:2], []]
+
+
+def test_client_batch_lingers_for_more_requests():
+    """A batch that isn't full waits up to batch_linger for more requests, an empty queue or a zero linger doesn't wait"""
+    requests = [{'term': 1, 'entry': i, 'id': i} for i in range(2)]
+    node = batching_node(requests[:1], batch_linger=1)
+    threading.Timer(0.1, node.client_queue.put, (requests[1],)).start()
+    assert node._get_client_batch() == requests
+
+    start = time.time()
+    assert node._get_client_batch() == []
+    node.batch_linger = 0
+    node.client_queue.put(requests[0])
+    assert node._get_client_batch() == requests[:1]
+    assert (time.time() - start) < 0.5
+
+    node.batch_linger = 0.2
+    node.client_queue.put(requests[0])
+    start = time.time()
+    assert node._get_client_batch() == requests[:1]
+    assert (time.time() - start) >= 0.2
+
+
+def test_follower_forwards_requests_in_batches():
+    """A follower that knows the leader forwards everything queued on it, split into batches"""
+    requests = [{'term': 1, 'entry': i, 'id': i} for i in range(5)]
+    follower = batching_node(requests, max_batch_entries=2)
+    follower.current_role = 'follower'
+    follower.leader_id = 'h:1'
+    follower.last_applied_index = follower._log_max_index()
+    follower.is_learner = False
+    follower.election_timeout = 10
+    follower._terminate = False
+    def get_message(wake_time):
+        follower._terminate = True
+        return None
+    follower._get_message = get_message
+
+    follower._follower()
+    forwarded = [message for message in follower.sent if message.type == MessageType.ClientRequest]
+    assert [message.entries for message in forwarded] == [requests[0:2], requests[2:4], requests[4:5]]
+    assert all(message.receiver == 'h:1' for message in forwarded)
+    assert follower.client_queue.empty()